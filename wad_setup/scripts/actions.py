@@ -38,6 +38,17 @@ def pip_install(pkglist, **kwargs):
 def pip_install_requirements(**kwargs):
     return helpers.pip_install_requirements(**kwargs)
 
+def probe_host(installation_root, **kwargs):
+    """
+    Benchmark cpu, memory, fsync and I/O on the filesystem of WADROOT; the results size the generated settings
+    """
+    from . import hostprobe as act
+    result, msg = ("OK", "")
+
+    result, msg = act.probe_host(installation_root, **kwargs)
+
+    return result, msg
+
 def create_folders_settings(**kwargs):
     """
     Create the WADQC Root folder, and all subfolders. Create settings files for WADQC services.
@@ -240,7 +251,7 @@ def create_postgresql_datadir(installation_root, **kwargs):
     """
     from . import database_setup as ds
     pgport = kwargs.get('pgsql_port', 5432)
-    result, msg = ds.create_postgresql_datadir(installation_root, pgport) # create_folders_settings must have been run first
+    result, msg = ds.create_postgresql_datadir(installation_root, pgport, kwargs.get('postgresql_settings', None)) # create_folders_settings must have been run first
 
     return result, msg
     
@@ -336,6 +347,28 @@ def nginx_deploy_sites(sitelist, portlist, installation_root, **kwargs):
 
     return result, msg
 
+def load_test(**kwargs):
+    """
+    Load test the deployed sites; sites and ports are taken from the *_deploy_sites action of this recipe
+    """
+    from . import loadtest as act
+    result, msg = ("OK", "")
+
+    result, msg = act.load_test(**kwargs)
+
+    return result, msg
+
+def record_importtime(sitelist, **kwargs):
+    """
+    Record the import-time profiles of the sites in WADROOT/WAD_QC/importtime; also done by the *_deploy_sites actions
+    """
+    from . import importtime as act
+    result, msg = ("OK", "")
+
+    result, msg = act.record_importtime(sitelist, **kwargs)
+
+    return result, msg
+
 def firewall_add_port(portlist, **kwargs):
     """
     Open ports in firewall
@@ -358,6 +391,40 @@ def create_start_systemd(service, installation_root, **kwargs):
 
     return result, msg
 
+def create_start_systemd_units(services, installation_root, **kwargs):
+    """
+    Create systemd startup scripts for a list of services, install them with one daemon-reload and start them together
+    """
+    from . import systemd_setup as act
+    result, msg = ("OK", "")
+
+    result, msg = act.install_units(services, installation_root, **kwargs)
+
+    return result, msg
+
+def create_maintenance_timers(jobs, installation_root, **kwargs):
+    """
+    Install systemd timers for maintenance jobs (vacuum, reindex, storage, retention) and enable them
+    """
+    from . import systemd_setup as act
+    result, msg = ("OK", "")
+
+    result, msg = act.install_units(['wadmaint-{}'.format(job) for job in jobs], installation_root, **kwargs)
+
+    return result, msg
+
+def update_systemd(service, installation_root, **kwargs):
+    """
+    Apply changed settings to an installed systemd service as a drop-in; restart it only if needed
+    """
+    from . import systemd_setup as act
+    import time
+    result, msg = ("OK", "")
+
+    result, msg = act.update_service(service, installation_root, time.strftime('%Y%m%d_%H%M%S'), **kwargs)
+
+    return result, msg
+
 def create_virtualenv(name, workon_home, python3, activate_on_login, **kwargs):
     """
     Install requirements for virtualenv, create Envs home, make an environment named <name> of python3 (True)
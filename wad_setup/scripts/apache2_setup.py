@@ -6,6 +6,8 @@ from .folders_settings import copy_replaces
 from .which import which
 from .defaults import LOGGERNAME
 from .actions import pip_install
+from .importtime import record_importtime
+from .hostprobe import recommend
 
 logger = logging.getLogger(LOGGERNAME)
 
@@ -153,10 +155,14 @@ def _deploy_sites(paths, sitelist, portlist, installation_root, **kwargs):
     import getpass
     user = getpass.getuser() # gets the name of the user running this shell
 
+    # mod_wsgi starts the interpreter of the virtualenv itself, instead of the wsgi file activating it
     if not "virtualenv" in kwargs.keys() or kwargs['virtualenv'].strip() == "": 
-        venvbin = 'None' #Needs to be a string for replace!
+        pythonhome = ''
     else:
-        venvbin = '"{}"'.format(os.path.abspath(os.path.expanduser(kwargs['virtualenv']))) # note the quotes!
+        pythonhome = 'python-home={}'.format(os.path.dirname(os.path.abspath(os.path.expanduser(kwargs['virtualenv']))))
+
+    # threads of the mod_wsgi daemon process of each site
+    threads = recommend('wsgi_threads', installation_root, 5, kwargs.get('wsgi_threads', None))
 
     # add the sites
     pos = { k:i for i,k in enumerate(sitelist)}
@@ -166,8 +172,8 @@ def _deploy_sites(paths, sitelist, portlist, installation_root, **kwargs):
         # create proper paths in wsgi
         xtra_paths = [ os.path.dirname(p) for p in [which('wadcontrol'), which('Orthanc'), which('pg_config')]]
         dest = os.path.join(installation_root, 'admin_wadqc.wsgi')
-        inlist  = ['__WADROOT__',   '__XTRAPATHS__', '__VENVBIN__', '\\']
-        outlist = [installation_root, str(xtra_paths),    venvbin,       '/']
+        inlist  = ['__WADROOT__',   '__XTRAPATHS__', '\\']
+        outlist = [installation_root, str(xtra_paths), '/']
         copy_replaces(src=os.path.join(paths['wsgi'], 'admin_wadqc.wsgi'), 
                       dest=dest, 
                       inlist=inlist, 
@@ -185,8 +191,8 @@ def _deploy_sites(paths, sitelist, portlist, installation_root, **kwargs):
         else:
             listen = "Listen"
 
-        inlist  = ['__LISTEN__',  '__USER__',   '__GROUP__', '__PORT__',  '\\']
-        outlist = [listen,       user,          user,       str(port),  '/']
+        inlist  = ['__LISTEN__',  '__USER__',   '__GROUP__', '__PORT__', '__THREADS__',      '__PYTHONHOME__', '\\']
+        outlist = [listen,       user,          user,       str(port), str(int(threads)), pythonhome,       '/']
         copy_replaces(src=os.path.join(paths['conf'], 'admin_wadqc.conf'), 
                       dest=dest, 
                       inlist=inlist, 
@@ -199,8 +205,8 @@ def _deploy_sites(paths, sitelist, portlist, installation_root, **kwargs):
     if 'wad_dashboard' in sitelist:
         # create proper paths in wsgi
         dest = os.path.join(installation_root, 'dashboard_wadqc.wsgi')
-        inlist  = ['__WADROOT__',   '__VENVBIN__', '\\']
-        outlist = [installation_root, venvbin,     '/']
+        inlist  = ['__WADROOT__',   '\\']
+        outlist = [installation_root, '/']
         copy_replaces(src=os.path.join(paths['wsgi'], 'dashboard_wadqc.wsgi'), 
                       dest=dest, 
                       inlist=inlist, 
@@ -218,8 +224,8 @@ def _deploy_sites(paths, sitelist, portlist, installation_root, **kwargs):
         else:
             listen = "Listen"
 
-        inlist  = ['__LISTEN__',  '__USER__',   '__GROUP__', '__PORT__',  '\\']
-        outlist = [listen,       user,          user,       str(port),  '/']
+        inlist  = ['__LISTEN__',  '__USER__',   '__GROUP__', '__PORT__', '__THREADS__',      '__PYTHONHOME__', '\\']
+        outlist = [listen,       user,          user,       str(port), str(int(threads)), pythonhome,       '/']
         copy_replaces(src=os.path.join(paths['conf'], 'dashboard_wadqc.conf'), 
                       dest=dest, 
                       inlist=inlist, 
@@ -232,8 +238,8 @@ def _deploy_sites(paths, sitelist, portlist, installation_root, **kwargs):
     if 'wad_api' in sitelist:
         # create proper paths in wsgi
         dest = os.path.join(installation_root, 'api_wadqc.wsgi')
-        inlist  = ['__WADROOT__', '__XTRAPATHS__',  '__VENVBIN__', '\\']
-        outlist = [installation_root, str(xtra_paths), venvbin,     '/']
+        inlist  = ['__WADROOT__', '__XTRAPATHS__',  '\\']
+        outlist = [installation_root, str(xtra_paths), '/']
         copy_replaces(src=os.path.join(paths['wsgi'], 'api_wadqc.wsgi'), 
                       dest=dest, 
                       inlist=inlist, 
@@ -250,8 +256,8 @@ def _deploy_sites(paths, sitelist, portlist, installation_root, **kwargs):
         else:
             listen = "Listen"
 
-        inlist  = ['__LISTEN__',  '__USER__',   '__GROUP__', '__PORT__',  '\\']
-        outlist = [listen,       user,          user,       str(port),  '/']
+        inlist  = ['__LISTEN__',  '__USER__',   '__GROUP__', '__PORT__', '__THREADS__',      '__PYTHONHOME__', '\\']
+        outlist = [listen,       user,          user,       str(port), str(int(threads)), pythonhome,       '/']
         copy_replaces(src=os.path.join(paths['conf'], 'api_wadqc.conf'), 
                       dest=dest, 
                       inlist=inlist, 
@@ -297,6 +303,14 @@ def apache2_deploy_sites(sitelist, portlist, installation_root, **kwargs):
                 errormsg = 'ERROR! Could not deploy_sites sites on apache2! '
                 return result, errormsg+msg
 
+    # baseline of the app import time, which is paid by each mod_wsgi daemon on (re)start
+    if kwargs.get('importtime', True):
+        result2, msg2 = record_importtime(sitelist, installation_root, **kwargs)
+        if result2 == 'ERROR':
+            logger.warning(msg2)
+        else:
+            logger.info(msg2)
+
     return result, msg
 
 def httpd_deploy_sites(sitelist, portlist, installation_root, **kwargs):
@@ -376,6 +390,14 @@ def httpd_deploy_sites(sitelist, portlist, installation_root, **kwargs):
                 errormsg = 'ERROR! Could not deploy_sites sites on httpd! '
                 return result, errormsg+msg
 
+    # baseline of the app import time, which is paid by each mod_wsgi daemon on (re)start
+    if kwargs.get('importtime', True):
+        result2, msg2 = record_importtime(sitelist, installation_root, **kwargs)
+        if result2 == 'ERROR':
+            logger.warning(msg2)
+        else:
+            logger.info(msg2)
+
     return result, msg
 
 def firewall_add_port(portlist, **kwargs):
@@ -1,9 +1,10 @@
 #!/usr/bin/env python
 from __future__ import print_function
-__version__ = '20170503' 
+__version__ = '20261019' 
 
 """
 Changelog:
+    20261019: memory and planner settings of PostgreSQL sized from the host probe
     20170503: added ports for PostgreSQL
 """
 
@@ -15,10 +16,12 @@ try:
     from .helpers import external_call, port_available
     from .defaults import LOGGERNAME
     from .folders_settings import copy_replaces
+    from .hostprobe import recommend
 except:
     from helpers import external_call, port_available
     from defaults import LOGGERNAME
     from folders_settings import copy_replaces
+    from hostprobe import recommend
     
 logger = logging.getLogger(LOGGERNAME)
 
@@ -50,10 +53,32 @@ def get_dict_from_jsonfile(jsonfile):
     setup = json.loads(validjson)
     return setup
 
-def create_postgresql_datadir(wadroot=None, pgport=5432):
+SIZING_BEGIN = '# ---- sized by wad_setup'
+SIZING_END = '# ---- end of sized by wad_setup'
+
+def set_postgresql_sizing(conffile, settings):
+    """
+    Write settings at the end of postgresql.conf, where they override the defaults above them.
+    A block written before is replaced, so this can be repeated.
+    """
+    with open(conffile, 'r') as fio:
+        lines = fio.read().splitlines()
+    if SIZING_BEGIN in lines and SIZING_END in lines:
+        lines = lines[:lines.index(SIZING_BEGIN)]+lines[lines.index(SIZING_END)+1:]
+
+    if len(settings) > 0:
+        lines.append(SIZING_BEGIN)
+        for key in sorted(settings.keys()):
+            lines.append('{} = {}'.format(key, settings[key]))
+        lines.append(SIZING_END)
+    with open(conffile, 'w') as fio:
+        fio.write('\n'.join(lines)+'\n')
+
+def create_postgresql_datadir(wadroot=None, pgport=5432, settings=None):
     """
     Create a new PostgreSQL datadir under WADROOT.
     This step is needed before create_databases databases can be called.
+    The memory and planner settings are sized from the host probe; settings of the recipe override them.
     """
     logger = logging.getLogger(LOGGERNAME)
     logger.info('Creating datadir for PostgreSQL...')
@@ -108,6 +133,11 @@ def create_postgresql_datadir(wadroot=None, pgport=5432):
         if cmd[0] == 'fix_config':
             copy_replaces(src=src, dest=dest, 
                           inlist=inlist, outlist=outlist) 
+            sizing = dict(recommend('postgresql', wadroot, {}))
+            for key, val in (settings or {}).items():
+                logger.info('...postgresql {} = {}: set in recipe'.format(key, val))
+                sizing[key] = val
+            set_postgresql_sizing(dest, sizing)
             continue
 
         result, msg = external_call(cmd, returnoutput=True, background=bk)
@@ -13,6 +13,7 @@ import shlex
 import collections
 import errno
 import os
+import stat
 import sys
 import subprocess
 import signal
@@ -21,6 +22,9 @@ import socket
 import tempfile
 import datetime
 import fcntl
+import select
+import json
+import array
 
 if sys.version[0] == '2':
     string_types = basestring
@@ -79,7 +83,21 @@ DefaultTimeoutStartSec = int(os.environ.get("SYSTEMCTL_TIMEOUT_START_SEC", 90))
 DefaultTimeoutStopSec = int(os.environ.get("SYSTEMCTL_TIMEOUT_STOP_SEC", 90))   # official value
 DefaultMaximumTimeout = int(os.environ.get("SYSTEMCTL_MAXIMUM_TIMEOUT", 200))   # overrides all other
 InitLoopSleep = int(os.environ.get("SYSTEMCTL_INITLOOP", 5))
-ProcMaxDepth = 100
+ParallelJobs = int(os.environ.get("SYSTEMCTL_PARALLEL_JOBS", 4)) # units of one level started at once
+UnitCacheFile = os.environ.get("SYSTEMCTL_UNIT_CACHE", "systemctl.units.cache") # in _notify_socket_folder, "" = off
+ControlSocket = os.environ.get("SYSTEMCTL_CONTROL_SOCKET", "systemctl.control") # in _notify_socket_folder, "" = off
+JournalMaxMB = int(os.environ.get("SYSTEMCTL_JOURNAL_MAX_MB", 50))      # rotate a journal log above that size, 0 = off
+JournalMaxAgeSec = int(os.environ.get("SYSTEMCTL_JOURNAL_MAX_AGE_SEC", 0)) # rotate a journal log after that time, 0 = off
+JournalKeep = int(os.environ.get("SYSTEMCTL_JOURNAL_KEEP", 5))          # rotated copies kept as <unit>.log.1 ...
+JournalCompress = os.environ.get("SYSTEMCTL_JOURNAL_COMPRESS", "") not in [ "", "no", "0" ] # gzip the rotated copies
+CgroupSlice = os.environ.get("SYSTEMCTL_CGROUP", "system.slice") # the units' cgroups below our own cgroup, "" = off
+DefaultRestartSec = "100ms" # official value
+DefaultMaximumRestartSec = int(os.environ.get("SYSTEMCTL_MAXIMUM_RESTART_SEC", 3600))
+DefaultStartLimitIntervalSec = 10 # official value
+DefaultStartLimitBurst = 5 # official value
+PR_SET_CHILD_SUBREAPER = 36 # linux/prctl.h
+IN_WRITTEN = 0x2 | 0x8 | 0x80 | 0x100 # linux/inotify.h: IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+BackoffSleep = 0.01 # first step of the waits that can not wait for an event
 MaxLockWait = None # equals DefaultMaximumTimeout
 DefaultPath = "/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin"
 ResetLocale = ["LANG", "LANGUAGE", "LC_CTYPE", "LC_NUMERIC", "LC_TIME", "LC_COLLATE", "LC_MONETARY",
@@ -90,6 +108,17 @@ ResetLocale = ["LANG", "LANGUAGE", "LC_CTYPE", "LC_NUMERIC", "LC_TIME", "LC_COLL
 _notify_socket_folder = "/var/run/systemd" # alias /run/systemd
 _pid_file_folder = "/var/run"
 _journal_log_folder = "/var/log/journal"
+_cgroup_folder = "/sys/fs/cgroup" # cgroup v2 (unified) hierarchy, not below --root
+
+# resource-control settings => (controller, file) in the cgroup of the unit
+_cgroup_properties = collections.OrderedDict([
+    ("CPUWeight", ("cpu", "cpu.weight")),
+    ("CPUQuota", ("cpu", "cpu.max")),
+    ("AllowedCPUs", ("cpuset", "cpuset.cpus")),
+    ("IOWeight", ("io", "io.weight")),
+    ("MemoryHigh", ("memory", "memory.high")),
+    ("MemoryMax", ("memory", "memory.max")),
+    ("TasksMax", ("pids", "pids.max")) ])
 
 _systemctl_debug_log = "/var/log/systemctl.debug.log"
 _systemctl_extra_log = "/var/log/systemctl.log"
@@ -164,6 +193,14 @@ def get_home():
     if explicit: return explicit
     return os.path.expanduser("~")
 
+def _runtime_file(name): # -> filename?
+    """ a file in the (--root) _notify_socket_folder, None when the name is "" or "no" """
+    if not name or name in [ "no", "off", "0" ]:
+        return None
+    if os.path.isabs(name):
+        return os_path(_root, name)
+    return os_path(_root, _var(os.path.join(_notify_socket_folder, name)))
+
 def _var(path):
     """ assumes that the path starts with /var - and when
         in --user mode it is moved to /run/user/1001/run/
@@ -260,16 +297,181 @@ def _pid_zombie(pid):
         # On certain systems 0 is a valid PID but we have no way
         # to know that in a portable fashion.
         raise ValueError('invalid PID 0')
-    check = "/proc/%s/status" % pid
+    return ProcessTable([ pid ]).is_zombie(pid)
+
+def _file_stamp(path):
+    """ what the unit cache compares to see if a file or folder has changed.
+        Symlinks (enabled or masked units) are followed for their target.
+        A list, as it is stored in the json of the unit cache. """
+    try:
+        st = os.lstat(path)
+        stamp = [ st.st_mtime, st.st_size, st.st_ino ]
+        if os.path.islink(path):
+            st = os.stat(path)
+            stamp += [ os.readlink(path), st.st_mtime, st.st_size ]
+        return stamp
+    except OSError:
+        return None
+
+class ProcessTable:
+    """ a snapshot of the process table from one pass over /proc/*/stat (or over the stat
+        of the given pids only), with an index of the children of each process, so that
+        the descendants of a process are found in linear time """
+    def __init__(self, pids = None):
+        self.state = {} # pid => state letter, 'Z' for a zombie
+        self.ppid = {} # pid => parent pid
+        self.children = {} # pid => [ child pids ]
+        if pids is None:
+            pids = [ name for name in os.listdir("/proc") if name.isdigit() ]
+        for pid in pids:
+            self.read_stat(pid)
+        for pid in sorted(self.ppid):
+            self.children.setdefault(self.ppid[pid], []).append(pid)
+    def read_stat(self, pid):
+        proc_stat = "/proc/%s/stat" % pid
+        try:
+            with open(proc_stat) as f:
+                stat = f.read()
+        except IOError as e:
+            if e.errno not in [ errno.ENOENT, errno.ESRCH ]: # process ended meanwhile
+                logg.error("%s (%s): %s", proc_stat, e.errno, e)
+            return
+        # "pid (comm) state ppid ..." where comm may contain spaces and parentheses
+        fields = stat[stat.rfind(")")+1:].split()
+        try:
+            self.state[int(pid)] = fields[0]
+            self.ppid[int(pid)] = int(fields[1])
+        except (IndexError, ValueError):
+            logg.warning("%s: cannot parse %s", proc_stat, stat[:80])
+    def exists(self, pid):
+        return to_int(pid) in self.state
+    def is_zombie(self, pid):
+        return self.state.get(to_int(pid), "") in [ "Z" ]
+    def is_alive(self, pid):
+        return self.state.get(to_int(pid), "X") not in [ "Z", "X", "x" ]
+    def descendants_of(self, pid):
+        """ pid and all its descendants, parents before their children """
+        pid = to_int(pid)
+        found = [ pid ]
+        seen = set(found)
+        index = 0
+        while index < len(found):
+            for child in self.children.get(found[index], []):
+                if child not in seen:
+                    seen.add(child)
+                    found.append(child)
+            index += 1
+        return found
+
+def _libc():
+    import ctypes
+    import ctypes.util
+    return ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno = True)
+
+def set_child_subreaper():
+    """ let orphaned processes of the services be reparented to this process (Linux 3.4),
+        as they are for PID 1, so the init-loop can reap and supervise them """
+    if os.getpid() == 1:
+        return True
     try:
-        for line in open(check):
-            if line.startswith("State:"):
-                return "Z" in line
-    except IOError as e:
-        if e.errno != errno.ENOENT:
-            logg.error("%s (%s): %s", check, e.errno, e)
+        return _libc().prctl(PR_SET_CHILD_SUBREAPER, 1, 0, 0, 0) == 0
+    except Exception as e:
+        logg.debug("no child subreaper: %s", e)
         return False
-    return False
+
+def sleep_backoff(attempt, deadline = None):
+    """ sleep 10ms, 20ms, 40ms, .. up to MinimumYield - but not beyond the deadline """
+    delay = min(MinimumYield, BackoffSleep * (2 ** min(attempt, 16)))
+    if deadline is not None:
+        delay = max(0, min(delay, deadline - time.time()))
+    time.sleep(delay)
+
+def pidfd_wait(pid, timeout): # -> True | False | None
+    """ wait for the process to end with a pidfd (Linux 5.3, python 3.9): True when it has
+        ended, False on timeout, and None when a pidfd can not be used here """
+    if not hasattr(os, "pidfd_open") or not hasattr(select, "poll"):
+        return None
+    try:
+        pidfd = os.pidfd_open(int(pid))
+    except OSError as e:
+        if e.errno == errno.ESRCH:
+            return True
+        return None
+    try:
+        poller = select.poll()
+        poller.register(pidfd, select.POLLIN)
+        return len(poller.poll(max(0, timeout) * 1000)) > 0
+    finally:
+        os.close(pidfd)
+
+class LockTimeout(Exception):
+    pass
+
+def _raise_lock_timeout(signum, frame):
+    raise LockTimeout()
+
+def flock_wait(fd, timeout):
+    """ a blocking flock(LOCK_EX) that raises BlockingIOError after the timeout. The wait is
+        ended by a SIGALRM - outside of the main thread it polls LOCK_NB with a backoff """
+    if timeout <= 0:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return
+    try:
+        old_handler = signal.signal(signal.SIGALRM, _raise_lock_timeout)
+    except ValueError: # signal only works in main thread
+        deadline = time.time() + timeout
+        for attempt in xrange(1000000):
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return
+            except BlockingIOError:
+                if time.time() >= deadline:
+                    raise
+                sleep_backoff(attempt, deadline)
+    try:
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+    except LockTimeout:
+        raise BlockingIOError(errno.EAGAIN, "lock wait timeout")
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, old_handler if old_handler is not None else signal.SIG_DFL)
+
+class FolderWatch:
+    """ inotify on a folder, so that a wait for a file (a PIDFile) returns as soon as
+        something is written there. Without inotify the wait() is just a sleep. """
+    def __init__(self, folder):
+        self.fd = None
+        try:
+            libc = _libc()
+            fd = libc.inotify_init1(os.O_NONBLOCK | getattr(os, "O_CLOEXEC", 0o2000000))
+            if fd < 0:
+                return
+            if libc.inotify_add_watch(fd, folder.encode("utf-8"), IN_WRITTEN) < 0:
+                os.close(fd)
+                return
+            self.fd = fd
+        except Exception as e:
+            logg.debug("no inotify on %s: %s", folder, e)
+    def wait(self, timeout):
+        if self.fd is None:
+            time.sleep(max(0, timeout))
+            return
+        try:
+            select.select([ self.fd ], [], [], max(0, timeout))
+        except (select.error, OSError) as e: # python2 does not retry on EINTR
+            if e.args[0] != errno.EINTR:
+                raise
+        try:
+            while os.read(self.fd, 4096):
+                pass
+        except OSError as e:
+            if e.errno not in [ errno.EAGAIN, errno.EWOULDBLOCK ]:
+                raise
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+        self.fd = None
 
 def checkstatus(cmd):
     if cmd.startswith("-"):
@@ -528,10 +730,14 @@ class waitlock:
             lockfile = self.lockfile()
             lockname = os.path.basename(lockfile)
             self.opened = os.open(lockfile, os.O_RDWR | os.O_CREAT, 0o600)
+            deadline = time.time() + int(MaxLockWait or DefaultMaximumTimeout)
             for attempt in xrange(int(MaxLockWait or DefaultMaximumTimeout)):
                 try:
                     logg.debug("[%s] %s. trying %s _______ ", os.getpid(), attempt, lockname)
-                    fcntl.flock(self.opened, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    if not attempt:
+                        fcntl.flock(self.opened, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    else:
+                        flock_wait(self.opened, deadline - time.time()) # until MaxLockWait
                     st = os.fstat(self.opened)
                     if not st.st_nlink:
                         logg.debug("[%s] %s. %s got deleted, trying again", os.getpid(), attempt, lockname)
@@ -546,7 +752,8 @@ class waitlock:
                     whom = os.read(self.opened, 4096)
                     os.lseek(self.opened, 0, os.SEEK_SET)
                     logg.info("[%s] %s. systemctl locked by %s", os.getpid(), attempt, whom.rstrip())
-                    time.sleep(1) # until MaxLockWait
+                    if time.time() >= deadline:
+                        break
                     continue
             logg.error("[%s] not able to get the lock to %s", os.getpid(), lockname)
         except Exception as e:
@@ -616,6 +823,34 @@ def parse_unit(name): # -> object(prefix, instance, suffix, ...., name, componen
     UnitName = collections.namedtuple("UnitName", ["name", "prefix", "instance", "suffix", "component" ])
     return UnitName(name, prefix, instance, suffix, component)
 
+def cgroup_value(name, value): # -> text?
+    """ the content for the cgroup file of a resource-control setting, None if not understood """
+    value = value.strip()
+    if name in [ "MemoryHigh", "MemoryMax", "TasksMax" ]:
+        if value in [ "", "infinity" ]:
+            return "max"
+        units = { "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4 }
+        if name != "TasksMax" and value[-1:].upper() in units:
+            if value[:-1].isdigit():
+                return str(int(value[:-1]) * units[value[-1:].upper()])
+            return None
+        return value.isdigit() and value or None
+    if name in [ "CPUWeight", "IOWeight" ]:
+        if not value:
+            return "100"
+        if value.isdigit() and 1 <= int(value) <= 10000:
+            return value
+        return None
+    if name == "CPUQuota":
+        if not value:
+            return "max 100000"
+        if value.endswith("%") and value[:-1].isdigit():
+            return "%s 100000" % (int(value[:-1]) * 1000)
+        return None
+    if name == "AllowedCPUs":
+        return value.replace(" ", ",")
+    return None
+
 def time_to_seconds(text, maximum = None):
     if maximum is None:
         maximum = DefaultMaximumTimeout
@@ -682,78 +917,94 @@ def getAfter(conf):
                 result.append(name)
     return result
 
-def compareAfter(confA, confB):
-    idA = confA.name()
-    idB = confB.name()
-    for after in getAfter(confA):
-        if after == idB:
-            logg.debug("%s After %s", idA, idB)
-            return -1
-    for after in getAfter(confB):
-        if after == idA:
-            logg.debug("%s After %s", idB, idA)
-            return 1
-    for before in getBefore(confA):
-        if before == idB:
-            logg.debug("%s Before %s", idA, idB)
-            return 1
-    for before in getBefore(confB):
-        if before == idA:
-            logg.debug("%s Before %s", idB, idA)
-            return -1
-    return 0
+def getDepends(conf, key):
+    """ the unit names of a [Unit] dependency setting like Requires or Wants """
+    result = []
+    for deps in conf.data.getlist("Unit", key, []):
+        for dep in deps.split(" "):
+            name = dep.strip()
+            if name and name not in result:
+                result.append(name)
+    return result
 
-def sortedAfter(conflist, cmp = compareAfter):
-    # the normal sorted() does only look at two items
-    # so if "A after C" and a list [A, B, C] then
-    # it will see "A = B" and "B = C" assuming that
-    # "A = C" and the list is already sorted.
-    #
-    # To make a totalsorted we have to create a marker
-    # that informs sorted() that also B has a relation.
-    # It only works when 'after' has a direction, so
-    # anything without 'before' is a 'after'. In that
-    # case we find that "B after C".
-    class SortTuple:
-        def __init__(self, rank, conf):
-            self.rank = rank
-            self.conf = conf
-    sortlist = [ SortTuple(0, conf) for conf in conflist]
-    for check in xrange(len(sortlist)): # maxrank = len(sortlist)
-        changed = 0
-        for A in xrange(len(sortlist)):
-            for B in xrange(len(sortlist)):
-                if A != B:
-                    itemA = sortlist[A]
-                    itemB = sortlist[B]
-                    before = compareAfter(itemA.conf, itemB.conf)
-                    if before > 0 and itemA.rank <= itemB.rank:
-                        if DEBUG_AFTER: # pragma: no cover
-                            logg.info("  %-30s before %s", itemA.conf.name(), itemB.conf.name())
-                        itemA.rank = itemB.rank + 1
-                        changed += 1
-                    if before < 0 and itemB.rank <= itemA.rank:
-                        if DEBUG_AFTER: # pragma: no cover
-                            logg.info("  %-30s before %s", itemB.conf.name(), itemA.conf.name())
-                        itemB.rank = itemA.rank + 1
-                        changed += 1
-        if not changed:
-            if DEBUG_AFTER: # pragma: no cover
-                logg.info("done in check %s of %s", check, len(sortlist))
-            break
-            # because Requires is almost always the same as the After clauses
-            # we are mostly done in round 1 as the list is in required order
-    for conf in conflist:
-        if DEBUG_AFTER: # pragma: no cover
-            logg.debug(".. %s", conf.name())
-    for item in sortlist:
-        if DEBUG_AFTER: # pragma: no cover
-            logg.info("(%s) %s", item.rank, item.conf.name())
-    sortedlist = sorted(sortlist, key = lambda item: -item.rank)
-    for item in sortedlist:
+class DependencyGraph:
+    """ the start order of a list of units, built once: a unit starts after the units in its
+        After, Requires, Requisite, BindsTo and Wants and before the units in its Before (only
+        the units of the list count). levels() is a topological sort (Kahn) into levels whose
+        units do not depend on each other, so each level can be started concurrently. """
+    def __init__(self, conflist):
+        self.confs = list(conflist)
+        self.index = dict([ (conf.name(), pos) for pos, conf in enumerate(self.confs) ])
+        self.later = [ set() for conf in self.confs ] # pos => positions that must start after it
+        for pos, conf in enumerate(self.confs):
+            for key in [ "After", "Requires", "Requisite", "BindsTo", "Wants" ]:
+                for name in getDepends(conf, key):
+                    dep = self.index.get(name)
+                    if dep is not None and dep != pos:
+                        self.later[dep].add(pos)
+            for name in getBefore(conf):
+                dep = self.index.get(name)
+                if dep is not None and dep != pos:
+                    self.later[pos].add(dep)
+    def levels(self):
+        """ lists of confs in start order, each in the order of the given list. An ordering
+            cycle is reported and broken by dropping one of its edges (as systemd drops a job),
+            then the sort goes on, so the units that come after the cycle keep their order """
+        later = [ set(deps) for deps in self.later ] # without the edges that break a cycle
+        indegree = [ 0 ] * len(self.confs)
+        for pos in xrange(len(self.confs)):
+            for dep in later[pos]:
+                indegree[dep] += 1
+        levels = []
+        current = [ pos for pos in xrange(len(self.confs)) if not indegree[pos] ]
+        while True:
+            while current:
+                levels.append(current)
+                ready = []
+                for pos in current:
+                    for dep in later[pos]:
+                        indegree[dep] -= 1
+                        if not indegree[dep]:
+                            ready.append(dep)
+                current = sorted(ready)
+            left = [ pos for pos in xrange(len(self.confs)) if indegree[pos] ]
+            if not left:
+                break
+            cycle = self.cycle(left, later)
+            first, then = cycle[-2], cycle[-1]
+            logg.error("ordering cycle: %s - starting %s without waiting for %s",
+                " -> ".join([ self.confs[pos].name() for pos in cycle ]),
+                self.confs[then].name(), self.confs[first].name())
+            later[first].discard(then)
+            indegree[then] -= 1
+            if not indegree[then]:
+                current = [ then ]
         if DEBUG_AFTER: # pragma: no cover
-            logg.info("[%s] %s", item.rank, item.conf.name())
-    return [ item.conf for item in sortedlist ]
+            for rank, level in enumerate(levels):
+                logg.info("[%s] %s", rank, " ".join([ self.confs[pos].name() for pos in level ]))
+        return [ [ self.confs[pos] for pos in level ] for level in levels ]
+    def cycle(self, left, later):
+        """ one ordering cycle among the units left by the sort; each of them is ordered after
+            another one of them, so walking back over those ends in a cycle. The first unit
+            is repeated at the end. """
+        remaining = set(left)
+        earlier = dict([ (pos, []) for pos in left ])
+        for pos in left:
+            for dep in later[pos]:
+                if dep in remaining:
+                    earlier[dep].append(pos)
+        walk = [ left[0] ]
+        while walk.count(walk[-1]) < 2:
+            walk.append(earlier[walk[-1]][0])
+        walk = walk[walk.index(walk[-1]):]
+        return list(reversed(walk))
+
+def sortedAfter(conflist):
+    """ the confs in start order by their DependencyGraph """
+    result = []
+    for level in DependencyGraph(conflist).levels():
+        result += level
+    return result
 
 class Systemctl:
     def __init__(self):
@@ -789,6 +1040,19 @@ class Systemctl:
         self._user_getlogin = os_getlogin()
         self._log_file = {} # init-loop
         self._log_hold = {} # init-loop
+        self._exit_status = {} # init-loop: pid => waitpid status of reaped processes
+        self._exit_handled = {} # init-loop: unit => MainPID whose exit was handled
+        self._restart_due = {} # init-loop: unit => (time, MainPID) of a scheduled restart
+        self._child_wakeup = None # init-loop: (read, write) of the SIGCHLD wakeup pipe
+        self._control = None # init-loop: listening socket for systemctl commands
+        self._control_pids = set() # init-loop: forked children running a control request
+        self._compress_pids = {} # init-loop: forked child => copy of a journal log it compresses
+        self._parallel_jobs = ParallelJobs
+        self._boottime = None # get_boottime, computed once
+        self._log_rotated = {} # journal log => time of its last rotation
+        self._cgroup_base = None # cgroup_base, "" when there is none
+        self._unit_cache = None # unit-cache: content of the unit_cache_file()
+        self._unit_cache_changed = False
     def user_folder(self):
         for folder in self.user_folders():
             if folder: return folder
@@ -834,9 +1098,101 @@ class Systemctl:
         path = self.unit_sysv_file(module)
         if path is not None: return path
         return None
+    def unit_cache_file(self): # -> filename?
+        """ the file that keeps the parsed unit files between calls of systemctl """
+        return _runtime_file(UnitCacheFile)
+    def load_unit_cache(self): # -> dict
+        """ the unit cache is read once - it is plain json, only trusted when it is
+            owned by us, and dropped when it was written by another script file """
+        if self._unit_cache is None:
+            self._unit_cache = {}
+            cachefile = self.unit_cache_file()
+            if cachefile and os.path.exists(cachefile):
+                try:
+                    with open(cachefile, "r") as f:
+                        if os.fstat(f.fileno()).st_uid != os.geteuid():
+                            logg.warning("unit cache %s is not owned by us - ignored", cachefile)
+                            return self._unit_cache
+                        cache = json.load(f, object_pairs_hook = collections.OrderedDict)
+                    if isinstance(cache, dict) and cache.get("script") == _file_stamp(os.path.realpath(__file__)):
+                        self._unit_cache = cache
+                    else:
+                        logg.debug("unit cache %s is from another script", cachefile)
+                except Exception as e:
+                    logg.debug("unit cache %s can not be read: %s", cachefile, e)
+        return self._unit_cache
+    def save_unit_cache(self):
+        """ write the unit cache if something was parsed anew (atomic rename) """
+        if not self._unit_cache_changed:
+            return False
+        cachefile = self.unit_cache_file()
+        if not cachefile:
+            return False
+        self._unit_cache["script"] = _file_stamp(os.path.realpath(__file__))
+        try:
+            folder = os.path.dirname(cachefile)
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            fd, tmpfile = tempfile.mkstemp(prefix = os.path.basename(cachefile) + ".", dir = folder)
+            with os.fdopen(fd, "w") as f:
+                json.dump(self._unit_cache, f)
+            os.rename(tmpfile, cachefile)
+            self._unit_cache_changed = False
+            logg.debug("unit cache %s written", cachefile)
+            return True
+        except Exception as e:
+            logg.debug("unit cache %s can not be written: %s", cachefile, e)
+            return False
+    def drop_unit_cache(self):
+        """ forget all unit files seen so far - including the unit cache file """
+        cachefile = self.unit_cache_file()
+        if cachefile and os.path.exists(cachefile):
+            try:
+                os.remove(cachefile)
+                logg.debug("unit cache %s removed", cachefile)
+            except OSError as e:
+                logg.warning("unit cache %s can not be removed: %s", cachefile, e)
+        self._unit_cache = {}
+        self._unit_cache_changed = False
+        self._file_for_unit_sysd = None
+        self._file_for_unit_sysv = None
+        self._loaded_file_sysd = {}
+        self._loaded_file_sysv = {}
+    def sysd_folder_stamps(self): # -> [ (folder, stamp),... ]
+        """ when none of the unit folders has changed then the list of unit names is the same """
+        stamps = []
+        for folder in self.sysd_folders():
+            if not folder:
+                continue
+            if self._root:
+                folder = os_path(self._root, folder)
+            stamps.append([ folder, _file_stamp(folder) ])
+        return stamps
+    def sysd_unit_stamps(self, path, drop_in_files): # -> [ (path, stamp),... ]
+        """ a parsed unit is valid while neither the unit file nor its
+            drop-in folders and drop-in files have changed. """
+        stamps = [ [ path, _file_stamp(path) ] ]
+        basename_d = os.path.basename(path) + ".d"
+        for folder in self.sysd_folders():
+            if not folder:
+                continue
+            if self._root:
+                folder = os_path(self._root, folder)
+            override_d = os_path(folder, basename_d)
+            stamps.append([ override_d, _file_stamp(override_d) ])
+        for name in sorted(drop_in_files):
+            override = drop_in_files[name]
+            stamps.append([ override, _file_stamp(override) ])
+        return stamps
     def scan_unit_sysd_files(self, module = None): # -> [ unit-names,... ]
         """ reads all unit files, returns the first filename for the unit given """
         if self._file_for_unit_sysd is None:
+            cache = self.load_unit_cache()
+            stamps = self.sysd_folder_stamps()
+            if cache.get("folders") == stamps:
+                self._file_for_unit_sysd = cache["units"]
+                logg.debug("found %s sysd files (cached)", len(self._file_for_unit_sysd))
+                return list(self._file_for_unit_sysd.keys())
             self._file_for_unit_sysd = {}
             for folder in self.sysd_folders():
                 if not folder: 
@@ -853,6 +1209,12 @@ class Systemctl:
                     if service_name not in self._file_for_unit_sysd:
                         self._file_for_unit_sysd[service_name] = path
             logg.debug("found %s sysd files", len(self._file_for_unit_sysd))
+            cache["folders"] = stamps
+            cache["units"] = self._file_for_unit_sysd
+            paths = set(self._file_for_unit_sysd.values())
+            confs = cache.get("confs", {})
+            cache["confs"] = dict((path, confs[path]) for path in confs if path in paths)
+            self._unit_cache_changed = True
         return list(self._file_for_unit_sysd.keys())
     def unit_sysd_file(self, module = None): # -> filename?
         """ file path for the given module (systemd) """
@@ -963,6 +1325,17 @@ class Systemctl:
         if not path: return None
         if path in self._loaded_file_sysd:
             return self._loaded_file_sysd[path]
+        confs = self.load_unit_cache().setdefault("confs", {})
+        cached = confs.get(path)
+        if cached and cached["stamps"] == self.sysd_unit_stamps(path, cached["drop_in_files"]):
+            unit = UnitParser()
+            unit._dict = cached["sections"]
+            unit._files = list(cached["files"])
+            conf = UnitConf(unit, module)
+            conf.masked = cached["masked"]
+            conf.drop_in_files = cached["drop_in_files"]
+            self._loaded_file_sysd[path] = conf
+            return conf
         masked = None
         if os.path.islink(path) and os.readlink(path).startswith("/dev"):
             masked = os.readlink(path)
@@ -973,12 +1346,16 @@ class Systemctl:
             drop_in_files = self.find_drop_in_files(os.path.basename(path))
             # load in alphabetic order, irrespective of location
             for name in sorted(drop_in_files):
-                path = drop_in_files[name]
-                unit.read_sysd(path)
+                override = drop_in_files[name]
+                unit.read_sysd(override)
         conf = UnitConf(unit, module)
         conf.masked = masked
         conf.drop_in_files = drop_in_files
         self._loaded_file_sysd[path] = conf
+        confs[path] = { "stamps": self.sysd_unit_stamps(path, drop_in_files),
+                        "sections": unit._dict, "files": list(unit._files),
+                        "masked": masked, "drop_in_files": drop_in_files }
+        self._unit_cache_changed = True
         return conf
     def load_sysv_unit_conf(self, module): # -> conf?
         """ read the unit file with a UnitParser (sysv) """
@@ -1169,9 +1546,10 @@ class Systemctl:
         pid = default
         if not pid_file:
             return default
-        if not os.path.isfile(pid_file):
+        st = self.stat_file(pid_file)
+        if not st:
             return default
-        if self.truncate_old(pid_file):
+        if self.truncate_old(pid_file, st.st_mtime):
             return default
         try:
             # some pid-files from applications contain multiple lines
@@ -1186,20 +1564,28 @@ class Systemctl:
         """ wait some seconds for the pid file to appear and return the pid """
         timeout = int(timeout or (DefaultTimeoutStartSec/2))
         timeout = max(timeout, (MinimumTimeoutStartSec))
+        deadline = time.time() + timeout # until TimeoutStartSec/2
         dirpath = os.path.dirname(os.path.abspath(pid_file))
-        for x in xrange(timeout):
-            if not os.path.isdir(dirpath):
-                time.sleep(1) # until TimeoutStartSec/2
-                continue
-            pid = self.read_pid_file(pid_file)
-            if not pid:
-                time.sleep(1) # until TimeoutStartSec/2
-                continue
-            if not pid_exists(pid):
-                time.sleep(1) # until TimeoutStartSec/2
-                continue
-            return pid
-        return None
+        watch = None
+        try:
+            for attempt in xrange(1000000):
+                if os.path.isdir(dirpath):
+                    if watch is None:
+                        watch = FolderWatch(dirpath) # before reading, so no write is missed
+                    pid = self.read_pid_file(pid_file)
+                    if pid and pid_exists(pid):
+                        return pid
+                if time.time() >= deadline:
+                    return None
+                # inotify wakes up on the write, the backoff is for a pid that is not yet alive
+                delay = min(MinimumYield, BackoffSleep * (2 ** min(attempt, 16)), deadline - time.time())
+                if watch is None:
+                    time.sleep(max(0, delay))
+                else:
+                    watch.wait(delay)
+        finally:
+            if watch is not None:
+                watch.close()
     def test_pid_file(self, unit): # -> text
         """ support for the testsuite.py """
         conf = self.get_unit_conf(unit)
@@ -1292,10 +1678,11 @@ class Systemctl:
         if not status_file:
             logg.debug("no status file. returning %s", status)
             return status
-        if not os.path.isfile(status_file):
+        st = self.stat_file(status_file)
+        if not st:
             logg.debug("no status file: %s\n returning %s", status_file, status)
             return status
-        if self.truncate_old(status_file):
+        if self.truncate_old(status_file, st.st_mtime):
             logg.debug("old status file: %s\n returning %s", status_file, status)
             return status
         try:
@@ -1328,8 +1715,16 @@ class Systemctl:
             conf.status[name] = value
     #
     def get_boottime(self):
+        """ the boot time (of the container) is computed once per call of systemctl """
+        if self._boottime is None:
+            self._boottime = self.get_boottime_uncached()
+        return self._boottime
+    def get_boottime_uncached(self):
         if "oldest" in COVERAGE:
             self.get_boottime_oldest()
+        booted = self.get_boottime_procstat()
+        if booted:
+            return booted
         for pid in xrange(10):
             proc = "/proc/%s/status" % pid
             try:
@@ -1338,6 +1733,25 @@ class Systemctl:
             except Exception as e: # pragma: nocover
                 logg.warning("could not access %s: %s", proc, e)
         return self.get_boottime_oldest()
+    def get_boottime_procstat(self):
+        """ the start of PID 1 from the kernel boot time (btime in /proc/stat) and the
+            starttime of /proc/1/stat in clock ticks. In a container that is when the
+            container started, like the mtime of /proc/1/status in the fallback. """
+        try:
+            btime = None
+            for line in open("/proc/stat"):
+                if line.startswith("btime "):
+                    btime = int(line.split()[1])
+                    break
+            if btime is None:
+                return None
+            with open("/proc/1/stat") as f:
+                proc_stat = f.read()
+            starttime = int(proc_stat[proc_stat.rfind(")")+1:].split()[19]) # field 22
+            return btime + starttime / float(os.sysconf("SC_CLK_TCK"))
+        except (IOError, OSError, ValueError, IndexError) as e:
+            logg.debug("no boot time from /proc/stat: %s", e)
+            return None
     def get_boottime_oldest(self):
         # otherwise get the oldest entry in /proc
         booted = time.time()
@@ -1353,8 +1767,20 @@ class Systemctl:
         return booted
     def get_filetime(self, filename):
         return os.path.getmtime(filename)
-    def truncate_old(self, filename):
-        filetime = self.get_filetime(filename)
+    def stat_file(self, filename): # -> stat_result?
+        """ the os.stat of a regular file, or None """
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            return None
+        return st
+    def truncate_old(self, filename, filetime = None):
+        """ a file from before the (container) boot is emptied - the filetime
+            may be given from an os.stat that the caller has done already """
+        if filetime is None:
+            filetime = self.get_filetime(filename)
         boottime = self.get_boottime()
         if filetime >= boottime :
             return False # OK
@@ -1369,15 +1795,12 @@ class Systemctl:
     def getsize(self, filename):
         if not filename:
             return 0
-        if not os.path.isfile(filename):
-            return 0
-        if self.truncate_old(filename):
+        st = self.stat_file(filename)
+        if not st:
             return 0
-        try:
-            return os.path.getsize(filename)
-        except Exception as e:
-            logg.warning("while reading file size: %s\n of %s", e, filename)
+        if self.truncate_old(filename, st.st_mtime):
             return 0
+        return st.st_size
     #
     def read_env_file(self, env_file): # -> generate[ (name,value) ]
         """ EnvironmentFile=<name> is being scanned """
@@ -1575,7 +1998,109 @@ class Systemctl:
         log_folder = os.path.dirname(log_file)
         if not os.path.isdir(log_folder):
             os.makedirs(log_folder)
+        st = self.stat_file(log_file)
+        if st and self.journal_log_due(log_file, st):
+            self.rotate_journal_log(log_file)
         return open(os.path.join(log_file), "a")
+    def journal_log_due(self, log_file, st): # -> reason?
+        """ whether the journal log has grown beyond JournalMaxMB or JournalMaxAgeSec """
+        if not st.st_size:
+            return None
+        if JournalMaxMB and st.st_size > JournalMaxMB * 1024 * 1024:
+            return "size"
+        if JournalMaxAgeSec:
+            if log_file not in self._log_rotated:
+                rotated = self.stat_file(log_file + ".1") or self.stat_file(log_file + ".1.gz")
+                self._log_rotated[log_file] = rotated and rotated.st_mtime or time.time()
+            if time.time() - self._log_rotated[log_file] > JournalMaxAgeSec:
+                return "age"
+        return None
+    def rotate_journal_log(self, log_file, opened = None): # -> text?
+        """ copy the journal log to <log>.1 (.gz) and truncate it. The services have it
+            open with O_APPEND, so renaming it would leave them writing to the old file.
+            The older copies are shifted up to <log>.JournalKeep. The init-loop passes the
+            log as it reads it: right before truncating, the text that was not forwarded yet
+            is read up to the end of the log and returned, and the copy ends at that same
+            point. Its copy is compressed by a forked child then (compress_journal_log).
+            Returns None when the log could not be rotated. """
+        logg.info("rotate journal log %s", log_file)
+        background = opened is not None and JournalCompress
+        rest = ""
+        try:
+            for ext in [ "", ".gz" ]:
+                oldest = "%s.%s%s" % (log_file, JournalKeep, ext)
+                if os.path.exists(oldest):
+                    os.remove(oldest)
+                for num in xrange(JournalKeep - 1, 0, -1):
+                    older = "%s.%s%s" % (log_file, num, ext)
+                    if os.path.exists(older):
+                        os.rename(older, "%s.%s%s" % (log_file, num + 1, ext))
+            copy = None
+            if JournalKeep > 0:
+                if JournalCompress and not background:
+                    import gzip
+                    copy = gzip.open(log_file + ".1.gz", "wb")
+                else:
+                    copy = open(log_file + ".1", "wb")
+            with open(log_file, "r+b") as f:
+                try:
+                    tail = b""
+                    if copy is not None:
+                        while True:
+                            data = f.read(1024 * 1024)
+                            if not data: break
+                            copy.write(data)
+                    if opened is not None:
+                        rest = opened.read() # catch up with the copy first, so that the
+                        if copy is not None:
+                            copy.write(f.read(max(0, os.lseek(opened.fileno(), 0, os.SEEK_CUR) - f.tell())))
+                        rest += opened.read() # last read is short: lines written after it are lost
+                        if copy is not None:
+                            tail = f.read(max(0, os.lseek(opened.fileno(), 0, os.SEEK_CUR) - f.tell()))
+                    f.truncate(0)
+                    if copy is not None:
+                        copy.write(tail)
+                finally:
+                    if copy is not None:
+                        copy.close()
+            self._log_rotated[log_file] = time.time()
+            if background:
+                self.compress_journal_log(log_file + ".1")
+            return rest
+        except Exception as e:
+            logg.warning("rotate journal log %s: %s", log_file, e)
+            return None
+    def compress_journal_log(self, copy_file):
+        """ gzip the copy of a rotated journal log in a forked child, so that the init-loop
+            goes on reaping. The reaper collects the child; until then the log is not rotated
+            again, as that would shift the copy away under it. """
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid:
+            self._compress_pids[pid] = copy_file
+            return
+        exitcode = 1
+        try:
+            signal.set_wakeup_fd(-1)
+            for signum in [ signal.SIGCHLD, signal.SIGTERM, signal.SIGINT, signal.SIGQUIT ]:
+                signal.signal(signum, signal.SIG_DFL)
+            if self._control:
+                self._control.close()
+            import gzip
+            with open(copy_file, "rb") as f:
+                with gzip.open(copy_file + ".gz.tmp", "wb") as copy:
+                    while True:
+                        data = f.read(1024 * 1024)
+                        if not data: break
+                        copy.write(data)
+            os.rename(copy_file + ".gz.tmp", copy_file + ".gz")
+            os.remove(copy_file)
+            exitcode = 0
+        except Exception as e:
+            logg.warning("compress journal log %s: %s", copy_file, e)
+        finally:
+            os._exit(exitcode)
     def chdir_workingdir(self, conf, check = True):
         """ if specified then change the working directory """
         # the original systemd will start in '/' even if User= is given
@@ -1646,16 +2171,24 @@ class Systemctl:
         logg.info("wait $NOTIFY_SOCKET, timeout %s", timeout)
         results = {}
         seenREADY = None
-        for attempt in xrange(timeout+1):
+        deadline = time.time() + timeout + 1 # until TimeoutStartSec
+        while True:
             if pid and not self.is_active_pid(pid):
                 logg.info("dead PID %s", pid)
                 return results
-            if not attempt: # first one
-                time.sleep(1) # until TimeoutStartSec
+            left = deadline - time.time()
+            if left <= 0:
+                break
+            try: # wakes up on a message - and every MinimumYield to check the PID
+                ready, _, _ = select.select([ notify.socket ], [], [], min(left, MinimumYield))
+            except (select.error, OSError) as e: # python2 does not retry on EINTR
+                if e.args[0] != errno.EINTR:
+                    raise
                 continue
-            result = self.read_notify_socket(notify, 1) # sleep max 1 second
+            if not ready:
+                continue
+            result = self.read_notify_socket(notify, MinimumYield)
             if not result: # timeout
-                time.sleep(1) # until TimeoutStartSec
                 continue
             for name, value in self.read_env_part(result):
                 results[name] = value
@@ -1696,9 +2229,12 @@ class Systemctl:
             stop the named units afterwards """
         done = True
         started_units = []
-        for unit in self.sortedAfter(units):
-            started_units.append(unit)
-            if not self.start_unit(unit):
+        if init:
+            set_child_subreaper() # before the start, so daemons of forking services come back to us
+        self.cgroup_base() # set up here, not again in each forked worker and child
+        for level in self.sortedLevels(units):
+            started_units += level
+            if not self.run_units_parallel(self.start_unit, level):
                 done = False
         if init:
             logg.info("init-loop start")
@@ -1721,6 +2257,104 @@ class Systemctl:
         timeout = conf.data.get("Service", "TimeoutSec", DefaultTimeoutStartSec)
         timeout = conf.data.get("Service", "TimeoutStartSec", timeout)
         return time_to_seconds(timeout, DefaultMaximumTimeout)
+    def get_Restart(self, conf):
+        return conf.data.get("Service", "Restart", "no")
+    def get_RestartSec(self, conf):
+        delay = conf.data.get("Service", "RestartSec", DefaultRestartSec)
+        return time_to_seconds(delay, DefaultMaximumRestartSec)
+    def get_RestartSteps(self, conf):
+        try: return int(conf.data.get("Service", "RestartSteps", "0"))
+        except ValueError: return 0
+    def get_RestartMaxDelaySec(self, conf):
+        maxdelay = conf.data.get("Service", "RestartMaxDelaySec", "")
+        if not maxdelay:
+            return self.get_RestartSec(conf)
+        return max(time_to_seconds(maxdelay, DefaultMaximumRestartSec), self.get_RestartSec(conf))
+    def get_restart_delay_from(self, conf, restarts = 0):
+        """ the delay before the next automatic restart, after 'restarts' earlier ones.
+            With RestartSteps and RestartMaxDelaySec the delay grows exponentially from
+            RestartSec to RestartMaxDelaySec in RestartSteps steps (as systemd 254). """
+        delay = self.get_RestartSec(conf)
+        steps = self.get_RestartSteps(conf)
+        maxdelay = self.get_RestartMaxDelaySec(conf)
+        if steps <= 0 or maxdelay <= delay:
+            return delay
+        if restarts >= steps:
+            return maxdelay
+        return delay * pow(float(maxdelay) / delay, float(restarts) / steps)
+    def get_StartLimitIntervalSec(self, conf):
+        interval = conf.data.get("Service", "StartLimitInterval", DefaultStartLimitIntervalSec) # before systemd 230
+        interval = conf.data.get("Unit", "StartLimitIntervalSec", interval)
+        if str(interval).strip() in [ "0", "infinity" ]:
+            return 0 # no rate limiting
+        return time_to_seconds(interval, DefaultMaximumRestartSec)
+    def get_StartLimitBurst(self, conf):
+        burst = conf.data.get("Service", "StartLimitBurst", DefaultStartLimitBurst) # before systemd 230
+        burst = conf.data.get("Unit", "StartLimitBurst", burst)
+        try: return int(burst)
+        except ValueError: return DefaultStartLimitBurst
+    def get_WatchdogSec(self, conf):
+        watchdog = conf.data.get("Service", "WatchdogSec", "0")
+        if str(watchdog).strip() in [ "", "0", "infinity" ]:
+            return 0
+        return time_to_seconds(watchdog, DefaultMaximumRestartSec)
+    def get_SuccessExitStatus(self, conf):
+        """ the exit codes and signals that count as a clean exit of the main process; next to
+            the listed ones that is exit code 0 and SIGHUP, SIGINT, SIGTERM and SIGPIPE (as systemd) """
+        codes = [ 0 ]
+        signals = [ signal.SIGHUP, signal.SIGINT, signal.SIGTERM, signal.SIGPIPE ]
+        for setting in conf.data.getlist("Service", "SuccessExitStatus", []):
+            for item in setting.split():
+                if item.isdigit():
+                    codes.append(int(item))
+                    continue
+                name = item.upper()
+                if not name.startswith("SIG"):
+                    name = "SIG" + name
+                signum = getattr(signal, name, None)
+                if signum is None:
+                    logg.warning("%s: ignoring unknown SuccessExitStatus=%s", conf.name(), item)
+                    continue
+                signals.append(signum)
+        return codes, signals
+    def exit_clean_from(self, conf, exitcode = None, signum = 0):
+        """ whether the main process ended cleanly by SuccessExitStatus """
+        codes, signals = self.get_SuccessExitStatus(conf)
+        if signum:
+            return signum in signals
+        return exitcode in codes
+    def restart_wanted_from(self, conf, exitcode = None, signaled = False, watchdog = False):
+        """ whether the Restart= setting asks for a restart after the main process ended """
+        restart = self.get_Restart(conf)
+        clean = not signaled and not watchdog and exitcode in [ None, 0 ]
+        if restart == "always": return True
+        if restart == "on-success": return clean
+        if restart == "on-failure": return not clean
+        if restart == "on-abnormal": return signaled or watchdog
+        if restart == "on-abort": return signaled
+        if restart == "on-watchdog": return watchdog
+        return False
+    def start_limit_hit_from(self, conf, record = True):
+        """ True if StartLimitBurst starts happened within StartLimitIntervalSec; the start
+            times are kept in the status file (NRestarts counts the automatic restarts). """
+        interval = self.get_StartLimitIntervalSec(conf)
+        burst = self.get_StartLimitBurst(conf)
+        if not interval or burst <= 0:
+            return False
+        now = time.time()
+        starts = []
+        for item in (self.get_status_from(conf, "StartLimitTimes", "") or "").split(","):
+            try: stamp = float(item)
+            except ValueError: continue
+            if stamp > now - interval:
+                starts.append(stamp)
+        if len(starts) >= burst:
+            logg.error("%s: start request repeated too quickly (%s starts within %ss)", conf.name(), len(starts), interval)
+            return True
+        if record:
+            starts.append(now)
+            self.write_status_from(conf, StartLimitTimes = ",".join(["%.3f" % stamp for stamp in starts]))
+        return False
     def start_unit_from(self, conf):
         if not conf: return False
         if self.syntax_check(conf) > 100: return False
@@ -1981,6 +2615,7 @@ class Systemctl:
         os.dup2(inp.fileno(), sys.stdin.fileno())
         os.dup2(out.fileno(), sys.stdout.fileno())
         os.dup2(out.fileno(), sys.stderr.fileno())
+        self.enter_cgroup_from(conf) # before setuid, as root
         runuser = self.expand_special(conf.data.get("Service", "User", ""), conf)
         rungroup = self.expand_special(conf.data.get("Service", "Group", ""), conf)
         envs = shutil_setuid(runuser, rungroup)
@@ -2021,8 +2656,8 @@ class Systemctl:
     def stop_units(self, units):
         """ fails if any unit fails to stop """
         done = True
-        for unit in self.sortedBefore(units):
-            if not self.stop_unit(unit):
+        for level in reversed(self.sortedLevels(units)):
+            if not self.run_units_parallel(self.stop_unit, level):
                 done = False
         return done
     def stop_unit(self, unit):
@@ -2192,12 +2827,17 @@ class Systemctl:
         if not pid:
             return True
         logg.info("wait for PID %s to vanish (%ss)", pid, timeout)
-        for x in xrange(int(timeout)):
+        started = time.time()
+        deadline = started + int(timeout) # until TimeoutStopSec
+        for attempt in xrange(1000000):
             if not self.is_active_pid(pid):
-                logg.info("wait for PID %s is done (%s.)", pid, x)
+                logg.info("wait for PID %s is done (%.3fs)", pid, time.time() - started)
                 return True
-            time.sleep(1) # until TimeoutStopSec
-        logg.info("wait for PID %s failed (%s.)", pid, x)
+            if time.time() >= deadline:
+                break
+            if not pidfd_wait(pid, deadline - time.time()): # a zombie is readable at once
+                sleep_backoff(attempt, deadline)
+        logg.info("wait for PID %s failed (%.3fs)", pid, time.time() - started)
         return False
     def reload_modules(self, *modules):
         """ [UNIT]... -- reload these units """
@@ -2498,19 +3138,37 @@ class Systemctl:
         logg.info("STATUS %s %s", status_file, size)
         mainpid = to_int(self.read_mainpid_from(conf, ""))
         self.clean_status_from(conf) # clear RemainAfterExit and TimeoutStartSec
-        if not mainpid:
+        members = self.read_cgroup_procs_from(conf) # None when the unit has no cgroup
+        if not mainpid and not members:
             if useKillMode in ["control-group"]:
                 logg.warning("no main PID [%s]", conf.filename())
                 logg.warning("and there is no control-group here")
             else:
                 logg.info("no main PID [%s]", conf.filename())
             return False
-        if not pid_exists(mainpid) or pid_zombie(mainpid):
-            logg.debug("ignoring children when mainpid is already dead")
-            # because we list child processes, not processes in control-group
-            return True
-        pidlist = self.pidlist_of(mainpid) # here
-        if pid_exists(mainpid):
+        if members is not None:
+            # the cgroup knows all the processes of the unit, also those that left the tree
+            pidlist = [ pid for pid in [ mainpid ] + members if pid ]
+            pidlist = [ pid for n, pid in enumerate(pidlist) if pid not in pidlist[:n] ]
+            procs = ProcessTable(pidlist)
+            alive = [ pid for pid in pidlist if procs.is_alive(pid) ]
+            if not alive:
+                self.remove_cgroup_from(conf)
+                return True
+            if mainpid not in alive:
+                if useKillMode in [ "process" ]:
+                    logg.info("main PID %s is gone, KillMode=process leaves PIDs %s", mainpid, alive)
+                    return True
+                logg.info("main PID %s is gone, stop control-group PIDs %s", mainpid, alive)
+                mainpid = alive[0]
+        else:
+            procs = ProcessTable() # one snapshot for the checks and the descendants
+            if not procs.is_alive(mainpid):
+                logg.debug("ignoring children when mainpid is already dead")
+                # because we list child processes, not processes in control-group
+                return True
+            pidlist = self.pidlist_of(mainpid, procs) # here
+        if procs.exists(mainpid):
             logg.info("stop kill PID %s", mainpid)
             self._kill_pid(mainpid, kill_signal)
         if useKillMode in ["control-group"]:
@@ -2524,10 +3182,11 @@ class Systemctl:
             for pid in pidlist:
                 self._kill_pid(pid, signal.SIGHUP)
         # wait for the processes to have exited
-        while True:
+        for attempt in xrange(1000000):
+            procs = ProcessTable(pidlist) # only the stat of these
             dead = True
             for pid in pidlist:
-                if pid_exists(pid) and not pid_zombie(pid):
+                if procs.is_alive(pid):
                     dead = False
                     break
             if dead:
@@ -2535,9 +3194,13 @@ class Systemctl:
             if time.time() > started + timeout:
                 logg.info("service PIDs not stopped after %s", timeout)
                 break
-            time.sleep(1) # until TimeoutStopSec
+            # wait on one that is still alive, a pidfd of an ended one would return at once
+            if pidfd_wait(pid, min(MinimumYield, started + timeout - time.time())) is None:
+                sleep_backoff(attempt, started + timeout) # until TimeoutStopSec
         if dead or not doSendSIGKILL:
             logg.info("done kill PID %s %s", mainpid, dead and "OK")
+            if dead:
+                self.remove_cgroup_from(conf)
             return dead
         if useKillMode in [ "control-group", "mixed" ]:
             logg.info("hard kill PIDs %s", pidlist)
@@ -2552,6 +3215,8 @@ class Systemctl:
             time.sleep(MinimumYield)
         dead = not pid_exists(mainpid) or pid_zombie(mainpid)
         logg.info("done hard kill PID %s %s", mainpid, dead and "OK")
+        if dead:
+            self.remove_cgroup_from(conf)
         return dead
     def _kill_pid(self, pid, kill_signal = None):
         try: 
@@ -3426,41 +4091,142 @@ class Systemctl:
             if conf.loaded():
                 deps_conf.append(conf)
         result = []
-        for dep in sortedAfter(deps_conf, cmp=compareAfter):
+        for dep in sortedAfter(deps_conf):
             line = (dep.name(),  "(%s)" % (" ".join(deps[dep.name()])))
             result.append(line)
         return result
+    def sortedLevels(self, unitlist):
+        """ get the start order for the unit list (ignoring masked units) as levels of
+            units that do not depend on each other """
+        conflist = []
+        for unit in unitlist:
+            conf = self.get_unit_conf(unit)
+            if conf.masked:
+                logg.debug("ignoring masked unit %s", unit)
+                continue
+            conflist.append(conf)
+        return [ [ conf.name() for conf in level ] for level in DependencyGraph(conflist).levels() ]
     def sortedAfter(self, unitlist):
         """ get correct start order for the unit list (ignoring masked units) """
-        conflist = [ self.get_unit_conf(unit) for unit in unitlist ]
-        if True:
-            conflist = []
-            for unit in unitlist:
-                conf = self.get_unit_conf(unit)
-                if conf.masked:
-                    logg.debug("ignoring masked unit %s", unit)
-                    continue
-                conflist.append(conf)
-        sortlist = sortedAfter(conflist)
-        return [ item.name() for item in sortlist ]
+        result = []
+        for level in self.sortedLevels(unitlist):
+            result += level
+        return result
     def sortedBefore(self, unitlist):
-        """ get correct start order for the unit list (ignoring masked units) """
-        conflist = [ self.get_unit_conf(unit) for unit in unitlist ]
-        if True:
-            conflist = []
-            for unit in unitlist:
-                conf = self.get_unit_conf(unit)
-                if conf.masked:
-                    logg.debug("ignoring masked unit %s", unit)
+        """ get correct stop order for the unit list (ignoring masked units) """
+        return list(reversed(self.sortedAfter(unitlist)))
+    def run_units_parallel(self, action, units):
+        """ run action(unit) for the units of one level, at most _parallel_jobs at a time, each
+            in a forked worker (no threads, as the workers fork and exec the services themselves).
+            The exit code of a worker tells whether its action succeeded. """
+        if len(units) <= 1 or self._parallel_jobs <= 1:
+            done = True
+            for unit in units:
+                if not action(unit):
+                    done = False
+            return done
+        wakeup = self.start_worker_wakeup()
+        try:
+            return self.run_workers(action, units, wakeup)
+        finally:
+            self.stop_worker_wakeup(wakeup)
+    def run_workers(self, action, units, wakeup):
+        done = True
+        pending = list(units)
+        running = {}
+        while pending or running:
+            while pending and len(running) < self._parallel_jobs:
+                unit = pending.pop(0)
+                forkpid = os.fork()
+                if not forkpid: # pragma: no cover
+                    if wakeup: # the SIGCHLD handling of before, for the children of the worker
+                        signal.set_wakeup_fd(wakeup[2])
+                        signal.signal(signal.SIGCHLD, wakeup[3] if wakeup[3] is not None else signal.SIG_DFL)
+                    try:
+                        ok = action(unit)
+                    except Exception as e:
+                        logg.error("%s: %s", unit, e)
+                        ok = False
+                    for handler in logging.getLogger().handlers + logg.handlers:
+                        handler.flush()
+                    os._exit(ok and 0 or 1)
+                logg.debug("%s in worker PID %s", unit, forkpid)
+                running[forkpid] = unit
+            # check our workers only; a waitpid(-1) would take the exit status of services
+            self.wait_worker_wakeup(wakeup)
+            for forkpid in list(running.keys()):
+                run = subprocess_testpid(forkpid)
+                if run.returncode is None and not run.signal:
                     continue
-                conflist.append(conf)
-        sortlist = sortedAfter(reversed(conflist))
-        return [ item.name() for item in reversed(sortlist) ]
+                unit = running.pop(forkpid)
+                if run.returncode or run.signal:
+                    done = False
+                conf = self.load_unit_conf(unit)
+                if conf:
+                    conf.status = None # written by the worker
+        return done
+    def start_worker_wakeup(self):
+        """ a SIGCHLD wakeup pipe of its own for run_units_parallel, so it sleeps until a worker
+            ends. It replaces the one of the init-loop for the time being. Returns the state for
+            stop_worker_wakeup, or None to poll the workers. """
+        try:
+            rfd, wfd = os.pipe()
+        except OSError as e:
+            logg.debug("no SIGCHLD wakeup for the workers (%s) - polling", e)
+            return None
+        try:
+            for fd in (rfd, wfd):
+                fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+                fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+            old_handler = signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+            signal.siginterrupt(signal.SIGCHLD, False)
+            old_fd = signal.set_wakeup_fd(wfd)
+        except (OSError, ValueError, AttributeError) as e: # ValueError: not in the main thread
+            logg.debug("no SIGCHLD wakeup for the workers (%s) - polling", e)
+            os.close(rfd)
+            os.close(wfd)
+            return None
+        return (rfd, wfd, old_fd, old_handler)
+    def stop_worker_wakeup(self, wakeup):
+        """ restore the SIGCHLD handling of before start_worker_wakeup. The init-loop gets a
+            wakeup of its own, as its services may have ended meanwhile. """
+        if not wakeup:
+            return
+        rfd, wfd, old_fd, old_handler = wakeup
+        signal.set_wakeup_fd(old_fd)
+        signal.signal(signal.SIGCHLD, old_handler if old_handler is not None else signal.SIG_DFL)
+        os.close(rfd)
+        os.close(wfd)
+        if old_fd >= 0:
+            try:
+                os.write(old_fd, b"\0")
+            except OSError:
+                pass # full, the init-loop wakes up anyway
+    def wait_worker_wakeup(self, wakeup):
+        """ sleep until a child ended; SIGCHLD signals may be merged, so the caller checks all its
+            workers after each wakeup. The timeout only guards against a lost signal. """
+        if not wakeup:
+            time.sleep(MinimumYield / 5)
+            return
+        rfd = wakeup[0]
+        try:
+            select.select([ rfd ], [], [], InitLoopSleep)
+        except (select.error, OSError) as e: # python2 does not retry on EINTR
+            if e.args[0] != errno.EINTR:
+                raise
+        try:
+            while os.read(rfd, 512):
+                pass
+        except OSError as e:
+            if e.errno not in [ errno.EAGAIN, errno.EWOULDBLOCK ]:
+                raise
     def system_daemon_reload(self):
         """ reload does will only check the service files here.
             The returncode will tell the number of warnings,
             and it is over 100 if it can not continue even
-            for the relaxed systemctl.py style of execution. """
+            for the relaxed systemctl.py style of execution.
+            The unit cache is dropped so that all unit files are read anew. """
+        self.drop_unit_cache()
         errors = 0
         for unit in self.match_units():
             try:
@@ -3528,6 +4294,13 @@ class Systemctl:
         if len(usedExecReload) > 0 and "/bin/kill " in usedExecReload[0]:
             logg.warning(" %s: the use of /bin/kill is not recommended for ExecReload as it is asychronous."
               + "\n\t\t\tThat means all the dependencies will perform the reload simultanously / out of order.", unit)
+        haveRestart = conf.data.get("Service", "Restart", "no")
+        if haveRestart not in [ "no", "always", "on-success", "on-failure", "on-abnormal", "on-abort", "on-watchdog" ]:
+            logg.error(" %s: Failed to parse Restart= setting, ignoring: %s", unit, haveRestart)
+            errors += 1
+        if conf.data.get("Service", "WatchdogSec", "0") not in [ "", "0" ] and haveType != "notify" \
+          and conf.data.get("Service", "NotifyAccess", "none") not in [ "main", "exec", "all" ]:
+            logg.warning(" %s: WatchdogSec without Type=notify or NotifyAccess= can not receive watchdog pings", unit)
         if conf.data.getlist("Service", "ExecRestart", []): #pragma: no cover
             logg.error(" %s: there no such thing as an ExecRestart (ignored)", unit)
         if conf.data.getlist("Service", "ExecRestartPre", []): #pragma: no cover
@@ -3665,6 +4438,14 @@ class Systemctl:
         yield "UnitFileState", self.enabled_from(conf)
         yield "TimeoutStartUSec", seconds_to_time(self.get_TimeoutStartSec(conf))
         yield "TimeoutStopUSec", seconds_to_time(self.get_TimeoutStopSec(conf))
+        yield "Restart", self.get_Restart(conf)
+        yield "RestartUSec", seconds_to_time(self.get_RestartSec(conf))
+        yield "RestartSteps", self.get_RestartSteps(conf)
+        yield "RestartMaxDelayUSec", seconds_to_time(self.get_RestartMaxDelaySec(conf))
+        yield "NRestarts", self.get_status_from(conf, "NRestarts", "0")
+        yield "StartLimitIntervalUSec", seconds_to_time(self.get_StartLimitIntervalSec(conf))
+        yield "StartLimitBurst", self.get_StartLimitBurst(conf)
+        yield "WatchdogUSec", seconds_to_time(self.get_WatchdogSec(conf))
         env_parts = []
         for env_part in conf.data.getlist("Service", "Environment", []):
             env_parts.append(self.expand_special(env_part, conf))
@@ -3914,20 +4695,48 @@ class Systemctl:
             except Exception as e:
                 logg.error("can not open %s log: %s\n\t%s", unit, log_path, e)
     def read_log_files(self, units):
+        """ forward the new lines of the journal logs to stdout - in one write per round.
+            A log that is due is rotated here (unless its last copy is still being
+            compressed), and reading restarts at the top when the log was truncated
+            (by us or by open_journal_log of a starting service). """
+        output = []
         for unit in units:
             if unit in self._log_file:
-                new_text = self._log_file[unit].read()
+                opened = self._log_file[unit]
+                new_text = opened.read()
+                st = os.fstat(opened.fileno())
+                if st.st_size < os.lseek(opened.fileno(), 0, os.SEEK_CUR):
+                    opened.seek(0)
+                    new_text += opened.read()
+                    st = os.fstat(opened.fileno())
+                if opened.name + ".1" not in self._compress_pids.values() \
+                        and self.journal_log_due(opened.name, st):
+                    rest = self.rotate_journal_log(opened.name, opened)
+                    if rest is not None:
+                        new_text += rest
+                        opened.seek(0)
                 text = self._log_hold[unit] + new_text
                 if not text: continue
                 lines = text.split("\n")
-                if not text.endswith("\n"):
-                    self._log_hold[unit] = lines[-1]
-                    lines = lines[:-1]
-                for line in lines:
-                    content = unit+": "+line+"\n"
-                    os.write(1, content.encode("utf-8"))
-                    try: os.fsync(1)
-                    except: pass
+                self._log_hold[unit] = lines[-1] # "" when the text ends with a newline
+                for line in lines[:-1]:
+                    output.append(unit+": "+line+"\n")
+        if output:
+            self.write_log_output("".join(output))
+    def write_log_output(self, text):
+        data = text.encode("utf-8")
+        while data:
+            try:
+                written = os.write(1, data)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.EAGAIN:
+                    select.select([], [ 1 ], [], MinimumYield)
+                    continue
+                logg.debug("can not forward the logs: %s", e)
+                return
+            data = data[written:]
     def stop_log_files(self, units):
         for unit in units:
             try:
@@ -3943,21 +4752,29 @@ class Systemctl:
             waits for an interrupt. When a SIGTERM /SIGINT /Control-C signal
             is received then the signal name is returned. Any other signal will 
             just raise an Exception like one would normally expect. As a special
-            the 'systemctl halt' emits SIGQUIT which puts it into no_more_procs mode."""
+            the 'systemctl halt' emits SIGQUIT which puts it into no_more_procs mode.
+            Services whose main process ends are restarted by their Restart= setting."""
         signal.signal(signal.SIGQUIT, lambda signum, frame: ignore_signals_and_raise_keyboard_interrupt("SIGQUIT"))
         signal.signal(signal.SIGINT, lambda signum, frame: ignore_signals_and_raise_keyboard_interrupt("SIGINT"))
         signal.signal(signal.SIGTERM, lambda signum, frame: ignore_signals_and_raise_keyboard_interrupt("SIGTERM"))
         self.start_log_files(units)
+        self.start_child_wakeup()
+        self.start_control_socket()
+        self.cgroup_base() # inherited by the restarts and the control requests
         result = None
+        next_restart = None
         while True:
             try:
-                time.sleep(InitLoopSleep)
+                if self.wait_child_wakeup(self.init_loop_timeout(next_restart)):
+                    self.serve_control_socket()
                 self.read_log_files(units)
                 ##### the reaper goes round
                 running = self.system_reap_zombies()
                 # logg.debug("reap zombies - init-loop found %s running procs", running)
+                ##### and the supervisor after it
+                next_restart = self.supervise_units(units)
                 if self.exit_when_no_more_services:
-                    active = False
+                    active = len(self._restart_due) > 0 or len(self._control_pids) > 0
                     for unit in units:
                         conf = self.load_unit_conf(unit)
                         if not conf: continue
@@ -3979,69 +4796,534 @@ class Systemctl:
                 signal.signal(signal.SIGTERM, signal.SIG_DFL)
                 signal.signal(signal.SIGINT, signal.SIG_DFL)
                 logg.info("interrupted - exit init-loop")
-                result = e.message or "STOPPED"
+                result = e.args and e.args[0] or "STOPPED" # python3 has no e.message
+                break
+        self.stop_control_socket()
+        self.stop_child_wakeup()
         self.read_log_files(units)
         self.read_log_files(units)
         self.stop_log_files(units)
         logg.debug("done - init loop")
         return result
+    def start_child_wakeup(self):
+        """ a pipe that gets a byte on each SIGCHLD (signal.set_wakeup_fd), so the init-loop
+            can sleep until a child ends instead of polling """
+        if not set_child_subreaper():
+            logg.info("not PID 1 and no child subreaper: only direct children are reaped")
+        try:
+            rfd, wfd = os.pipe()
+            for fd in (rfd, wfd):
+                fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+                fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+            signal.signal(signal.SIGCHLD, lambda signum, frame: None) # the wakeup fd does the work
+            signal.siginterrupt(signal.SIGCHLD, False) # no EINTR in the waitpid of start/stop
+            signal.set_wakeup_fd(wfd)
+            self._child_wakeup = (rfd, wfd)
+        except (OSError, ValueError, AttributeError) as e:
+            logg.warning("no SIGCHLD wakeup (%s) - polling every %ss", e, InitLoopSleep)
+            self._child_wakeup = None
+    def stop_child_wakeup(self):
+        if self._child_wakeup:
+            signal.set_wakeup_fd(-1)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            for fd in self._child_wakeup:
+                os.close(fd)
+        self._child_wakeup = None
+    def init_loop_timeout(self, next_restart = None):
+        """ seconds the init-loop may sleep: until the next scheduled restart; without the wakeup
+            pipe or while tailing logs every InitLoopSleep; otherwise until a signal arrives """
+        timeout = None
+        if not self._child_wakeup or self._log_file:
+            timeout = InitLoopSleep
+        if next_restart is not None:
+            timeout = min(timeout or next_restart, max(MinimumYield, next_restart))
+        return timeout
+    def wait_child_wakeup(self, timeout = None):
+        """ sleep until a child ended (or another signal arrived) or the timeout passed.
+            Returns True when a client is waiting on the control socket. """
+        if not self._child_wakeup:
+            if not self._control:
+                time.sleep(timeout or InitLoopSleep)
+                return False
+            ready, _, _ = select.select([ self._control ], [], [], timeout or InitLoopSleep)
+            return bool(ready)
+        rfd = self._child_wakeup[0]
+        waiting = [ rfd ]
+        if self._control:
+            waiting.append(self._control)
+        ready = []
+        try:
+            ready, _, _ = select.select(waiting, [], [], timeout)
+        except (select.error, OSError) as e: # python2 does not retry on EINTR
+            if e.args[0] != errno.EINTR:
+                raise
+        try:
+            while os.read(rfd, 512):
+                pass
+        except OSError as e:
+            if e.errno not in [ errno.EAGAIN, errno.EWOULDBLOCK ]:
+                raise
+        return self._control in ready
+    def start_control_socket(self):
+        """ the control socket lets 'systemctl COMMAND' run in a fork of the init process
+            with the units already loaded (see control_request for the client side) """
+        socketfile = _runtime_file(ControlSocket)
+        if not socketfile:
+            return
+        if not hasattr(socket.socket, "recvmsg"):
+            logg.debug("no control socket - python has no recvmsg")
+            return
+        try:
+            folder = os.path.dirname(socketfile)
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            if os.path.exists(socketfile):
+                os.unlink(socketfile) # left over from an earlier init process
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.bind(socketfile)
+            os.chmod(socketfile, 0o600)
+            sock.listen(16)
+            sock.setblocking(False)
+            self._control = sock
+            logg.debug("control socket %s", socketfile)
+        except (OSError, socket.error) as e:
+            logg.warning("no control socket %s: %s", socketfile, e)
+            self._control = None
+    def stop_control_socket(self):
+        if self._control:
+            socketfile = _runtime_file(ControlSocket)
+            self._control.close()
+            if socketfile and os.path.exists(socketfile):
+                os.unlink(socketfile)
+        self._control = None
+    def serve_control_socket(self):
+        """ accept the waiting clients - each command runs in a forked child that writes
+            to the stdout/stderr of the client and sends back the exit code """
+        while self._control:
+            try:
+                conn, _ = self._control.accept()
+            except (OSError, socket.error) as e:
+                if e.args[0] in [ errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR ]:
+                    return
+                raise
+            fds = []
+            try:
+                conn.setblocking(True)
+                conn.settimeout(MinimumTimeoutStartSec)
+                fdsize = array.array("i").itemsize
+                msg, ancdata, _, _ = conn.recvmsg(65536, socket.CMSG_LEN(3 * fdsize))
+                for level, kind, data in ancdata:
+                    if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                        fds += array.array("i", data[:len(data) - len(data) % fdsize]).tolist()
+                request = msg.decode("utf-8").split("\0") # "argv" and the command line
+                if request[0] != "argv":
+                    raise ValueError("expected a command line, got %s" % request[0])
+                argv = request[1:]
+                if len(fds) != 3:
+                    raise ValueError("expected stdin/stdout/stderr, got %s fds" % len(fds))
+                logg.info("control socket: %s", " ".join(argv))
+                if "daemon-reload" in argv: # the command line is parsed in the child
+                    self.drop_unit_cache() # the init process forgets its units as well
+                sys.stdout.flush()
+                sys.stderr.flush()
+                pid = os.fork()
+                if not pid:
+                    self.run_control_request(conn, fds, argv) # does not return
+                self._control_pids.add(pid)
+            except Exception as e:
+                logg.error("control socket: bad request: %s", e)
+            finally:
+                conn.close()
+                for fd in fds:
+                    os.close(fd)
+    def run_control_request(self, conn, fds, argv):
+        """ in the forked child: become a normal 'systemctl' call with the command line of
+            the client, reusing the units that the init process has loaded. A command line
+            for another --root or --user, or for an init process, is sent back as
+            "standalone". Otherwise the client learns how long to wait, see control_timeout. """
+        exitcode = 1
+        try:
+            signal.set_wakeup_fd(-1)
+            for signum in [ signal.SIGCHLD, signal.SIGTERM, signal.SIGINT, signal.SIGQUIT ]:
+                signal.signal(signum, signal.SIG_DFL)
+            self._control.close()
+            if self._child_wakeup:
+                for fd in self._child_wakeup:
+                    os.close(fd)
+            for stdfd, fd in enumerate(fds):
+                os.dup2(fd, stdfd)
+            globals().update(_control_defaults)
+            opt, args = option_parser().parse_args(argv)
+            user_mode = opt.user and not opt.system
+            if opt.root != _root or user_mode != _user_mode or opt.init or opt.ipv4 or opt.ipv6 \
+                    or (args and args[0] == "init"):
+                conn.sendall(b"standalone\n")
+                os._exit(0)
+            for name, option in _control_options:
+                globals()[name] = getattr(opt, option)
+            globals()["_init"] = False
+            level = max(0, logging.ERROR - 10 * opt.verbose) # what the client shows, log files unchanged
+            for handler in logging.getLogger().handlers + logg.handlers:
+                if not isinstance(handler, logging.FileHandler):
+                    handler.setLevel(level)
+            if level < logg.getEffectiveLevel():
+                logg.setLevel(level)
+            if opt.version:
+                args = [ "version" ]
+            if not args:
+                args = [ "list-units" ]
+            systemctl = Systemctl()
+            systemctl._unit_cache = self._unit_cache
+            systemctl._cgroup_base = self._cgroup_base
+            try:
+                conn.sendall(("timeout %s\n" % systemctl.control_timeout(args[1:])).encode("utf-8"))
+            except (OSError, socket.error) as e: # the client has gone, e.g. it ran standalone
+                logg.debug("control socket: %s", e)
+                os._exit(0)
+            found, result = run_command(systemctl, args[0], args[1:])
+            if not found:
+                logg.error("Unknown operation %s.", args[0])
+            else:
+                systemctl.save_unit_cache()
+                exitcode = print_result(result)
+        except SystemExit as e: # from option_parser
+            exitcode = e.code if isinstance(e.code, int) else 1
+        except Exception as e:
+            logg.error("control socket: %s failed: %s", " ".join(argv), e)
+        finally:
+            try:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                conn.sendall(("%s\n" % exitcode).encode("utf-8"))
+            finally:
+                os._exit(0)
+    def control_timeout(self, modules):
+        """ seconds a control socket client waits for the result of a command on these units:
+            each may be stopped and started in turn (restart), so the sum of their timeouts """
+        timeout = 0
+        try:
+            for unit in modules and self.match_units(modules) or []:
+                conf = self.get_unit_conf(unit)
+                timeout += self.get_TimeoutStartSec(conf) + self.get_TimeoutStopSec(conf)
+        except Exception as e:
+            logg.debug("control timeout: %s", e)
+        return max(timeout, DefaultTimeoutStartSec + DefaultTimeoutStopSec) + InitLoopSleep
     def system_reap_zombies(self):
-        """ check to reap children """
-        selfpid = os.getpid()
+        """ reap all ended children with waitpid(-1, WNOHANG), keeping their exit status for the
+            supervisor. Returns the number of children left: 0 when none remain, which as PID 1 or
+            child subreaper means all processes of the services have ended (1 if there are any
+            but /proc/self/task/*/children cannot be read) """
+        while True:
+            try:
+                run_pid, run_stat = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.ECHILD:
+                    return 0 # no children at all
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if not run_pid:
+                break # children left, none ended
+            logg.info("reap zombie %s", run_pid)
+            self._control_pids.discard(run_pid)
+            self._compress_pids.pop(run_pid, None)
+            self._exit_status[run_pid] = run_stat # for the supervisor
         running = 0
-        for pid in os.listdir("/proc"):
-            try: pid = int(pid)
-            except: continue
-            if pid == selfpid:
+        try:
+            for tid in os.listdir("/proc/self/task"):
+                with open("/proc/self/task/%s/children" % tid) as f:
+                    running += len(f.read().split())
+        except (IOError, OSError):
+            return 1
+        return running
+    def supervised_units(self, units):
+        """ the services of the init-loop and any other service with a status file, e.g. one
+            started later by another systemctl call (its processes are reparented to PID 1) """
+        found = [ unit for unit in units if unit.endswith(".service") ]
+        folder = _var(self._pid_file_folder)
+        if self._root:
+            folder = os_path(self._root, folder)
+        if os.path.isdir(folder):
+            for name in sorted(os.listdir(folder)):
+                if name.endswith(".service.status"):
+                    unit = name[:-len(".status")]
+                    if unit not in found:
+                        found.append(unit)
+        return found
+    def exit_status_of(self, pid):
+        """ (exitcode, signal) of a process reaped by the init-loop; (None, 0) if unknown """
+        run_stat = self._exit_status.pop(to_int(pid), None)
+        if run_stat is None:
+            return None, 0
+        if os.WIFSIGNALED(run_stat):
+            return None, os.WTERMSIG(run_stat)
+        return os.WEXITSTATUS(run_stat), 0
+    def supervise_units(self, units):
+        """ the supervisor goes round - the main process of a simple, forking or notify service
+            that has ended while its MainPID is still recorded (a stop removes it) is handled by the
+            Restart= setting of the service. The restart waits RestartSec, growing with RestartSteps
+            and RestartMaxDelaySec, and is refused after StartLimitBurst restarts within
+            StartLimitIntervalSec. Returns the seconds until the next scheduled restart or None. """
+        now = time.time()
+        for unit in self.supervised_units(units):
+            conf = self.load_unit_conf(unit)
+            if not conf: continue
+            if conf.data.get("Service", "Type", "simple").lower() not in [ "simple", "forking", "notify" ]:
                 continue
-            proc_status = "/proc/%s/status" % pid
-            if os.path.isfile(proc_status):
-                zombie = False
-                ppid = -1
-                try:
-                    for line in open(proc_status):
-                        m = re.match(r"State:\s*Z.*", line)
-                        if m: zombie = True
-                        m = re.match(r"PPid:\s*(\d+)", line)
-                        if m: ppid = int(m.group(1))
-                except IOError as e:
-                    logg.warning("%s : %s", proc_status, e)
+            if unit in self._restart_due:
+                due, pid = self._restart_due[unit]
+                if due > now: continue
+                del self._restart_due[unit]
+                with waitlock(conf):
+                    conf.status = None # re-read, another systemctl may have changed it
+                    if str(self.read_mainpid_from(conf, "")) != pid:
+                        logg.info("%s: PID %s was stopped or replaced, no automatic restart", unit, pid)
+                        continue
+                    self.restart_exited_unit_from(conf)
+                continue
+            pid = self.read_mainpid_from(conf, "")
+            if not pid or self.is_active_pid(pid) or self._exit_handled.get(unit) == str(pid):
+                continue
+            with waitlock(conf):
+                conf.status = None # re-read, another systemctl may be stopping the service
+                pid = self.read_mainpid_from(conf, "")
+                if not pid or self.is_active_pid(pid):
+                    continue
+                pid = str(pid)
+                self._exit_handled[unit] = pid
+                exitcode, signum = self.exit_status_of(pid)
+                if exitcode is None and not signum:
+                    how = "exit status unknown"
+                    wanted = self.restart_wanted_from(conf, exitcode = -1) # not seen as clean
+                elif signum:
+                    how = "signal %s" % signum
+                    if self.exit_clean_from(conf, signum = signum):
+                        wanted = self.restart_wanted_from(conf, exitcode = 0)
+                    else:
+                        wanted = self.restart_wanted_from(conf, signaled = True)
+                else:
+                    how = "exit code %s" % exitcode
+                    self.write_status_from(conf, ExecMainCode = exitcode)
+                    if self.exit_clean_from(conf, exitcode = exitcode):
+                        wanted = self.restart_wanted_from(conf, exitcode = 0)
+                    else:
+                        wanted = self.restart_wanted_from(conf, exitcode = exitcode)
+                if not wanted:
+                    logg.info("%s: PID %s ended (%s), no restart for Restart=%s", unit, pid, how, self.get_Restart(conf))
                     continue
-                if zombie and ppid == os.getpid():
-                    logg.info("reap zombie %s", pid)
-                    try: os.waitpid(pid, os.WNOHANG)
-                    except OSError as e: 
-                        logg.warning("reap zombie %s: %s", e.strerror)
-            if os.path.isfile(proc_status):
-                if pid > 1:
-                    running += 1
-        return running # except PID 0 and PID 1
-    def pidlist_of(self, pid):
+                restarts = to_int(self.get_status_from(conf, "NRestarts", "0"))
+                delay = self.get_restart_delay_from(conf, restarts)
+                logg.warning("%s: PID %s ended (%s), restart in %.1fs", unit, pid, how, delay)
+                self._restart_due[unit] = (now + delay, pid)
+        self._exit_status = {} # the rest were no main processes
+        if not self._restart_due:
+            return None
+        return max(0., min([ due for due, pid in self._restart_due.values() ]) - time.time())
+    def restart_exited_unit_from(self, conf):
+        """ automatic restart of a service whose main process has ended; NRestarts is counted
+            in the status file. The caller holds the waitlock. """
+        if self.start_limit_hit_from(conf, record = True):
+            logg.error("%s: not restarted anymore, see StartLimitBurst and StartLimitIntervalSec", conf.name())
+            return False
+        restarts = to_int(self.get_status_from(conf, "NRestarts", "0")) + 1
+        self.clean_pid_file_from(conf) # a stale PIDFile would look like a started service
+        self.write_status_from(conf, NRestarts = restarts)
+        logg.info("%s: automatic restart %s", conf.name(), restarts)
+        return self.do_start_unit_from(conf)
+    def pidlist_of(self, pid, procs = None):
+        """ pid and its descendants, from the snapshot procs or a new one """
         try: pid = int(pid)
         except: return []
-        pidlist = [ pid ]
-        pids = [ pid ]
-        for depth in xrange(ProcMaxDepth):
-            for pid in os.listdir("/proc"):
-                try: pid = int(pid)
-                except: continue
-                proc_status = "/proc/%s/status" % pid
-                if os.path.isfile(proc_status):
-                    try:
-                        for line in open(proc_status):
-                            if line.startswith("PPid:"):
-                                ppid = line[len("PPid:"):].strip()
-                                try: ppid = int(ppid)
-                                except: continue
-                                if ppid in pidlist and pid not in pids:
-                                    pids += [ pid ]
-                    except IOError as e:
-                        logg.warning("%s : %s", proc_status, e)
-                        continue
-            if len(pids) != len(pidlist):
-                pidlist = pids[:]
-                continue
+        if procs is None:
+            procs = ProcessTable()
+        return procs.descendants_of(pid)
+    def cgroup_base(self): # -> folder?
+        """ the cgroup v2 folder of the units (<top>/system.slice, see cgroup_top) with the
+            controllers enabled for their cgroups, None without a writable cgroup2. The
+            init process sets it up before it forks anything, the children inherit it. """
+        if self._cgroup_base is None:
+            self._cgroup_base = self.setup_cgroup_base() or ""
+        return self._cgroup_base or None
+    def cgroup_top(self): # -> folder?
+        """ the cgroup2 folder that we were started in, from the "0::" line of /proc/self/cgroup.
+            That is /sys/fs/cgroup only with a cgroup namespace of our own; without one it is
+            the cgroup that the container engine has made for us. When we have been moved to
+            its init.scope already, or run as a unit below it, then that is taken off again. """
+        path = None
+        try:
+            with open("/proc/self/cgroup") as f:
+                for line in f:
+                    if line.startswith("0::"):
+                        path = line[3:].strip()
+        except (IOError, OSError) as e:
+            logg.debug("no cgroup of our own: %s", e)
+        if not path or not path.startswith("/"):
+            return None
+        parts = [ part for part in path.split("/") if part ]
+        if parts[-1:] == [ "init.scope" ]:
+            parts = parts[:-1]
+        elif parts[-2:-1] == [ CgroupSlice ] and parts[-1].endswith(".service"):
+            parts = parts[:-2]
+        return os.path.join(_cgroup_folder, *parts)
+    def setup_cgroup_base(self):
+        if not CgroupSlice or CgroupSlice in [ "no", "off", "0" ]:
+            return None
+        top = self.cgroup_top()
+        if not top:
+            logg.debug("no cgroup2 hierarchy")
+            return None
+        if not os.path.isfile(os.path.join(top, "cgroup.controllers")):
+            logg.debug("no cgroup2 hierarchy in %s", top)
+            return None
+        if not os.access(os.path.join(top, "cgroup.subtree_control"), os.W_OK):
+            logg.debug("cgroup2 hierarchy in %s is not writable", top)
+            return None
+        base = os.path.join(top, CgroupSlice)
+        try:
+            if not os.path.isdir(base):
+                os.mkdir(base)
+            with open(os.path.join(top, "cgroup.controllers")) as f:
+                available = f.read().split()
+            wanted = []
+            for controller, filename in _cgroup_properties.values():
+                if controller in available and controller not in wanted:
+                    wanted.append(controller)
+            self.enable_cgroup_controllers(top, wanted)
+            self.enable_cgroup_controllers(base, wanted)
+            return base
+        except (IOError, OSError) as e:
+            logg.info("no cgroups for the units: %s", e)
+            return None
+    def enable_cgroup_controllers(self, folder, controllers):
+        """ cgroup.subtree_control of the folder. A cgroup with processes can not pass
+            controllers on ("no internal processes"), so when we are the init process then
+            the processes of the container are moved to <folder>/init.scope first. """
+        subtree_control = os.path.join(folder, "cgroup.subtree_control")
+        with open(subtree_control) as f:
+            enabled = f.read().split()
+        missing = [ controller for controller in controllers if controller not in enabled ]
+        if not missing:
+            return
+        text = " ".join([ "+" + controller for controller in missing ])
+        try:
+            with open(subtree_control, "w") as f:
+                f.write(text)
+        except (IOError, OSError) as e:
+            if e.errno != errno.EBUSY or not (self._init or os.getpid() == 1):
+                raise
+            init_scope = os.path.join(folder, "init.scope")
+            if not os.path.isdir(init_scope):
+                os.mkdir(init_scope)
+            for pid in self.read_cgroup_procs(folder):
+                self.write_cgroup_procs(init_scope, pid)
+            with open(subtree_control, "w") as f:
+                f.write(text)
+        logg.debug("cgroup %s: %s", folder, text)
+    def read_cgroup_procs(self, folder): # -> [ pid,... ]
+        pids = []
+        with open(os.path.join(folder, "cgroup.procs")) as f:
+            for line in f:
+                if line.strip():
+                    pids.append(int(line))
         return pids
+    def write_cgroup_procs(self, folder, pid):
+        """ move one process - cgroup.procs takes a single PID per write """
+        try:
+            with open(os.path.join(folder, "cgroup.procs"), "w") as f:
+                f.write(str(pid))
+            return True
+        except (IOError, OSError) as e:
+            logg.debug("PID %s not moved to %s: %s", pid, folder, e)
+            return False
+    def cgroup_of(self, conf): # -> folder?
+        base = self.cgroup_base()
+        if not base:
+            return None
+        return os.path.join(base, conf.name())
+    def cgroup_settings_from(self, conf): # -> [ (name, file, text),... ]
+        settings = []
+        for name, (controller, filename) in _cgroup_properties.items():
+            values = conf.data.getlist("Service", name, [])
+            if not values:
+                continue
+            text = cgroup_value(name, values[-1]) # drop-ins come last
+            if text is None:
+                logg.warning("%s: unsupported %s=%s", conf.name(), name, values[-1])
+                continue
+            settings.append((name, filename, text))
+        return settings
+    def apply_cgroup_settings(self, folder, settings):
+        done = True
+        for name, filename, text in settings:
+            try:
+                with open(os.path.join(folder, filename), "w") as f:
+                    f.write(text)
+                logg.debug("cgroup %s: %s=%s", os.path.basename(folder), filename, text)
+            except (IOError, OSError) as e:
+                logg.warning("%s: can not set %s in %s: %s", os.path.basename(folder), name, filename, e)
+                done = False
+        return done
+    def enter_cgroup_from(self, conf):
+        """ in the child before execve: create the cgroup of the unit, apply its
+            resource settings and move this process into it """
+        folder = self.cgroup_of(conf)
+        if not folder:
+            return False
+        try:
+            if not os.path.isdir(folder):
+                os.mkdir(folder)
+        except OSError as e:
+            logg.warning("%s: no cgroup %s: %s", conf.name(), folder, e)
+            return False
+        self.apply_cgroup_settings(folder, self.cgroup_settings_from(conf))
+        return self.write_cgroup_procs(folder, os.getpid())
+    def read_cgroup_procs_from(self, conf): # -> [ pid,... ]?
+        """ the processes in the cgroup of the unit, None when it has none """
+        folder = self.cgroup_of(conf)
+        if not folder or not os.path.isdir(folder):
+            return None
+        try:
+            return self.read_cgroup_procs(folder)
+        except (IOError, OSError, ValueError) as e:
+            logg.warning("%s: can not read cgroup.procs: %s", conf.name(), e)
+            return None
+    def remove_cgroup_from(self, conf):
+        folder = self.cgroup_of(conf)
+        if folder and os.path.isdir(folder):
+            try:
+                os.rmdir(folder)
+            except OSError as e:
+                logg.debug("%s: cgroup not removed: %s", conf.name(), e)
+    def set_property_modules(self, *modules):
+        """ UNIT NAME=VALUE... -- set resource-control properties of a running unit.
+            Only the cgroup is changed (as with --runtime), the unit files are not. """
+        if len(modules) < 2:
+            logg.error("Too few arguments")
+            return False
+        unit = modules[0]
+        conf = self.get_unit_conf(unit)
+        if not conf.loaded():
+            logg.error("Unit %s could not be found.", unit)
+            return False
+        settings = []
+        found_all = True
+        for assignment in modules[1:]:
+            name, _, value = assignment.partition("=")
+            if name not in _cgroup_properties:
+                logg.error("Unknown assignment: %s", assignment)
+                found_all = False
+                continue
+            text = cgroup_value(name, value)
+            if text is None:
+                logg.error("Failed to parse %s value %s", name, value)
+                found_all = False
+                continue
+            settings.append((name, _cgroup_properties[name][1], text))
+        folder = self.cgroup_of(conf)
+        if not folder or not os.path.isdir(folder):
+            logg.info("%s has no cgroup (not running or no cgroup2): ignored", unit)
+            return found_all
+        return self.apply_cgroup_settings(folder, settings) and found_all
     def etc_hosts(self):
         path = "/etc/hosts"
         if self._root:
@@ -4214,7 +5496,101 @@ def print_result(result):
         logg.warning("EXEC END Unknown result type %s", str(type(result)))
     return exitcode
 
-if __name__ == "__main__":
+# the settings that the init process takes from the command line of a control_request: global => option
+_control_options = [ ("_extra_vars", "extra_vars"), ("_force", "force"), ("_full", "full"),
+    ("_no_legend", "no_legend"), ("_no_ask_password", "no_ask_password"), ("_now", "now"),
+    ("_preset_mode", "preset_mode"), ("_quiet", "quiet"), ("_show_all", "show_all"),
+    ("_unit_state", "state"), ("_unit_type", "unit_type"), ("_unit_property", "unit_property") ]
+# their defaults, as the init process has its own command line
+_control_defaults = dict((name, globals()[name]) for name, option in _control_options)
+
+def run_command(systemctl, command, modules): # -> (found, result)
+    """ run the systemctl method for the command, e.g. 'is-active' => is_active_modules """
+    found = False
+    result = None
+    # command NAME
+    if command == "mask": command = "disable"
+    if command.startswith("__"):
+        command_name = command[2:]
+        command_func = getattr(systemctl, command_name, None)
+        if callable(command_func) and not found:
+            found = True
+            result = command_func(*modules)
+    command_name = command.replace("-","_").replace(".","_")+"_modules"
+    command_func = getattr(systemctl, command_name, None)
+    if callable(command_func) and not found:
+        found = True
+        result = command_func(*modules)
+    command_name = "show_"+command.replace("-","_").replace(".","_")
+    command_func = getattr(systemctl, command_name, None)
+    if callable(command_func) and not found:
+        found = True
+        result = command_func(*modules)
+    command_name = "system_"+command.replace("-","_").replace(".","_")
+    command_func = getattr(systemctl, command_name, None)
+    if callable(command_func) and not found:
+        found = True
+        result = command_func()
+    command_name = "systems_"+command.replace("-","_").replace(".","_")
+    command_func = getattr(systemctl, command_name, None)
+    if callable(command_func) and not found:
+        found = True
+        result = command_func()
+    return found, result
+
+def control_request(argv): # -> exitcode?
+    """ thin client: let the init process run the command line when it serves a control
+        socket. The request is "argv" and the arguments, separated by NUL characters, with
+        our stdin/stdout/stderr passed along, so the output is the same.
+        The init process answers "standalone" when it can not run the command line for us
+        (another --root or --user, --init), else "timeout N" and at last the exit code.
+        Returns None when there is no init process to ask, when it refuses, or when it does
+        not answer within MinimumTimeoutStartSec (run standalone then). systemctl_launcher.py
+        does the same before systemctl3 is even loaded. """
+    socketfile = _runtime_file(ControlSocket)
+    if not socketfile or not os.path.exists(socketfile):
+        return None
+    if not hasattr(socket.socket, "sendmsg"):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(MinimumYield)
+        sock.connect(socketfile)
+        fds = array.array("i", [ 0, 1, 2 ])
+        request = "\0".join([ "argv" ] + argv).encode("utf-8")
+        sock.sendmsg([ request ], [ (socket.SOL_SOCKET, socket.SCM_RIGHTS, fds) ])
+    except (OSError, socket.error) as e:
+        logg.debug("control socket %s: %s - running standalone", socketfile, e)
+        sock.close()
+        return None
+    timeout = None
+    try:
+        sock.settimeout(MinimumTimeoutStartSec) # the init-loop may be busy with a restart
+        reply = sock.makefile("rb")
+        line = reply.readline().decode("utf-8").strip()
+        if line.startswith("timeout "):
+            timeout = float(line.split()[1])
+            sock.settimeout(timeout)
+            line = reply.readline().decode("utf-8").strip()
+        if line in [ "", "standalone" ] and timeout is None:
+            logg.debug("control socket %s: refused - running standalone", socketfile)
+            return None
+        return int(line)
+    except socket.timeout:
+        if timeout is None:
+            logg.warning("control socket %s: no answer - running standalone", socketfile)
+            return None
+        logg.error("control socket %s: no result after %ss", socketfile, timeout)
+        return 1
+    except (ValueError, OSError, socket.error) as e:
+        logg.error("control socket %s: no result: %s", socketfile, e)
+        return 1
+    finally:
+        sock.close()
+
+def option_parser():
+    """ the command line options; used by the main program and for the command lines
+        that clients hand over on the control socket """
     import optparse
     _o = optparse.OptionParser("%prog [options] command [name...]", 
         epilog="use 'help' command for more information")
@@ -4266,8 +5642,8 @@ if __name__ == "__main__":
         help="Do not ask for system passwords")
     # _o.add_option("--global", action="store_true", dest="globally", default=_globally,
     #    help="Enable/disable unit files globally") # for all user logins
-    # _o.add_option("--runtime", action="store_true",
-    #     help="Enable unit files only temporarily until next reboot")
+    _o.add_option("--runtime", action="store_true",
+        help="Enable unit files only temporarily until next reboot (ignored, set-property is always runtime)")
     _o.add_option("--force", action="store_true", default=_force,
         help="When enabling unit files, override existing symblinks / When shutting down, execute action immediately")
     _o.add_option("--preset-mode", metavar="TYPE", default=_preset_mode,
@@ -4282,7 +5658,6 @@ if __name__ == "__main__":
         help="Print unit dependencies as a list instead of a tree (ignored)")
     _o.add_option("--no-pager", action="store_true",
         help="Do not pipe output into pager (ignored)")
-    #
     _o.add_option("--coverage", metavar="OPTIONLIST", default=COVERAGE,
         help="..support for coverage (e.g. spawn,oldest,sleep) [%default]")
     _o.add_option("-e","--extra-vars", "--environment", metavar="NAME=VAL", action="append", default=[],
@@ -4295,6 +5670,10 @@ if __name__ == "__main__":
         help="..only keep ipv6 localhost in /etc/hosts")
     _o.add_option("-1","--init", action="store_true", default=False,
         help="..keep running as init-process (default if PID 1)")
+    return _o
+
+if __name__ == "__main__":
+    _o = option_parser()
     opt, args = _o.parse_args()
     logging.basicConfig(level = max(0, logging.FATAL - 10 * opt.verbose))
     logg.setLevel(max(0, logging.ERROR - 10 * opt.verbose))
@@ -4350,7 +5729,6 @@ if __name__ == "__main__":
         _user_mode and " --user" or " --system", _init and " --init" or "", )
     #
     #
-    systemctl = Systemctl()
     if opt.version:
         args = [ "version" ]
     if not args:
@@ -4361,41 +5739,20 @@ if __name__ == "__main__":
     logg.debug("======= systemctl.py " + " ".join(args))
     command = args[0]
     modules = args[1:]
+    if not _init and not opt.ipv4 and not opt.ipv6 and command not in [ "init" ] \
+            and not globals().get("_control_asked"): # set by systemctl_launcher.py
+        exitcode = control_request(sys.argv[1:])
+        if exitcode is not None:
+            sys.exit(exitcode)
+    systemctl = Systemctl()
     if opt.ipv4:
         systemctl.force_ipv4()
     elif opt.ipv6:
         systemctl.force_ipv6()
-    found = False
-    # command NAME
-    if command == "mask": command = "disable"
-    if command.startswith("__"):
-        command_name = command[2:]
-        command_func = getattr(systemctl, command_name, None)
-        if callable(command_func) and not found:
-            found = True
-            result = command_func(*modules)
-    command_name = command.replace("-","_").replace(".","_")+"_modules"
-    command_func = getattr(systemctl, command_name, None)
-    if callable(command_func) and not found:
-        found = True
-        result = command_func(*modules)
-    command_name = "show_"+command.replace("-","_").replace(".","_")
-    command_func = getattr(systemctl, command_name, None)
-    if callable(command_func) and not found:
-        found = True
-        result = command_func(*modules)
-    command_name = "system_"+command.replace("-","_").replace(".","_")
-    command_func = getattr(systemctl, command_name, None)
-    if callable(command_func) and not found:
-        found = True
-        result = command_func()
-    command_name = "systems_"+command.replace("-","_").replace(".","_")
-    command_func = getattr(systemctl, command_name, None)
-    if callable(command_func) and not found:
-        found = True
-        result = command_func()
+    found, result = run_command(systemctl, command, modules)
     if not found:
         logg.error("Unknown operation %s.", command)
         sys.exit(1)
     #
+    systemctl.save_unit_cache()
     sys.exit(print_result(result))
@@ -0,0 +1,84 @@
+#! /usr/bin/python3
+""" /usr/bin/systemctl: runs systemctl3.py from /usr/lib/systemctl3 as a module,
+    so that its compiled bytecode is used instead of compiling the script on every call.
+    When the init process serves its control socket, the command line is handed over to it
+    first, without loading systemctl3 at all (see control_request in systemctl3.py for the
+    protocol). Only _socket is imported for that, as the socket module alone takes longer
+    to import than the init process needs to run a command. """
+import os
+import sys
+
+def control_socket():
+    """ the control socket of the init process for the system manager, as in systemctl3.py """
+    name = os.environ.get("SYSTEMCTL_CONTROL_SOCKET", "systemctl.control")
+    if not name or name in [ "no", "off", "0" ]:
+        return None
+    if os.path.isabs(name):
+        return name
+    return os.path.join("/var/run/systemd", name)
+
+def readline(sock, buf):
+    """ the next line of the reply and the rest of buf; an empty line when the init process closed """
+    while not b"\n" in buf:
+        data = sock.recv(64)
+        if not data:
+            return "", b""
+        buf += data
+    line, buf = buf.split(b"\n", 1)
+    return line.decode("utf-8").strip(), buf
+
+def control_request(argv):
+    """ the exit code of the command line run by the init process, or None to run systemctl3.
+        After a request that was refused or not answered, systemctl3 does not ask again """
+    if os.getpid() in [ 1, 0 ]:
+        return None
+    for arg in argv: # these need another socket or no init process; left to systemctl3
+        if arg.startswith("--root") or arg in [ "--user", "--init", "-1" ]:
+            return None
+    socketfile = control_socket()
+    if not socketfile or not os.path.exists(socketfile):
+        return None
+    import _socket
+    import struct # array would load collections.abc
+    sock = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+    try:
+        sock.settimeout(0.5)
+        sock.connect(socketfile)
+        fds = struct.pack("3i", 0, 1, 2)
+        request = "\0".join([ "argv" ] + argv).encode("utf-8")
+        sock.sendmsg([ request ], [ (_socket.SOL_SOCKET, _socket.SCM_RIGHTS, fds) ])
+    except OSError:
+        sock.close()
+        return None
+    timeout = None
+    init_globals["_control_asked"] = True
+    try:
+        sock.settimeout(4) # MinimumTimeoutStartSec; the init-loop may be busy with a restart
+        line, buf = readline(sock, b"")
+        if line.startswith("timeout "):
+            timeout = float(line.split()[1])
+            sock.settimeout(timeout)
+            line, buf = readline(sock, buf)
+        if line in [ "", "standalone" ] and timeout is None:
+            return None
+        return int(line)
+    except _socket.timeout:
+        if timeout is None:
+            return None
+        sys.stderr.write("systemctl: no result from the init process after %ss\n" % timeout)
+        return 1
+    except (ValueError, OSError) as e:
+        sys.stderr.write("systemctl: no result from the init process: %s\n" % e)
+        return 1
+    finally:
+        sock.close()
+
+init_globals = {}
+exitcode = control_request(sys.argv[1:])
+if exitcode is not None:
+    sys.exit(exitcode)
+
+import runpy
+
+sys.path.insert(0, "/usr/lib/systemctl3")
+runpy.run_module("systemctl3", init_globals=init_globals, run_name="__main__", alter_sys=True)
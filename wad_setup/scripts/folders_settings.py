@@ -9,10 +9,11 @@ import subprocess
 import platform
 import logging
 
-__version__ = '20190207' 
+__version__ = '20261019' 
 
 """
 Changelog:
+ 20261019: WORKERS sized from the host probe
  20190207: added orthancpluginsroot because was not used for apt!
  20170914: bugfix multiple '-r' arguments defined (removed short hand notations for different ports);
            bugfix pacs_port argument was set to rest_port
@@ -25,8 +26,10 @@ Changelog:
 try:
     from .defaults import LOGGERNAME
     from .addtoenv import addtoenv
+    from .hostprobe import recommend
 except:
     from defaults import LOGGERNAME
+    from hostprobe import recommend
     from addtoenv import addtoenv
     
 logger = logging.getLogger(LOGGERNAME)
@@ -86,9 +89,12 @@ def create_scripts(database, **kwargs):
     templates = os.path.join(os.path.dirname(__file__), 'templates')
     # postgresql support
     if database == 'postgresql':
-        inlist = ['__ORTHANCPLUGINSROOT__', '__DEVROOT__', '__PACSPSWD__', '__ODBPSWD__', '__PSQLPORT__', '__RESTPORT__', '__PACSPORT__', '\\']
+        # storage caps for recycling by Orthanc; 0 means no limit
+        inlist = ['__ORTHANCPLUGINSROOT__', '__DEVROOT__', '__PACSPSWD__', '__ODBPSWD__', '__PSQLPORT__', '__RESTPORT__', '__PACSPORT__', 
+                  '__MAXSTORAGE__', '__MAXPATIENTS__', '\\']
         outlist = [ orthancplugins_root, installation_root, kwargs['orthanc_pass'], kwargs['orthancdb_pass'], 
-                    str(kwargs['pgsql_port']), str(kwargs['rest_port']), str(kwargs['pacs_port']), '/' ]
+                    str(kwargs['pgsql_port']), str(kwargs['rest_port']), str(kwargs['pacs_port']), 
+                    str(int(kwargs.get('orthanc_max_storage_mb', 0))), str(int(kwargs.get('orthanc_max_patients', 0))), '/' ]
         copy_replaces(src=os.path.join(templates, 'orthanc_postgresql.json'), 
                       dest=os.path.join(installation_root, 'orthanc', 'config', 'orthanc.json'), 
                       inlist=inlist, 
@@ -120,9 +126,10 @@ def create_scripts(database, **kwargs):
     except Exception as e:
         msg += 'WARNING: cannot make {} executable'.format(os.path.basename(dest))
 
-    # inifiles
-    inlist = ['__DEVROOT__', '__IDBPSWD__', '__PACSPSWD__', '__PSQLPORT__', '__RESTPORT__']
-    outlist = [installation_root, kwargs['iqcdb_pass'], kwargs['orthanc_pass'], str(kwargs['pgsql_port']), str(kwargs['rest_port'])]
+    # inifiles; the number of parallel processes of wadprocessor is sized from the host probe
+    workers = recommend('workers', installation_root, 1, kwargs.get('workers', None))
+    inlist = ['__DEVROOT__', '__IDBPSWD__', '__PACSPSWD__', '__PSQLPORT__', '__RESTPORT__', '__WORKERS__']
+    outlist = [installation_root, kwargs['iqcdb_pass'], kwargs['orthanc_pass'], str(kwargs['pgsql_port']), str(kwargs['rest_port']), str(int(workers))]
     copy_replaces(src=os.path.join(templates, 'wadconfig_postgresql.ini' if database == 'postgresql' else 'wadconfig.ini'), 
                   dest=os.path.join(installation_root, 'WAD_QC', 'wadconfig.ini'), 
                   inlist=inlist, 
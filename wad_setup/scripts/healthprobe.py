@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+__version__ = '20261019'
+
+"""
+Readiness probe for the WAD-QC services, used in ExecStartPost of the generated systemd units.
+
+A Type=simple service counts as started as soon as its process is forked, so After= on it only
+orders the launch. With this probe in ExecStartPost, systemd only considers the service started
+(and starts the units ordered after it) once it accepts connections.
+
+With --watchdog it also feeds the systemd watchdog of a service with WatchdogSec: once ready, it
+keeps running in the background of the service and sends WATCHDOG=1 while the probes succeed.
+When the service hangs the pings stop, and systemd restarts it after WatchdogSec.
+
+It is stand-alone (standard library only), because create_start_systemd installs it as
+WADROOT/WAD_QC/systemd/wad_healthprobe.
+
+Usage:
+  wad_healthprobe --http http://localhost:8042/system   # any HTTP response, also 401, means up
+  wad_healthprobe --tcp localhost:5432 --timeout 120
+  wad_healthprobe --tcp localhost:5432 --watchdog 60     # needs NOTIFY_SOCKET, i.e. NotifyAccess=all
+
+Changelog:
+ 20261019: watchdog pings
+ 20261019: initial version
+"""
+
+import os
+import sys
+import time
+import socket
+import argparse
+
+try:
+    from urllib.request import urlopen
+    from urllib.error import HTTPError, URLError
+except ImportError:
+    from urllib2 import urlopen, HTTPError, URLError
+
+def probe_tcp(hostport, timeout=2.):
+    """
+    True if a connection to host:port can be made
+    """
+    host, port = hostport.rsplit(':', 1)
+    try:
+        s = socket.create_connection((host, int(port)), timeout=timeout)
+        s.close()
+        return True
+    except (socket.error, socket.timeout):
+        return False
+
+def probe_http(url, timeout=2.):
+    """
+    True if url gives any HTTP response; an error status (e.g. 401 without credentials) still means the server is up
+    """
+    try:
+        urlopen(url, timeout=timeout).close()
+        return True
+    except HTTPError:
+        return True
+    except (URLError, socket.error, socket.timeout):
+        return False
+
+def wait_ready(probes, timeout=60., interval=.5):
+    """
+    Wait until all probes, a list of (function, target), succeed. Returns the targets that are not up after timeout.
+    """
+    deadline = time.time()+timeout
+    pending = list(probes)
+    while True:
+        pending = [(func, target) for func, target in pending if not func(target)]
+        if len(pending) == 0 or time.time() > deadline:
+            return [target for func, target in pending]
+        time.sleep(interval)
+
+def notify(message):
+    """
+    Send message to the systemd notify socket; False if there is none
+    """
+    address = os.environ.get('NOTIFY_SOCKET', '')
+    if address == '':
+        return False
+    if address.startswith('@'): # abstract namespace
+        address = '\0'+address[1:]
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        s.connect(address)
+        s.sendall(message.encode('utf-8'))
+        return True
+    except socket.error:
+        return False
+    finally:
+        s.close()
+
+def watchdog(probes, interval):
+    """
+    Send WATCHDOG=1 every interval seconds as long as all probes, a list of (function, target), succeed
+    """
+    while True:
+        if all(func(target) for func, target in probes):
+            notify('WATCHDOG=1')
+        time.sleep(interval)
+
+def detach():
+    """
+    Fork into the background of the service; returns False in the parent
+    """
+    if os.fork() > 0:
+        return False
+    os.setsid()
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in [0, 1, 2]:
+        os.dup2(devnull, fd)
+    return True
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Wait until WAD-QC services accept connections')
+    parser.add_argument('--tcp',
+                        default=[], action='append',
+                        help='host:port that must accept tcp connections; can be repeated.',
+                        dest='tcp')
+    parser.add_argument('--http',
+                        default=[], action='append',
+                        help='url that must give an HTTP response; can be repeated.',
+                        dest='http')
+    parser.add_argument('-t', '--timeout',
+                        default=60., type=float,
+                        help='seconds to wait before giving up [60].',
+                        dest='timeout')
+    parser.add_argument('-i', '--interval',
+                        default=.5, type=float,
+                        help='seconds between attempts [0.5].',
+                        dest='interval')
+    parser.add_argument('--watchdog',
+                        default=0., type=float,
+                        help='WatchdogSec of the service; once ready, ping the watchdog in the background while the probes succeed [0: off].',
+                        dest='watchdog')
+
+    args = parser.parse_args()
+    probes = [(probe_tcp, t) for t in args.tcp]+[(probe_http, u) for u in args.http]
+    if len(probes) == 0:
+        parser.print_help()
+        sys.exit(2)
+
+    starttime = time.time()
+    failed = wait_ready(probes, timeout=args.timeout, interval=args.interval)
+    if len(failed) > 0:
+        print('Not ready after {} s: {}'.format(args.timeout, ', '.join(failed)), file=sys.stderr)
+        sys.exit(1)
+    print('Ready after {:.1f} s: {}'.format(time.time()-starttime, ', '.join([t for f, t in probes])))
+
+    if args.watchdog > 0:
+        if os.environ.get('NOTIFY_SOCKET', '') == '':
+            print('No NOTIFY_SOCKET for watchdog pings; set NotifyAccess=all for the service', file=sys.stderr)
+        elif detach():
+            # ping three times per WatchdogSec, so one slow probe does not trigger a restart
+            watchdog(probes, args.watchdog/3.)
@@ -0,0 +1,419 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+__version__ = '20261019'
+
+"""
+Capacity probe of the host WAD-QC is installed on, and sizing of the settings that depend on it.
+
+The probe runs short micro-benchmarks: cpu (single core and all cores), memory bandwidth, fsync latency
+and sequential and random I/O on the filesystem of WADROOT. Only python (and NumPy if available) is used,
+no external tools. The results are stored in WADROOT/WAD_QC/hostprobe.json.
+
+The template generators (create_scripts, the *_deploy_sites actions, create_postgresql_datadir) ask
+recommend() for their sizes; without a probe they keep the defaults of the templates. Each choice is
+logged with the reason for it.
+
+Run from the wad_setup folder:
+  python -m scripts.hostprobe -r ~/WADDEV2          # probe and show the recommendations
+  python -m scripts.hostprobe -r ~/WADDEV2 --show   # show the recommendations of the stored probe
+
+Changelog:
+ 20261019: initial version
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import logging
+
+try:
+    from .defaults import LOGGERNAME
+except:
+    from defaults import LOGGERNAME
+
+logger = logging.getLogger(LOGGERNAME)
+
+PROBEFILE = os.path.join('WAD_QC', 'hostprobe.json')
+
+# hdd or ssd; below these the storage is treated as a spinning disk
+SSD_MIN_RANDOM_IOPS = 2000
+SSD_MAX_FSYNC_MS = 2.
+
+# fractions of the memory for the analyses: above the first (MemoryHigh of wadprocessor) they are throttled,
+# above the second (MemoryMax) killed
+ANALYSIS_MEMORY_HIGH = 0.6
+ANALYSIS_MEMORY_MAX = 0.8
+
+#----host
+def host_resources():
+    """
+    Number of usable cpus and total memory in MB of this host (None if unknown)
+    """
+    try:
+        ncpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        import multiprocessing
+        ncpus = multiprocessing.cpu_count()
+
+    mem_mb = None
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemTotal:'):
+                    mem_mb = int(line.split()[1])//1024
+                    break
+    except (IOError, OSError, ValueError):
+        pass
+
+    return {'cpus': ncpus, 'mem_mb': mem_mb}
+
+def analysis_cpus(ncpus):
+    """
+    The cpus for analyses; with 4 or more cpus, the first quarter is kept free for ingest, database and sites
+    """
+    reserved = max(1, ncpus//4) if ncpus >= 4 else 0
+    return list(range(reserved, ncpus))
+
+#----benchmarks
+def _cpu_work(n):
+    x = 0
+    for i in range(n):
+        x = (x + i*i) % 1000003
+    return x
+
+def bench_cpu(seconds=1.):
+    """
+    Loops per second on one core, and the scaling over all usable cpus (1.0: perfect)
+    """
+    import multiprocessing
+
+    n = 100000
+    start = time.time()
+    loops = 0
+    while time.time()-start < seconds:
+        _cpu_work(n)
+        loops += n
+    single = loops/(time.time()-start)
+
+    ncpus = host_resources()['cpus']
+    result = {'single_loops_s': int(single), 'cpus': ncpus, 'scaling': 1.}
+    if ncpus > 1:
+        per_cpu = max(n, int(single*seconds))
+        try:
+            pool = multiprocessing.Pool(ncpus)
+            start = time.time()
+            pool.map(_cpu_work, [per_cpu]*ncpus)
+            elapsed = time.time()-start
+            pool.close()
+            pool.join()
+            result['scaling'] = round(per_cpu*ncpus/elapsed/single/ncpus, 2)
+        except (OSError, ImportError) as e:
+            logger.warning('...cpu probe: cannot run on all cpus ({}); assuming perfect scaling'.format(str(e)))
+    return result
+
+def bench_memory(size_mb=64, seconds=1.):
+    """
+    Memory copy bandwidth in MB/s, with NumPy if available
+    """
+    nbytes = size_mb*1024*1024
+    try:
+        import numpy as np
+        src = np.ones(nbytes//8)
+        dst = np.empty_like(src)
+        copy = lambda: np.copyto(dst, src)
+        method = 'numpy'
+    except ImportError:
+        src = bytearray(nbytes)
+        dst = bytearray(nbytes)
+        view = memoryview(dst)
+        def copy():
+            view[:] = src
+        method = 'python'
+
+    copy() # touch the pages first
+    start = time.time()
+    copies = 0
+    while time.time()-start < seconds:
+        copy()
+        copies += 1
+    return {'copy_mb_s': int(copies*size_mb/(time.time()-start)), 'method': method}
+
+def _drop_cache(fd):
+    """
+    Ask the kernel to drop the cached pages of the file; False if it cannot
+    """
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        return True
+    except (AttributeError, OSError):
+        return False
+
+def _percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values)-1, int(len(values)*pct/100.))]
+
+def bench_fsync(folder, count=50):
+    """
+    Latency in ms of a 4 kB write followed by fsync, as for each commit of PostgreSQL
+    """
+    fname = os.path.join(folder, '.wadqc_probe_fsync')
+    block = os.urandom(4096)
+    latencies = []
+    fd = os.open(fname, os.O_WRONLY|os.O_CREAT|os.O_TRUNC, 0o600)
+    try:
+        for i in range(count):
+            start = time.time()
+            os.write(fd, block)
+            os.fsync(fd)
+            latencies.append(1000.*(time.time()-start))
+    finally:
+        os.close(fd)
+        os.remove(fname)
+    return {'median_ms': round(_percentile(latencies, 50), 3), 'p99_ms': round(_percentile(latencies, 99), 3)}
+
+def bench_io(folder, size_mb=256, seconds=2.):
+    """
+    Sequential write and read in MB/s, and random 4 kB reads and synchronous writes per second, on a scratch file in folder
+    """
+    fname = os.path.join(folder, '.wadqc_probe_io')
+    blocksize = 1024*1024
+    block = os.urandom(blocksize)
+    result = {'size_mb': size_mb}
+
+    fd = os.open(fname, os.O_RDWR|os.O_CREAT|os.O_TRUNC, 0o600)
+    try:
+        start = time.time()
+        for i in range(size_mb):
+            os.write(fd, block)
+        os.fsync(fd)
+        result['seq_write_mb_s'] = int(size_mb/(time.time()-start))
+
+        # without dropping the cache, the reads measure memory instead of the disk
+        result['cache_dropped'] = _drop_cache(fd)
+        os.lseek(fd, 0, os.SEEK_SET)
+        start = time.time()
+        while len(os.read(fd, blocksize)) > 0:
+            pass
+        result['seq_read_mb_s'] = int(size_mb/(time.time()-start))
+
+        nblocks = size_mb*256
+        _drop_cache(fd)
+        start = time.time()
+        reads = 0
+        while time.time()-start < seconds:
+            os.lseek(fd, random.randrange(nblocks)*4096, os.SEEK_SET)
+            os.read(fd, 4096)
+            reads += 1
+        result['rand_read_iops'] = int(reads/(time.time()-start))
+
+        # each write waits for the disk (O_DSYNC), else they only fill the page cache
+        small = block[:4096]
+        syncfd = os.open(fname, os.O_WRONLY|getattr(os, 'O_DSYNC', os.O_SYNC))
+        try:
+            start = time.time()
+            writes = 0
+            while time.time()-start < seconds:
+                os.lseek(syncfd, random.randrange(nblocks)*4096, os.SEEK_SET)
+                os.write(syncfd, small)
+                writes += 1
+            result['rand_write_iops'] = int(writes/(time.time()-start))
+        finally:
+            os.close(syncfd)
+    finally:
+        os.close(fd)
+        os.remove(fname)
+
+    return result
+
+def probe_host(installation_root, **kwargs):
+    """
+    Run the benchmarks on the filesystem of installation_root and store the results in WAD_QC/hostprobe.json.
+      probe_size_mb: size of the scratch file for the I/O benchmarks [256]
+      probe_seconds: duration of each timed benchmark [2]
+    """
+    logger.info('Probing the capacity of this host...')
+    result, msg = ("OK", "")
+
+    folder = os.path.join(installation_root, 'WAD_QC')
+    try:
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+    except OSError as e:
+        return "ERROR", "Cannot create {} for the host probe. {}".format(folder, str(e))
+
+    seconds = float(kwargs.get('probe_seconds', 2))
+    probe = {
+        'version': __version__,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'folder': folder,
+        'host': host_resources(),
+    }
+    try:
+        probe['cpu'] = bench_cpu(seconds/2.)
+        logger.info('...cpu: {} loops/s on one core, scaling {} over {} cpus'.format(
+            probe['cpu']['single_loops_s'], probe['cpu']['scaling'], probe['cpu']['cpus']))
+        probe['memory'] = bench_memory(seconds=seconds/2.)
+        logger.info('...memory: {} MB/s copy ({})'.format(probe['memory']['copy_mb_s'], probe['memory']['method']))
+        probe['fsync'] = bench_fsync(folder)
+        logger.info('...fsync: {} ms median, {} ms p99'.format(probe['fsync']['median_ms'], probe['fsync']['p99_ms']))
+        probe['io'] = bench_io(folder, int(kwargs.get('probe_size_mb', 256)), seconds)
+        logger.info('...I/O: {} MB/s write, {} MB/s read, {} random reads/s, {} random synchronous writes/s'.format(
+            probe['io']['seq_write_mb_s'], probe['io']['seq_read_mb_s'], probe['io']['rand_read_iops'], probe['io']['rand_write_iops']))
+        if not probe['io']['cache_dropped']:
+            logger.warning('...I/O: cannot drop the page cache; the read results are too optimistic')
+    except (IOError, OSError) as e:
+        return "ERROR", "Host probe failed. {}".format(str(e))
+
+    dest = os.path.join(installation_root, PROBEFILE)
+    with open(dest, 'w') as fout:
+        json.dump(probe, fout, indent=2, sort_keys=True)
+    logger.info('...host probe written to {}'.format(dest))
+
+    return result, msg
+
+def load_probe(installation_root):
+    """
+    The stored probe of installation_root, or None
+    """
+    fname = os.path.join(installation_root, PROBEFILE)
+    if not os.path.exists(fname):
+        return None
+    try:
+        with open(fname) as f:
+            return json.load(f)
+    except (IOError, ValueError) as e:
+        logger.warning('...cannot read host probe {}: {}'.format(fname, str(e)))
+        return None
+
+#----sizing; each returns (value, reason)
+def _clamp(val, low, high):
+    return max(low, min(high, val))
+
+def _ui_cpus(ncpus):
+    """
+    The cpus left for ingest, database and sites next to the analyses
+    """
+    return max(1, ncpus-len(analysis_cpus(ncpus)) if ncpus >= 4 else ncpus)
+
+def disk_class(probe):
+    if probe['io']['rand_read_iops'] >= SSD_MIN_RANDOM_IOPS and probe['fsync']['median_ms'] <= SSD_MAX_FSYNC_MS:
+        return 'ssd'
+    return 'hdd'
+
+def _size_workers(probe):
+    ncpus = probe['host']['cpus']
+    cpus = len(analysis_cpus(ncpus))
+    by_cpu = max(1, int(cpus*min(1., probe['cpu']['scaling'])+.5))
+    reason = '{} analysis cpus at scaling {}'.format(cpus, probe['cpu']['scaling'])
+    if probe['host']['mem_mb'] is None:
+        return by_cpu, reason
+    # analyses may use up to MemoryHigh of wadprocessor; count 1 GB per analysis
+    by_mem = max(1, int(probe['host']['mem_mb']*ANALYSIS_MEMORY_HIGH/1024))
+    if by_mem < by_cpu:
+        return by_mem, '1 GB per analysis in {:.0%} of {} MB; {} gives {}'.format(ANALYSIS_MEMORY_HIGH, probe['host']['mem_mb'], reason, by_cpu)
+    return by_cpu, reason
+
+def _size_uwsgi_processes(probe):
+    # the sites mostly wait on PostgreSQL and Orthanc, so two processes per cpu left next to the analyses
+    cpus = _ui_cpus(probe['host']['cpus'])
+    processes = _clamp(2*cpus, 2, 8)
+    reason = '2 per cpu for ingest and sites ({}), between 2 and 8'.format(cpus)
+    if not probe['host']['mem_mb'] is None:
+        # about 100 MB per process for three sites in 10% of the memory
+        by_mem = max(2, int(probe['host']['mem_mb']*0.1/(3*100)))
+        if by_mem < processes:
+            return by_mem, '100 MB per process for 3 sites in 10% of {} MB; {} gives {}'.format(probe['host']['mem_mb'], reason, processes)
+    return processes, reason
+
+def _size_wsgi_threads(probe):
+    # one mod_wsgi process per site; its threads mostly wait on PostgreSQL and Orthanc
+    cpus = _ui_cpus(probe['host']['cpus'])
+    return _clamp(2*cpus+1, 5, 15), '2 per cpu for ingest and sites ({}) plus 1, between 5 and 15'.format(cpus)
+
+def _size_postgresql(probe):
+    settings = {}
+    reasons = []
+    mem_mb = probe['host']['mem_mb']
+    if not mem_mb is None:
+        settings['shared_buffers'] = '{}MB'.format(_clamp(mem_mb//4, 128, 8192))
+        settings['effective_cache_size'] = '{}MB'.format(max(256, mem_mb//2))
+        settings['maintenance_work_mem'] = '{}MB'.format(_clamp(mem_mb//20, 64, 1024))
+        settings['work_mem'] = '{}MB'.format(_clamp(mem_mb//256, 4, 64))
+        reasons.append('memory {} MB: shared_buffers 25% (128MB-8GB), effective_cache_size 50%, '
+                       'maintenance_work_mem 5% (64MB-1GB), work_mem 1/256 (4-64MB)'.format(mem_mb))
+    disk = disk_class(probe)
+    if disk == 'ssd':
+        settings['random_page_cost'] = 1.1
+        settings['effective_io_concurrency'] = 200
+    else:
+        settings['random_page_cost'] = 4.0
+        settings['effective_io_concurrency'] = 2
+    reasons.append('{}: {} random reads/s, fsync {} ms'.format(disk, probe['io']['rand_read_iops'], probe['fsync']['median_ms']))
+    if probe['fsync']['median_ms'] > 10:
+        logger.warning('...fsync takes {} ms on {}; every commit of PostgreSQL waits for it'.format(
+            probe['fsync']['median_ms'], probe['folder']))
+    return settings, '; '.join(reasons)
+
+SIZERS = {
+    'workers': _size_workers,
+    'uwsgi_processes': _size_uwsgi_processes,
+    'wsgi_threads': _size_wsgi_threads,
+    'postgresql': _size_postgresql,
+}
+
+def recommend(name, installation_root, default, override=None):
+    """
+    Size of setting name (workers, uwsgi_processes, wsgi_threads, postgresql) for this host.
+    A value given in the recipe (override) wins; without a host probe the template default is kept.
+    The choice is logged with its reason.
+    """
+    if not override is None:
+        logger.info('...{} = {}: set in recipe'.format(name, override))
+        return override
+
+    probe = load_probe(installation_root)
+    if probe is None:
+        logger.info('...{} = {}: default, no host probe (run probe_host first)'.format(name, default))
+        return default
+
+    try:
+        value, reason = SIZERS[name](probe)
+    except KeyError as e:
+        logger.warning('...{} = {}: default, host probe lacks {}'.format(name, default, str(e)))
+        return default
+    logger.info('...{} = {}: {} (host probe of {})'.format(name, value, reason, probe['time']))
+    return value
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Probe the capacity of this host for WAD-QC')
+    parser.add_argument('-r', '--root',
+                        default=os.environ.get('WADROOT', None),
+                        help='WADROOT; the I/O is probed on its filesystem [$WADROOT].',
+                        dest='root')
+    parser.add_argument('--show',
+                        default=False, action='store_true',
+                        help='only show the recommendations of the stored probe.',
+                        dest='show')
+    parser.add_argument('--size',
+                        default=256, type=int,
+                        help='size in MB of the scratch file for the I/O probe [256].',
+                        dest='size')
+
+    args = parser.parse_args()
+    if args.root is None:
+        parser.print_help()
+        sys.exit(2)
+
+    logging.basicConfig(format='%(message)s', level=logging.INFO)
+    root = os.path.abspath(os.path.expanduser(args.root))
+    if not args.show:
+        result, msg = probe_host(root, probe_size_mb=args.size)
+        if result == "ERROR":
+            print(msg, file=sys.stderr)
+            sys.exit(1)
+    for name in sorted(SIZERS.keys()):
+        recommend(name, root, None)
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+__version__ = '20261019'
+
+"""
+Import-time profiles of the WAD-QC web apps.
+
+Every uwsgi master or mod_wsgi daemon imports the full wad_admin/wad_dashboard/wad_api app
+before it can serve a request. This records how long that takes with python -X importtime,
+using the interpreter of the virtualenv the sites run in, and writes for each site
+  WADROOT/WAD_QC/importtime/<site>_<timestamp>.txt   raw -X importtime output
+  WADROOT/WAD_QC/importtime/<site>_<timestamp>.json  summary: total and slowest modules
+so later deployments can be compared against this baseline.
+
+Usage:
+  python -m scripts.importtime <site>_<timestamp>.txt                  # summary of a raw profile
+  python -m scripts.importtime --compare old.json new.json            # compare two summaries
+
+Changelog:
+ 20261019: initial version
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import logging
+
+try:
+    from .defaults import LOGGERNAME
+except:
+    from defaults import LOGGERNAME
+logger = logging.getLogger(LOGGERNAME)
+
+# modules imported by the wsgi entry point of each site
+APP_MODULES = {
+    'wad_admin': ['wad_admin.run', 'wad_admin.app'],
+    'wad_dashboard': ['wad_dashboard.run', 'wad_dashboard.app'],
+    'wad_api': ['wad_api.run', 'wad_api.app'],
+}
+
+def profile_imports(python, modules, wadroot, timeout=300):
+    """
+    Import modules in a fresh interpreter with -X importtime; returns the raw profile (stderr)
+    """
+    env = dict(os.environ)
+    env['WADROOT'] = wadroot
+    env.pop('PYTHONPATH', None) # profile what the site sees, not what wad_setup sees
+    cmd = [python, '-X', 'importtime', '-c', 'import {}'.format(', '.join(modules))]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+    try:
+        output, error = proc.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.communicate()
+        raise RuntimeError('importing {} took longer than {} s'.format(', '.join(modules), timeout))
+
+    error = error.decode('utf-8', 'replace')
+    if proc.returncode:
+        # last lines hold the traceback
+        raise RuntimeError('importing {} failed: {}'.format(', '.join(modules), '\n'.join(error.splitlines()[-5:])))
+    return error
+
+def parse_importtime(text):
+    """
+    Parse -X importtime output into a list of dicts with module, depth, self_us and cumulative_us
+    """
+    entries = []
+    for line in text.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        parts = line[len('import time:'):].split('|')
+        if len(parts) != 3:
+            continue
+        try:
+            self_us, cumulative_us = int(parts[0]), int(parts[1])
+        except ValueError: # header line
+            continue
+        name = parts[2].rstrip()
+        depth = (len(name)-len(name.lstrip())-1)//2
+        entries.append({'module': name.strip(), 'depth': depth, 'self_us': self_us, 'cumulative_us': cumulative_us})
+    return entries
+
+def summarize(entries, top=25):
+    """
+    Total import time and the slowest modules, by cumulative and by self time
+    """
+    toplevel = [e for e in entries if e['depth'] == 0]
+    return {
+        'total_us': sum(e['cumulative_us'] for e in toplevel),
+        'modules': len(entries),
+        'slowest_cumulative': sorted(toplevel, key=lambda e: -e['cumulative_us'])[:top],
+        'slowest_self': sorted(entries, key=lambda e: -e['self_us'])[:top],
+    }
+
+def format_summary(summary, top=10):
+    lines = ['total {:.1f} ms for {} modules'.format(summary['total_us']/1000., summary['modules'])]
+    lines.append('  slowest packages (cumulative):')
+    for e in summary['slowest_cumulative'][:top]:
+        lines.append('    {:>10.1f} ms  {}'.format(e['cumulative_us']/1000., e['module']))
+    lines.append('  slowest modules (self):')
+    for e in summary['slowest_self'][:top]:
+        lines.append('    {:>10.1f} ms  {}'.format(e['self_us']/1000., e['module']))
+    return '\n'.join(lines)
+
+def compare_summaries(old, new):
+    """
+    Per site change in total import time between two summaries
+    """
+    lines = []
+    for site in sorted(set(old.keys()) | set(new.keys())):
+        if not site in old or not site in new:
+            lines.append('{:<15} only in {}'.format(site, 'old' if site in old else 'new'))
+            continue
+        t_old = old[site]['total_us']/1000.
+        t_new = new[site]['total_us']/1000.
+        change = 100.*(t_new-t_old)/t_old if t_old > 0 else 0.
+        lines.append('{:<15} {:>10.1f} ms -> {:>10.1f} ms ({:+.1f}%)'.format(site, t_old, t_new, change))
+    return '\n'.join(lines)
+
+def record_importtime(sitelist, installation_root, **kwargs):
+    """
+    Record the import-time profile of each site in sitelist as a deployment artifact.
+    Uses the python of the virtualenv if given, else the python running wad_setup.
+    """
+    result, msg = ('OK', '')
+
+    if sys.version_info < (3, 7):
+        return 'ERROR', '-X importtime needs python 3.7 or later'
+
+    if not "virtualenv" in kwargs.keys() or kwargs['virtualenv'].strip() == "":
+        python = sys.executable
+    else:
+        python = os.path.join(os.path.abspath(os.path.expanduser(kwargs['virtualenv'])), 'python')
+
+    wadroot = os.path.abspath(os.path.expanduser(installation_root))
+    outfolder = os.path.join(wadroot, 'WAD_QC', 'importtime')
+    if not os.path.exists(outfolder):
+        os.makedirs(outfolder)
+    stamp = time.strftime('%Y%m%d_%H%M%S')
+
+    written = []
+    for site in sitelist:
+        if not site in APP_MODULES:
+            continue
+        try:
+            raw = profile_imports(python, APP_MODULES[site], wadroot, timeout=float(kwargs.get('importtime_timeout', 300)))
+        except (OSError, RuntimeError) as e:
+            return 'ERROR', 'Could not record the import time of {}. {}'.format(site, str(e))
+
+        summary = summarize(parse_importtime(raw))
+        summary['python'] = python
+        dest = os.path.join(outfolder, '{}_{}'.format(site, stamp))
+        with open(dest+'.txt', 'w') as f:
+            f.write(raw)
+        with open(dest+'.json', 'w') as f:
+            json.dump(summary, f, indent=2)
+        written.append(dest+'.json')
+        logger.info('Import time of {}: {}'.format(site, format_summary(summary)))
+
+    msg = 'Import time profiles written to {}'.format(', '.join(written))
+    return result, msg
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Summarize or compare import-time profiles of the WAD-QC sites')
+    parser.add_argument('profiles',
+                        nargs='*',
+                        help='raw -X importtime output files to summarize.')
+    parser.add_argument('--compare',
+                        nargs=2,
+                        default=None,
+                        metavar=('OLD', 'NEW'),
+                        help='compare two json summaries, or two folders with json summaries of the same sites.',
+                        dest='compare')
+    parser.add_argument('-n', '--top',
+                        default=10,
+                        type=int,
+                        help='number of slowest modules to show [10].',
+                        dest='top')
+
+    args = parser.parse_args()
+    if not args.compare is None:
+        summaries = []
+        for src in args.compare:
+            if os.path.isdir(src):
+                # latest summary of each site in the folder
+                found = {}
+                for fname in sorted(os.listdir(src)):
+                    if fname.endswith('.json'):
+                        found[fname.rsplit('_', 2)[0]] = os.path.join(src, fname)
+            else:
+                found = {os.path.basename(src).rsplit('_', 2)[0]: src}
+            data = {}
+            for site, fname in found.items():
+                with open(fname) as f:
+                    data[site] = json.load(f)
+            summaries.append(data)
+        print(compare_summaries(summaries[0], summaries[1]))
+        sys.exit(0)
+
+    if len(args.profiles) == 0:
+        parser.print_help()
+        sys.exit(1)
+
+    for fname in args.profiles:
+        with open(fname) as f:
+            print('{}: {}'.format(fname, format_summary(summarize(parse_importtime(f.read())), top=args.top)))
@@ -0,0 +1,472 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+__version__ = '20261019'
+
+"""
+Load generator for the deployed WAD-QC web sites (wad_admin, wad_dashboard, wad_api).
+
+The sites and ports are taken from the sitelist/portlist of the *_deploy_sites action
+in a recipe, so the same run works for apache2, httpd and nginx+uwsgi deployments.
+Each site is loaded in turn with a weighted mix of requests at a fixed concurrency,
+and throughput and latency percentiles are reported per route. The report is written
+as json, so runs (e.g. apache2 vs nginx on the same hardware) can be compared with --compare.
+
+Only the standard library is used (asyncio); no external load generators or services.
+
+Run from the wad_setup folder:
+  python -m scripts.loadtest -r recipes/Lin64_Ubuntu1804_apt_virt_nginx.json -c 20 -d 60 -o nginx.json
+  python -m scripts.loadtest --compare apache2.json nginx.json
+
+Changelog:
+ 20261019: initial version
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import logging
+
+try:
+    from .defaults import LOGGERNAME
+    from .database_setup import get_dict_from_jsonfile
+except:
+    from defaults import LOGGERNAME
+    from database_setup import get_dict_from_jsonfile
+
+logger = logging.getLogger(LOGGERNAME)
+
+# actions in a recipe that deploy sites, and the web stack they deploy
+DEPLOY_ACTIONS = {
+    'apache2_deploy_sites': 'apache2',
+    'httpd_deploy_sites': 'httpd',
+    'nginx_deploy_sites': 'nginx',
+}
+
+# default request mix per site (only routes that do not need a login), shipped with the recipes
+DEFAULT_MIXFILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'recipes', 'loadtest_mix.json')
+
+PERCENTILES = [50, 90, 95, 99]
+
+def discover_sites(recipefile):
+    """
+    Find the deployed sites and their ports in the given recipe.
+    Returns the web stack name and a list of (site, port)
+    """
+    setup = get_dict_from_jsonfile(recipefile)
+    for act in setup.get('actions', []):
+        if act.get('cmd') in DEPLOY_ACTIONS:
+            kwargs = act.get('kwargs', {})
+            sites = list(zip(kwargs['sitelist'], [int(p) for p in kwargs['portlist']]))
+            return DEPLOY_ACTIONS[act['cmd']], sites
+
+    raise ValueError('Recipe "{}" does not deploy any sites.'.format(recipefile))
+
+def load_mixes(mixfile=None):
+    """
+    Return the request mixes; a json mixfile overrides the default mix per site
+    """
+    mixes = get_dict_from_jsonfile(DEFAULT_MIXFILE)
+    if not mixfile is None:
+        mixes.update(get_dict_from_jsonfile(mixfile))
+
+    for site, mix in mixes.items():
+        for route in mix:
+            route.setdefault('method', 'GET')
+            route.setdefault('weight', 1)
+    return mixes
+
+def percentile(sorted_values, pct):
+    # nearest-rank percentile of an already sorted list
+    if len(sorted_values) == 0:
+        return None
+    rank = int(round(pct/100.*len(sorted_values)+.5))
+    return sorted_values[min(max(rank, 1), len(sorted_values))-1]
+
+class HttpConnection(object):
+    """
+    Minimal keep-alive HTTP/1.1 client connection on asyncio streams.
+    """
+    def __init__(self, host, port, timeout):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+
+    def close(self):
+        if not self.writer is None:
+            self.writer.close()
+        self.reader = None
+        self.writer = None
+
+    async def request(self, method, path, body=None):
+        """
+        Send one request and read the full response. Returns (status, nbytes)
+        """
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port), self.timeout)
+
+        lines = [
+            '{} {} HTTP/1.1'.format(method, path),
+            'Host: {}:{}'.format(self.host, self.port),
+            'User-Agent: wad_loadtest/{}'.format(__version__),
+            'Accept: */*',
+            'Connection: keep-alive',
+        ]
+        payload = b''
+        if not body is None:
+            payload = json.dumps(body).encode('utf-8')
+            lines.append('Content-Type: application/json')
+        if not body is None or method in ['POST', 'PUT']:
+            lines.append('Content-Length: {}'.format(len(payload)))
+
+        self.writer.write(('\r\n'.join(lines)+'\r\n\r\n').encode('latin-1')+payload)
+        await self.writer.drain()
+
+        status, nbytes, keep_alive = await asyncio.wait_for(self._read_response(method), self.timeout)
+        if not keep_alive:
+            self.close()
+        return status, nbytes
+
+    async def _read_response(self, method):
+        statusline = await self.reader.readline()
+        if not statusline:
+            raise ConnectionError('connection closed by server')
+        version, status = statusline.decode('latin-1').split(None, 2)[:2]
+        status = int(status)
+
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in [b'\r\n', b'\n', b'']:
+                break
+            key, _, value = line.decode('latin-1').partition(':')
+            headers[key.strip().lower()] = value.strip().lower()
+
+        keep_alive = version == 'HTTP/1.1' and not headers.get('connection') == 'close'
+        nbytes = 0
+        if method == 'HEAD' or status in [204, 304] or status < 200:
+            pass
+        elif headers.get('transfer-encoding', '') == 'chunked':
+            while True:
+                size = int((await self.reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    # skip trailers
+                    while not (await self.reader.readline()) in [b'\r\n', b'\n', b'']:
+                        pass
+                    break
+                nbytes += len(await self.reader.readexactly(size+2))-2
+        elif 'content-length' in headers:
+            nbytes = len(await self.reader.readexactly(int(headers['content-length'])))
+        else:
+            nbytes = len(await self.reader.read())
+            keep_alive = False
+
+        return status, nbytes, keep_alive
+
+class RouteStats(object):
+    """
+    Collects the outcome of all requests to one route
+    """
+    def __init__(self, method, path):
+        self.method = method
+        self.path = path
+        self.latencies = []
+        self.statuses = {}
+        self.errors = {}
+        self.nbytes = 0
+
+    def add(self, latency, status=None, nbytes=0, error=None):
+        if error is None:
+            self.latencies.append(latency)
+            self.statuses[str(status)] = self.statuses.get(str(status), 0)+1
+            self.nbytes += nbytes
+        else:
+            self.errors[error] = self.errors.get(error, 0)+1
+
+    def report(self, elapsed):
+        lat = sorted(self.latencies)
+        result = {
+            'method': self.method,
+            'path': self.path,
+            'requests': len(lat),
+            'errors': sum(self.errors.values()),
+            'error_types': self.errors,
+            'status': self.statuses,
+            'throughput_rps': len(lat)/elapsed if elapsed>0 else 0.,
+            'bytes': self.nbytes,
+            'latency_ms': {
+                'mean': 1000.*sum(lat)/len(lat) if len(lat)>0 else None,
+                'min': 1000.*lat[0] if len(lat)>0 else None,
+                'max': 1000.*lat[-1] if len(lat)>0 else None,
+            }
+        }
+        for pct in PERCENTILES:
+            val = percentile(lat, pct)
+            result['latency_ms']['p{}'.format(pct)] = None if val is None else 1000.*val
+        return result
+
+async def _worker(host, port, mix, stats, deadline, budget, timeout, rng):
+    conn = HttpConnection(host, port, timeout)
+    weights = [route['weight'] for route in mix]
+    total = float(sum(weights))
+    try:
+        while time.time() < deadline:
+            if not budget is None:
+                if budget[0] <= 0:
+                    break
+                budget[0] -= 1
+
+            # weighted choice of the next route
+            pick = rng.random()*total
+            for idx, w in enumerate(weights):
+                pick -= w
+                if pick < 0:
+                    break
+            route = mix[idx]
+
+            t0 = time.perf_counter()
+            try:
+                status, nbytes = await conn.request(route['method'], route['path'], route.get('body', None))
+                stats[idx].add(time.perf_counter()-t0, status=status, nbytes=nbytes)
+            except (OSError, ValueError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+                stats[idx].add(time.perf_counter()-t0, error=type(e).__name__)
+                conn.close()
+    finally:
+        conn.close()
+
+async def _load_site(host, port, mix, concurrency, duration, requests, timeout, seed):
+    stats = [RouteStats(route['method'], route['path']) for route in mix]
+    budget = None if requests is None else [int(requests)]
+    deadline = time.time()+duration
+    t0 = time.perf_counter()
+    await asyncio.gather(*[
+        _worker(host, port, mix, stats, deadline, budget, timeout, random.Random(seed+i))
+        for i in range(concurrency)])
+    return stats, time.perf_counter()-t0
+
+def load_site(host, port, mix, concurrency=10, duration=30, requests=None, timeout=30, seed=0):
+    """
+    Replay the request mix against one site. Returns the report for this site
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        stats, elapsed = loop.run_until_complete(
+            _load_site(host, port, mix, concurrency, duration, requests, timeout, seed))
+    finally:
+        loop.close()
+
+    routes = [s.report(elapsed) for s in stats]
+    all_lat = sorted(l for s in stats for l in s.latencies)
+    nreq = len(all_lat)
+    total = {
+        'requests': nreq,
+        'errors': sum(r['errors'] for r in routes),
+        'elapsed_s': elapsed,
+        'throughput_rps': nreq/elapsed if elapsed>0 else 0.,
+        'latency_ms': {}
+    }
+    for pct in PERCENTILES:
+        val = percentile(all_lat, pct)
+        total['latency_ms']['p{}'.format(pct)] = None if val is None else 1000.*val
+
+    return {'port': port, 'routes': routes, 'total': total}
+
+def run_load_test(sites, host='localhost', concurrency=10, duration=30, requests=None,
+                  timeout=30, mixfile=None, stack=None, seed=0):
+    """
+    Load all given (site, port) pairs in turn. Returns the full report as a dict
+    """
+    mixes = load_mixes(mixfile)
+    report = {
+        'version': __version__,
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'stack': stack,
+        'host': host,
+        'concurrency': concurrency,
+        'duration_s': duration,
+        'requests': requests,
+        'sites': {}
+    }
+    for site, port in sites:
+        if not site in mixes:
+            logger.warning('No request mix defined for site {}. Skipping.'.format(site))
+            continue
+        logger.info('...loading {} on {}:{} with concurrency {}...'.format(site, host, port, concurrency))
+        report['sites'][site] = load_site(host, port, mixes[site], concurrency=concurrency,
+                                          duration=duration, requests=requests, timeout=timeout, seed=seed)
+        report['sites'][site]['mix'] = mixes[site]
+    return report
+
+def format_report(report):
+    """
+    Human readable table of a report
+    """
+    lines = ['Stack: {}  host: {}  concurrency: {}  started: {}'.format(
+        report.get('stack'), report.get('host'), report.get('concurrency'), report.get('started'))]
+    fmt = '  {:<6} {:<36} {:>8} {:>7} {:>9} {:>9} {:>9} {:>9}'
+    for site, data in sorted(report['sites'].items()):
+        lines.append('{} (port {}): {:.1f} req/s, {} requests, {} errors'.format(
+            site, data['port'], data['total']['throughput_rps'], data['total']['requests'], data['total']['errors']))
+        lines.append(fmt.format('method', 'path', 'req/s', 'errors', 'p50 ms', 'p90 ms', 'p95 ms', 'p99 ms'))
+        for r in data['routes']:
+            lat = r['latency_ms']
+            lines.append(fmt.format(r['method'], r['path'], '{:.1f}'.format(r['throughput_rps']), r['errors'],
+                                    *['-' if lat[p] is None else '{:.1f}'.format(lat[p]) for p in ['p50', 'p90', 'p95', 'p99']]))
+    return '\n'.join(lines)
+
+def compare_reports(base, other):
+    """
+    Human readable comparison of two reports, per site and route
+    """
+    lines = ['Comparing {} ({}) with {} ({})'.format(
+        base.get('stack'), base.get('started'), other.get('stack'), other.get('started'))]
+    fmt = '  {:<6} {:<36} {:>12} {:>12} {:>14} {:>14}'
+    for site in sorted(set(base['sites']) & set(other['sites'])):
+        lines.append(site)
+        lines.append(fmt.format('method', 'path', 'req/s base', 'req/s other', 'p95 ms base', 'p95 ms other'))
+        others = {(r['method'], r['path']): r for r in other['sites'][site]['routes']}
+        for r in base['sites'][site]['routes']:
+            o = others.get((r['method'], r['path']))
+            if o is None:
+                continue
+            lines.append(fmt.format(r['method'], r['path'],
+                                    '{:.1f}'.format(r['throughput_rps']), '{:.1f}'.format(o['throughput_rps']),
+                                    '-' if r['latency_ms']['p95'] is None else '{:.1f}'.format(r['latency_ms']['p95']),
+                                    '-' if o['latency_ms']['p95'] is None else '{:.1f}'.format(o['latency_ms']['p95'])))
+    return '\n'.join(lines)
+
+def load_test(**kwargs):
+    """
+    Entry point for the load_test action. Sites and ports are taken from the action kwargs,
+    or else from the *_deploy_sites action in the running recipe.
+    """
+    result, msg = ('OK', '')
+
+    stack = kwargs.get('stack', None)
+    if 'sitelist' in kwargs and 'portlist' in kwargs:
+        sites = list(zip(kwargs['sitelist'], [int(p) for p in kwargs['portlist']]))
+    else:
+        try:
+            stack, sites = discover_sites(kwargs['__recipe_path'])
+        except Exception as e:
+            return 'ERROR', 'Cannot find sites to load test. {}'.format(str(e))
+
+    report = run_load_test(sites, host=kwargs.get('host', 'localhost'),
+                           concurrency=int(kwargs.get('concurrency', 10)),
+                           duration=float(kwargs.get('duration', 30)),
+                           requests=kwargs.get('requests', None),
+                           timeout=float(kwargs.get('timeout', 30)),
+                           mixfile=kwargs.get('mixfile', None),
+                           stack=stack)
+
+    outfile = kwargs.get('outfile', None)
+    if outfile is None:
+        outfile = os.path.join(kwargs['installation_root'], 'WAD_QC', 'loadtest',
+                               'loadtest_{}_{}.json'.format(stack, time.strftime('%Y%m%d_%H%M%S')))
+    outfolder = os.path.dirname(os.path.abspath(outfile))
+    if not os.path.exists(outfolder):
+        os.makedirs(outfolder)
+    with open(outfile, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    logger.info('Load test results:\n{}'.format(format_report(report)))
+    msg = 'Load test report written to {}'.format(outfile)
+    return result, msg
+
+if __name__ == "__main__":
+    recipefile = None
+    host = 'localhost'
+    concurrency = 10
+    duration = 30.
+    timeout = 30.
+
+    parser = argparse.ArgumentParser(description='Load test the deployed WAD-QC sites')
+    parser.add_argument('-r', '--recipe',
+                        default=recipefile,
+                        type=str,
+                        help='the recipe used to deploy the sites; sites and ports are taken from it [{}].'.format(recipefile),
+                        dest='recipefile')
+    parser.add_argument('-s', '--sites',
+                        default=None,
+                        type=str,
+                        help='comma separated list of site:port to load instead of those from the recipe, e.g. wad_api:3000',
+                        dest='sites')
+    parser.add_argument('--host',
+                        default=host,
+                        type=str,
+                        help='host running the sites [{}].'.format(host),
+                        dest='host')
+    parser.add_argument('-c', '--concurrency',
+                        default=concurrency,
+                        type=int,
+                        help='number of concurrent connections per site [{}].'.format(concurrency),
+                        dest='concurrency')
+    parser.add_argument('-d', '--duration',
+                        default=duration,
+                        type=float,
+                        help='duration of the load per site in seconds [{}].'.format(duration),
+                        dest='duration')
+    parser.add_argument('-n', '--requests',
+                        default=None,
+                        type=int,
+                        help='stop after this many requests per site, even before duration is reached [None].',
+                        dest='requests')
+    parser.add_argument('-t', '--timeout',
+                        default=timeout,
+                        type=float,
+                        help='timeout of a single request in seconds [{}].'.format(timeout),
+                        dest='timeout')
+    parser.add_argument('-m', '--mix',
+                        default=None,
+                        type=str,
+                        help='json file with the request mix per site; overrides the mix of a site in recipes/loadtest_mix.json [None].',
+                        dest='mixfile')
+    parser.add_argument('-o', '--output',
+                        default=None,
+                        type=str,
+                        help='write the json report to this file [None].',
+                        dest='outfile')
+    parser.add_argument('--compare',
+                        default=None,
+                        nargs=2,
+                        type=str,
+                        help='compare two json reports instead of running a load test.',
+                        dest='compare')
+
+    args = parser.parse_args()
+
+    if not args.compare is None:
+        with open(args.compare[0]) as f:
+            base = json.load(f)
+        with open(args.compare[1]) as f:
+            other = json.load(f)
+        print(compare_reports(base, other))
+        sys.exit(0)
+
+    stack = None
+    if not args.sites is None:
+        sites = []
+        for sp in args.sites.split(','):
+            site, port = sp.strip().split(':')
+            sites.append((site, int(port)))
+    elif not args.recipefile is None:
+        stack, sites = discover_sites(args.recipefile)
+    else:
+        print('Error! loadtest needs --recipe or --sites. Exit.\n\n')
+        parser.print_help()
+        exit(False)
+
+    report = run_load_test(sites, host=args.host, concurrency=args.concurrency, duration=args.duration,
+                           requests=args.requests, timeout=args.timeout, mixfile=args.mixfile, stack=stack)
+    print(format_report(report))
+    if not args.outfile is None:
+        with open(args.outfile, 'w') as f:
+            json.dump(report, f, indent=2)
+        print('Report written to {}'.format(args.outfile))
@@ -0,0 +1,384 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+__version__ = '20261019'
+
+"""
+Maintenance jobs for the PostgreSQL cluster and storage of WAD-QC, run by the wadmaint-* systemd timers.
+
+  vacuum:  VACUUM (ANALYZE) of each database, so the planner statistics stay current and dead rows are reused
+  reindex: REINDEX of each database (CONCURRENTLY from PostgreSQL 12), to shrink bloated indexes
+  storage: size of the Orthanc storage and WAD_QC/Logs against their limits, and free space of their filesystems
+  retention: delete studies from Orthanc that WAD-QC has processed and that were not updated for --days days,
+             through the REST API in batches; studies with queued or failed processes, or of protected patients, stay
+
+Each run prints its duration and metrics (database and index size, live and dead rows, the tables with the
+most dead rows) to the journal, and appends them as one json line to <outdir>/<job>.jsonl, so the bloat can
+be followed over months. The exit status is not 0 if a job failed or a storage limit is exceeded, so the
+run shows up in "systemctl --failed".
+
+It is stand-alone (standard library only), because create_maintenance_timers installs it as
+WADROOT/WAD_QC/systemd/wad_maintenance. Passwords are read by psql from the file in PGPASSFILE.
+
+Usage:
+  wad_maintenance vacuum --db wadqc_db:wadqc --db orthanc_db:orthanc --port 5432
+  wad_maintenance reindex --db wadqc_db:wadqc --psql /usr/lib/postgresql/10/bin/psql
+  wad_maintenance storage --path ~/WADQC/orthanc/db:500G --path ~/WADQC/WAD_QC/Logs:2G --min-free 10
+  wad_maintenance retention --db wadqc_db:wadqc --orthanc http://localhost:8042 --credentials orthanc.cred --days 90 --dry-run
+
+Changelog:
+ 20261019: retention job
+ 20261019: initial version
+"""
+
+import os
+import sys
+import json
+import time
+import base64
+import argparse
+import subprocess
+
+try:
+    from urllib.request import urlopen, Request
+    from urllib.error import HTTPError, URLError
+except ImportError:
+    from urllib2 import urlopen, Request, HTTPError, URLError
+
+UNITS = {'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+
+def parse_size(text):
+    """
+    Bytes in a size like 500G, 2048M or 1000000
+    """
+    text = str(text).strip().upper().rstrip('B')
+    if len(text) > 0 and text[-1] in UNITS:
+        return int(float(text[:-1])*UNITS[text[-1]])
+    return int(text)
+
+def format_size(nbytes):
+    for unit in ['T', 'G', 'M', 'K']:
+        if abs(nbytes) >= UNITS[unit]:
+            return '{:.1f}{}'.format(float(nbytes)/UNITS[unit], unit)
+    return '{}'.format(nbytes)
+
+def psql(args, dbname, user, sql):
+    """
+    Run sql in dbname as user; returns the rows as lists of strings
+    """
+    cmd = [args.psql, '-h', args.host, '-p', str(args.port), '-U', user, '-d', dbname,
+           '-X', '-q', '-A', '-t', '-F', '|', '-v', 'ON_ERROR_STOP=1', '-c', sql]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output, error = proc.communicate()
+    if proc.returncode:
+        raise RuntimeError('{} failed in {}: {}'.format(sql.split()[0], dbname, error.decode('utf-8', 'replace').strip()))
+    return [line.split('|') for line in output.decode('utf-8', 'replace').splitlines() if line.strip()]
+
+def bloat_metrics(args, dbname, user, top=5):
+    """
+    Size of the database and its indexes, live and dead rows, and the tables with the most dead rows
+    """
+    row = psql(args, dbname, user,
+               'SELECT pg_database_size(current_database()), '
+               '(SELECT coalesce(sum(pg_relation_size(indexrelid)), 0) FROM pg_stat_user_indexes), '
+               '(SELECT coalesce(sum(n_live_tup), 0) FROM pg_stat_user_tables), '
+               '(SELECT coalesce(sum(n_dead_tup), 0) FROM pg_stat_user_tables);')[0]
+    metrics = {'db_bytes': int(row[0]), 'index_bytes': int(row[1]), 'live_rows': int(row[2]), 'dead_rows': int(row[3])}
+    metrics['dead_pct'] = round(100.*metrics['dead_rows']/max(1, metrics['live_rows']+metrics['dead_rows']), 1)
+    metrics['most_dead'] = [{'table': r[0], 'live_rows': int(r[1]), 'dead_rows': int(r[2])} for r in psql(args, dbname, user,
+        'SELECT relname, n_live_tup, n_dead_tup FROM pg_stat_user_tables WHERE n_dead_tup > 0 '
+        'ORDER BY n_dead_tup DESC LIMIT {};'.format(top))]
+    return metrics
+
+def format_metrics(m):
+    text = 'size {} indexes {} rows {} dead {} ({}%)'.format(
+        format_size(m['db_bytes']), format_size(m['index_bytes']), m['live_rows'], m['dead_rows'], m['dead_pct'])
+    if len(m.get('most_dead', [])) > 0:
+        text += '; most dead rows: {}'.format(', '.join(['{} {}'.format(t['table'], t['dead_rows']) for t in m['most_dead']]))
+    return text
+
+def run_database_job(args, sql_for):
+    """
+    Run the sql returned by sql_for(args, dbname, user) in each database, with the metrics before and after
+    """
+    records = []
+    for db in args.db:
+        dbname, user = db.split(':', 1) if ':' in db else (db, db)
+        record = {'db': dbname}
+        starttime = time.time()
+        try:
+            record['before'] = bloat_metrics(args, dbname, user)
+            print('{} {}: before: {}'.format(args.job, dbname, format_metrics(record['before'])))
+            psql(args, dbname, user, sql_for(args, dbname, user))
+            record['after'] = bloat_metrics(args, dbname, user)
+            print('{} {}: after: {}'.format(args.job, dbname, format_metrics(record['after'])))
+            record['result'] = 'OK'
+        except (OSError, RuntimeError) as e:
+            record['result'] = 'ERROR'
+            record['error'] = str(e)
+            print('{} {}: ERROR {}'.format(args.job, dbname, e), file=sys.stderr)
+        record['seconds'] = round(time.time()-starttime, 1)
+        print('{} {}: {} in {} s'.format(args.job, dbname, record['result'], record['seconds']))
+        records.append(record)
+    return records
+
+def vacuum_sql(args, dbname, user):
+    return 'VACUUM (ANALYZE);'
+
+def reindex_sql(args, dbname, user):
+    # CONCURRENTLY (PostgreSQL 12) does not block writes, so Orthanc can keep storing during the rebuild
+    version = int(psql(args, dbname, user, 'SHOW server_version_num;')[0][0])
+    # quoted as an identifier, so upper case and other characters are kept
+    return 'REINDEX DATABASE {}"{}";'.format('CONCURRENTLY ' if version >= 120000 else '', dbname.replace('"', '""'))
+
+def folder_size(folder):
+    """
+    Bytes on disk and number of files below folder
+    """
+    nbytes, nfiles = 0, 0
+    for root, dirs, files in os.walk(folder):
+        for fname in files:
+            try:
+                st = os.lstat(os.path.join(root, fname))
+            except OSError: # removed while walking
+                continue
+            nbytes += getattr(st, 'st_blocks', st.st_size//512)*512
+            nfiles += 1
+    return nbytes, nfiles
+
+def run_storage_job(args):
+    """
+    Size of each path against its limit, and the free space of its filesystem against min_free
+    """
+    records = []
+    for item in args.path:
+        path, limit = item.rsplit(':', 1) if ':' in item else (item, None)
+        path = os.path.abspath(os.path.expanduser(path))
+        record = {'path': path}
+        starttime = time.time()
+        if not os.path.isdir(path):
+            record['result'] = 'ERROR'
+            record['error'] = 'not a folder'
+            print('storage {}: ERROR not a folder'.format(path), file=sys.stderr)
+            records.append(record)
+            continue
+        record['bytes'], record['files'] = folder_size(path)
+        st = os.statvfs(path)
+        record['free_pct'] = round(100.*st.f_bavail/max(1, st.f_blocks), 1)
+        record['result'] = 'OK'
+        problems = []
+        if not limit is None:
+            record['limit_bytes'] = parse_size(limit)
+            if record['bytes'] > record['limit_bytes']:
+                problems.append('above limit {}'.format(format_size(record['limit_bytes'])))
+        if record['free_pct'] < args.min_free:
+            problems.append('only {}% free on its filesystem'.format(record['free_pct']))
+        if len(problems) > 0:
+            record['result'] = 'ERROR'
+            record['error'] = '; '.join(problems)
+        record['seconds'] = round(time.time()-starttime, 1)
+        print('storage {}: {} in {} files, {}% free{} ({} s)'.format(
+            path, format_size(record['bytes']), record['files'], record['free_pct'],
+            '' if len(problems) == 0 else ': '+record['error'], record['seconds']), file=sys.stderr if problems else sys.stdout)
+        records.append(record)
+    return records
+
+def orthanc(args, method, path):
+    """
+    Call the REST API of Orthanc; returns the decoded json answer
+    """
+    req = Request(args.orthanc.rstrip('/')+path)
+    req.get_method = lambda: method
+    if not args.auth is None:
+        req.add_header('Authorization', 'Basic {}'.format(base64.b64encode(args.auth.encode('utf-8')).decode('ascii')))
+    resp = urlopen(req, timeout=60)
+    try:
+        data = resp.read().decode('utf-8')
+    finally:
+        resp.close()
+    return json.loads(data) if data.strip() else None
+
+def processed_ids(args):
+    """
+    Orthanc ids of the data sets that WAD-QC finished (with results, or in the trash), and of those that still have
+    a process (queued, running or failed)
+    """
+    dbname, user = args.db[0].split(':', 1) if ':' in args.db[0] else (args.db[0], args.db[0])
+    done = set([r[0] for r in psql(args, dbname, user,
+        'SELECT d.data_id FROM dbdatasets d JOIN dbresults r ON r.data_set_id = d.id '
+        'UNION SELECT d.data_id FROM dbdatasets d JOIN dbdatatrash t ON t.data_set_id = d.id;')])
+    pending = set([r[0] for r in psql(args, dbname, user,
+        'SELECT DISTINCT d.data_id FROM dbdatasets d JOIN dbprocesses p ON p.data_set_id = d.id;')])
+    return done, pending
+
+def old_studies(args, cutoff, page=500):
+    """
+    Expanded Orthanc studies last updated before cutoff (YYYYMMDDTHHMMSS), oldest first
+    """
+    found = []
+    since = 0
+    while True:
+        studies = orthanc(args, 'GET', '/studies?expand&since={}&limit={}'.format(since, page))
+        found.extend([st for st in studies if st.get('LastUpdate', cutoff) < cutoff])
+        if len(studies) < page:
+            break
+        since += page
+    return sorted(found, key=lambda st: st['LastUpdate'])
+
+def run_retention_job(args):
+    """
+    Delete processed studies older than args.days in batches of args.batch, at most args.max_studies per run
+    """
+    starttime = time.time()
+    cutoff = time.strftime('%Y%m%dT%H%M%S', time.localtime(starttime-args.days*86400))
+    record = {'days': args.days, 'cutoff': cutoff, 'deleted': 0, 'reclaimed_bytes': 0, 'dry_run': args.dry_run,
+              'kept_pending': 0, 'kept_unprocessed': 0, 'kept_protected': 0}
+    try:
+        done, pending = processed_ids(args)
+        candidates = old_studies(args, cutoff)
+        record['old_studies'] = len(candidates)
+        protected = {}
+        todo = []
+        for st in candidates:
+            ids = [st['ID']]+st.get('Series', [])
+            if any([i in pending for i in ids]):
+                record['kept_pending'] += 1
+            elif not any([i in done for i in ids]):
+                record['kept_unprocessed'] += 1
+            else:
+                patient = st['ParentPatient']
+                if not patient in protected:
+                    protected[patient] = str(orthanc(args, 'GET', '/patients/{}/protected'.format(patient))) == '1'
+                if protected[patient]:
+                    record['kept_protected'] += 1
+                else:
+                    todo.append(st['ID'])
+        todo = todo[:args.max_studies]
+
+        for b in range(0, len(todo), args.batch):
+            for study in todo[b:b+args.batch]:
+                size = int(orthanc(args, 'GET', '/studies/{}/statistics'.format(study)).get('DiskSize', 0))
+                if not args.dry_run:
+                    orthanc(args, 'DELETE', '/studies/{}'.format(study))
+                record['deleted'] += 1
+                record['reclaimed_bytes'] += size
+            print('retention: {} {} of {} studies, {}'.format('would delete' if args.dry_run else 'deleted',
+                  record['deleted'], len(todo), format_size(record['reclaimed_bytes'])))
+            if b+args.batch < len(todo):
+                time.sleep(args.pause) # let Orthanc serve incoming studies between batches
+        record['result'] = 'OK'
+    except (OSError, RuntimeError, HTTPError, URLError, ValueError, KeyError) as e:
+        record['result'] = 'ERROR'
+        record['error'] = str(e)
+        print('retention: ERROR {}'.format(e), file=sys.stderr)
+
+    record['seconds'] = round(time.time()-starttime, 1)
+    print('retention: {} studies not updated since {}: {} {} ({}), kept {} with processes, {} unprocessed, '
+          '{} protected ({} s)'.format(record.get('old_studies', 0), cutoff, 'would delete' if args.dry_run else 'deleted',
+          record['deleted'], format_size(record['reclaimed_bytes']), record['kept_pending'], record['kept_unprocessed'],
+          record['kept_protected'], record['seconds']))
+    return [record]
+
+def append_records(outdir, job, records):
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    with open(os.path.join(outdir, '{}.jsonl'.format(job)), 'a') as f:
+        f.write(json.dumps({'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'job': job, 'records': records})+'\n')
+
+if __name__ == "__main__":
+    outdir = None
+    if 'WADROOT' in os.environ:
+        outdir = os.path.join(os.environ['WADROOT'], 'WAD_QC', 'maintenance')
+
+    parser = argparse.ArgumentParser(description='Maintenance jobs for the WAD-QC databases and storage')
+    parser.add_argument('job',
+                        choices=['vacuum', 'reindex', 'storage', 'retention'],
+                        help='job to run.')
+    parser.add_argument('--db',
+                        default=[], action='append',
+                        help='database:user to maintain; can be repeated.',
+                        dest='db')
+    parser.add_argument('--host',
+                        default='localhost', type=str,
+                        help='PostgreSQL host [localhost].',
+                        dest='host')
+    parser.add_argument('--port',
+                        default=5432, type=int,
+                        help='PostgreSQL port [5432].',
+                        dest='port')
+    parser.add_argument('--psql',
+                        default='psql', type=str,
+                        help='psql executable [psql].',
+                        dest='psql')
+    parser.add_argument('--path',
+                        default=[], action='append',
+                        help='folder[:limit] to check, e.g. /data/orthanc/db:500G; can be repeated.',
+                        dest='path')
+    parser.add_argument('--min-free',
+                        default=10., type=float,
+                        help='minimal free space in percent of the filesystem of each path [10].',
+                        dest='min_free')
+    parser.add_argument('--orthanc',
+                        default='http://localhost:8042', type=str,
+                        help='url of the REST API of Orthanc [http://localhost:8042].',
+                        dest='orthanc')
+    parser.add_argument('--credentials',
+                        default=None, type=str,
+                        help='file with user:password for the REST API of Orthanc [None].',
+                        dest='credentials')
+    parser.add_argument('--days',
+                        default=90, type=float,
+                        help='retention: delete processed studies not updated for this many days [90].',
+                        dest='days')
+    parser.add_argument('--batch',
+                        default=50, type=int,
+                        help='retention: studies deleted per batch [50].',
+                        dest='batch')
+    parser.add_argument('--pause',
+                        default=2., type=float,
+                        help='retention: seconds between batches [2].',
+                        dest='pause')
+    parser.add_argument('--max-studies',
+                        default=1000, type=int,
+                        help='retention: most studies deleted in one run [1000].',
+                        dest='max_studies')
+    parser.add_argument('--dry-run',
+                        default=False, action='store_true',
+                        help='retention: only report what would be deleted [False].',
+                        dest='dry_run')
+    parser.add_argument('-o', '--outdir',
+                        default=outdir, type=str,
+                        help='folder for the json lines with the metrics of each run [{}].'.format(outdir),
+                        dest='outdir')
+
+    args = parser.parse_args()
+    if args.job in ['vacuum', 'reindex', 'retention'] and len(args.db) == 0:
+        print('Error! No --db given. Exit.\n\n')
+        parser.print_help()
+        sys.exit(2)
+    if args.job == 'storage' and len(args.path) == 0:
+        print('Error! No --path given. Exit.\n\n')
+        parser.print_help()
+        sys.exit(2)
+
+    args.auth = None
+    if not args.credentials is None:
+        with open(args.credentials) as f:
+            args.auth = f.read().strip()
+
+    starttime = time.time()
+    if args.job == 'vacuum':
+        records = run_database_job(args, vacuum_sql)
+    elif args.job == 'reindex':
+        records = run_database_job(args, reindex_sql)
+    elif args.job == 'retention':
+        records = run_retention_job(args)
+    else:
+        records = run_storage_job(args)
+
+    if not args.outdir is None:
+        append_records(args.outdir, args.job, records)
+
+    failed = [r for r in records if not r['result'] == 'OK']
+    print('{}: {} of {} OK in {:.1f} s'.format(args.job, len(records)-len(failed), len(records), time.time()-starttime))
+    sys.exit(1 if len(failed) > 0 else 0)
@@ -4,7 +4,9 @@ import logging
 from .helpers import external_call, apt_install, yum_install, pip_install
 from .folders_settings import copy_replaces
 from .which import which
-from .systemd_setup import create_start_systemd
+from .systemd_setup import install_units
+from .importtime import record_importtime
+from .hostprobe import recommend
 from .defaults import LOGGERNAME
 logger = logging.getLogger(LOGGERNAME)
 
@@ -63,6 +65,67 @@ def enable_nginx(mode, **kwargs):
     
     return result, msg
 
+def _uwsgi_replaces(site, paths, processes=5, **kwargs):
+    """
+    helper function returning the replacements for the uwsgi ini of a site.
+    The virtualenv is set with home=, so the wsgi file does not need to activate it.
+    The number of worker processes is sized by the caller.
+    With socket activation, systemd owns the socket, so uwsgi must not remove it on exit (vacuum),
+    and the site can exit after idle_exit seconds without requests; the next connection starts it again.
+    """
+    from .systemd_setup import use_socket_activation
+
+    # uwsgi starts the interpreter of the virtualenv itself, instead of the wsgi file activating it
+    if not "virtualenv" in kwargs.keys() or kwargs['virtualenv'].strip() == "":
+        home = '# no virtualenv: system python'
+    else:
+        home = 'home = {}'.format(os.path.dirname(os.path.abspath(os.path.expanduser(kwargs['virtualenv']))))
+
+    vacuum = 'true'
+    idle = ''
+    if use_socket_activation(site, **kwargs):
+        idle_exit = kwargs.get('idle_exit', 0)
+        if isinstance(idle_exit, dict):
+            idle_exit = idle_exit.get(site, 0)
+
+        vacuum = 'false'
+        if int(idle_exit) > 0:
+            idle = '\n# exit when idle; {}.socket starts the site again\nidle = {}\ndie-on-idle = true'.format(site, int(idle_exit))
+
+    inlist  = ['__HOME__', '__PROCESSES__',     '__VACUUM__', '__IDLEEXIT__', '__SOCKETDIR__', '\\']
+    outlist = [home,       str(int(processes)), vacuum,       idle,           paths['sockdir'], '/']
+
+    return inlist, outlist
+
+def _site_replaces(port, paths, **kwargs):
+    """
+    helper function returning the replacements for the nginx site of a site.
+    If ssl_certificate and ssl_certificate_key are given, the site is served over TLS with HTTP/2.
+    """
+    inlist  = ['__SOCKETDIR__',  '__PORT__', '\\']
+    outlist = [paths['sockdir'], str(port),  '/']
+
+    ssl_certificate = kwargs.get('ssl_certificate', '')
+    ssl_certificate_key = kwargs.get('ssl_certificate_key', '')
+    if not ssl_certificate.strip() == '' and not ssl_certificate_key.strip() == '':
+        listenopts = ' ssl http2'
+        ssl = '\n'.join([
+            '    ssl_certificate {};'.format(os.path.abspath(os.path.expanduser(ssl_certificate))),
+            '    ssl_certificate_key {};'.format(os.path.abspath(os.path.expanduser(ssl_certificate_key))),
+            '    ssl_protocols TLSv1.2 TLSv1.3;',
+            '    ssl_session_cache shared:wadqc_ssl:10m;',
+            '    ssl_session_timeout 1h;',
+            '', ''])
+    else:
+        listenopts = ''
+        ssl = ''
+
+    inlist.extend(['__LISTENOPTS__', '__SSL__\n', '__KEEPALIVETIMEOUT__', '__KEEPALIVEREQUESTS__'])
+    outlist.extend([listenopts, ssl,
+                    str(kwargs.get('keepalive_timeout', '75s')), str(kwargs.get('keepalive_requests', 1000))])
+
+    return inlist, outlist
+
 def _deploy_sites(paths, sitelist, portlist, installation_root, **kwargs):
     """
     helper function generating the commands to copy the wsgi and conf scripts of sites
@@ -79,10 +142,8 @@ def _deploy_sites(paths, sitelist, portlist, installation_root, **kwargs):
     import getpass
     user = getpass.getuser() # gets the name of the user running this shell
 
-    if not "virtualenv" in kwargs.keys() or kwargs['virtualenv'].strip() == "": 
-        venvbin = 'None' #Needs to be a string for replace!
-    else:
-        venvbin = '"{}"'.format(os.path.abspath(os.path.expanduser(kwargs['virtualenv']))) # note the quotes!
+    # uwsgi processes per site
+    processes = recommend('uwsgi_processes', installation_root, 5, kwargs.get('uwsgi_processes', None))
 
     # add the sites
     pos = { k:i for i,k in enumerate(sitelist)}
@@ -92,8 +153,8 @@ def _deploy_sites(paths, sitelist, portlist, installation_root, **kwargs):
         # create proper paths in wsgi
         xtra_paths = [ os.path.dirname(p) for p in [which('wadcontrol'), which('Orthanc'), which('pg_config')]]
         dest = os.path.join(installation_root, 'admin_wadqc.py')
-        inlist  = ['__WADROOT__',   '__XTRAPATHS__', '__VENVBIN__', '\\']
-        outlist = [installation_root, str(xtra_paths),    venvbin,       '/']
+        inlist  = ['__WADROOT__',   '__XTRAPATHS__', '\\']
+        outlist = [installation_root, str(xtra_paths), '/']
         copy_replaces(src=os.path.join(paths['wsgi'], 'admin_wadqc.wsgi'), 
                       dest=dest, 
                       inlist=inlist, 
@@ -104,8 +165,7 @@ def _deploy_sites(paths, sitelist, portlist, installation_root, **kwargs):
         # create proper paths in site
         dest = os.path.join(installation_root, 'admin_wadqc.site')
         # no __LISTEN__ param: always Listen
-        inlist  = ['__SOCKETDIR__', '__PORT__',            '\\']
-        outlist = [paths['sockdir'], str(portlist[pos['wad_admin']]),'/']
+        inlist, outlist = _site_replaces(portlist[pos['wad_admin']], paths, **kwargs)
         copy_replaces(src=os.path.join(paths['conf'], 'admin_wadqc.site'), 
                       dest=dest, 
                       inlist=inlist, 
@@ -115,8 +175,7 @@ def _deploy_sites(paths, sitelist, portlist, installation_root, **kwargs):
 
         # create proper paths in uwsgi ini
         dest = os.path.join(installation_root, 'admin_wadqc.ini')
-        inlist  = ['__SOCKETDIR__',                 '\\']
-        outlist = [paths['sockdir'],'/']
+        inlist, outlist = _uwsgi_replaces('wad_admin', paths, processes, **kwargs)
         copy_replaces(src=os.path.join(paths['conf'], os.path.basename(dest)), 
                       dest=dest, 
                       inlist=inlist, 
@@ -129,8 +188,8 @@ def _deploy_sites(paths, sitelist, portlist, installation_root, **kwargs):
     if 'wad_dashboard' in sitelist:
         # create proper paths in wsgi
         dest = os.path.join(installation_root, 'dashboard_wadqc.py')
-        inlist  = ['__WADROOT__',   '__VENVBIN__', '\\']
-        outlist = [installation_root, venvbin,     '/']
+        inlist  = ['__WADROOT__',   '\\']
+        outlist = [installation_root, '/']
         copy_replaces(src=os.path.join(paths['wsgi'], 'dashboard_wadqc.wsgi'), 
                       dest=dest, 
                       inlist=inlist, 
@@ -140,8 +199,7 @@ def _deploy_sites(paths, sitelist, portlist, installation_root, **kwargs):
 
         # create proper paths in site
         dest = os.path.join(installation_root, 'dashboard_wadqc.site')
-        inlist  = ['__SOCKETDIR__', '__PORT__',                 '\\']
-        outlist = [paths['sockdir'], str(portlist[pos['wad_dashboard']]),'/']
+        inlist, outlist = _site_replaces(portlist[pos['wad_dashboard']], paths, **kwargs)
         copy_replaces(src=os.path.join(paths['conf'], 'dashboard_wadqc.site'), 
                       dest=dest, 
                       inlist=inlist, 
@@ -151,8 +209,7 @@ def _deploy_sites(paths, sitelist, portlist, installation_root, **kwargs):
 
         # create proper paths in uwsgi ini
         dest = os.path.join(installation_root, 'dashboard_wadqc.ini')
-        inlist  = ['__SOCKETDIR__',                 '\\']
-        outlist = [paths['sockdir'],'/']
+        inlist, outlist = _uwsgi_replaces('wad_dashboard', paths, processes, **kwargs)
         copy_replaces(src=os.path.join(paths['conf'], os.path.basename(dest)), 
                       dest=dest, 
                       inlist=inlist, 
@@ -165,8 +222,8 @@ def _deploy_sites(paths, sitelist, portlist, installation_root, **kwargs):
     if 'wad_api' in sitelist:
         # create proper paths in wsgi
         dest = os.path.join(installation_root, 'api_wadqc.py')
-        inlist  = ['__WADROOT__', '__XTRAPATHS__',  '__VENVBIN__', '\\']
-        outlist = [installation_root, str(xtra_paths), venvbin,     '/']
+        inlist  = ['__WADROOT__', '__XTRAPATHS__',  '\\']
+        outlist = [installation_root, str(xtra_paths), '/']
         copy_replaces(src=os.path.join(paths['wsgi'], 'api_wadqc.wsgi'), 
                       dest=dest, 
                       inlist=inlist, 
@@ -176,8 +233,7 @@ def _deploy_sites(paths, sitelist, portlist, installation_root, **kwargs):
 
         # create proper paths in site
         dest = os.path.join(installation_root, 'api_wadqc.site')
-        inlist  = ['__SOCKETDIR__', '__PORT__',                 '\\']
-        outlist = [paths['sockdir'], str(portlist[pos['wad_api']]),'/']
+        inlist, outlist = _site_replaces(portlist[pos['wad_api']], paths, **kwargs)
         copy_replaces(src=os.path.join(paths['conf'], 'api_wadqc.site'), 
                       dest=dest, 
                       inlist=inlist, 
@@ -187,8 +243,7 @@ def _deploy_sites(paths, sitelist, portlist, installation_root, **kwargs):
         
         # create proper paths in uwsgi ini
         dest = os.path.join(installation_root, 'api_wadqc.ini')
-        inlist  = ['__SOCKETDIR__',                 '\\']
-        outlist = [paths['sockdir'],'/']
+        inlist, outlist = _uwsgi_replaces('wad_api', paths, processes, **kwargs)
         copy_replaces(src=os.path.join(paths['conf'], os.path.basename(dest)), 
                       dest=dest, 
                       inlist=inlist, 
@@ -225,6 +280,12 @@ def nginx_deploy_sites(sitelist, portlist, installation_root, **kwargs):
             ['sudo', 'chmod', '+x', dest]
         ])
 
+    # collector for the uwsgi stats sockets in sockdir
+    dest = os.path.join(bindir, 'wad_uwsgistats')
+    cmds.extend([
+        ['cp', os.path.join(os.getcwd(), 'scripts', 'uwsgistats.py'), dest],
+        ['chmod', '+x', dest]
+    ])
 
     paths = {
         'var': '/var/www/wadqc',
@@ -257,13 +318,20 @@ def nginx_deploy_sites(sitelist, portlist, installation_root, **kwargs):
                 errormsg = 'ERROR! Could not deploy_sites sites on nginx! '
                 return result, errormsg+msg
 
-    # 5. make systemd services
-    for site in sitelist:
-        result, msg = create_start_systemd(site, installation_root, **kwargs)
-        mustquit = (not result == "OK")
-        if mustquit:
-            errormsg = 'ERROR! Could not create systemd for {} for nginx! '.format(site)
-            return result, errormsg+msg
+    # 5. make systemd services, all sites at once
+    result, msg = install_units(sitelist, installation_root, **kwargs)
+    mustquit = (not result == "OK")
+    if mustquit:
+        errormsg = 'ERROR! Could not create systemd for {} for nginx! '.format(', '.join(sitelist))
+        return result, errormsg+msg
+
+    # 6. baseline of the app import time, which is paid by each uwsgi master on (re)start
+    if kwargs.get('importtime', True):
+        result2, msg2 = record_importtime(sitelist, installation_root, **kwargs)
+        if result2 == 'ERROR':
+            logger.warning(msg2)
+        else:
+            logger.info(msg2)
 
     return result, msg
 
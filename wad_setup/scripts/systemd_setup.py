@@ -3,7 +3,8 @@ import logging
 import getpass
 from .distro import distro
 from .which import which
-from .helpers import external_call
+from .helpers import external_call, bytes_as_string
+from .hostprobe import host_resources, analysis_cpus, ANALYSIS_MEMORY_HIGH, ANALYSIS_MEMORY_MAX
 from .defaults import LOGGERNAME
 logger = logging.getLogger(LOGGERNAME)
 
@@ -11,11 +12,10 @@ logger = logging.getLogger(LOGGERNAME)
 Output files for running processor and postgresql and orthanc by systemd
 Will need sudo.
 
-For Orthanc and wadprocessor in a virtualenv, create a wrapper script in <WADROOT>/WAD_QC
-#!/bin/bash
-source __VENVBIN__/activate
-cd __WORKING_DIRECTORY__
-exec __EXE__
+For Orthanc and wadprocessor in a virtualenv, the units exec the console scripts of the virtualenv directly,
+with the environment that activate would give in <WADROOT>/WAD_QC/systemd/wadqc.env
+VIRTUAL_ENV=__VENV__
+PATH=__VENVBIN__:/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin
 
 """
 
@@ -23,8 +23,9 @@ SERVICES = {
     'wadprocessor': {
         #[Unit]
         'Description': 'WAD-QC Processor',
-        'After': 'syslog.target network.target wadpostgresql.service',
+        'After': 'syslog.target network.target wadpostgresql.service wadorthanc.service',
         'Requires': 'wadpostgresql.service',
+        'Wants': 'wadorthanc.service',
         #[Service]
         'Type': 'simple',
         'User': 'wad',
@@ -57,6 +58,8 @@ SERVICES = {
         'After': 'syslog.target network.target',
         #[Service]
         'Type': 'forking',
+        'PIDFile': 'PGDATA/postmaster.pid', # overwrite later
+        'TimeoutStartSec': 300, # crash recovery can take a while
         'User': 'wad',
         'Group': 'wad',
         'Restart': 'always',
@@ -65,8 +68,8 @@ SERVICES = {
             'mkdir -p /var/run/postgresql /var/log/postgresql', # make sure these folders exist
             '/bin/chown -R user:user /var/run/postgresql /var/log/postgresql', # overwrite later
             ],
-        'ExecStart': 'pg_ctl -D PGDATA start', # overwrite later
-        'ExecStop': 'pg_ctl -D PGDATA stop', # overwrite later
+        'ExecStart': 'pg_ctl -w -t 300 -D PGDATA start', # overwrite later; -w: return when accepting connections
+        'ExecStop': 'pg_ctl -w -D PGDATA stop', # overwrite later
         'ExecStopPost': '/bin/chown -R postgres:postgres /var/run/postgresql', # change back to system default allows package upgrade
         #[Install]
         'WantedBy': 'multi-user.target'
@@ -74,9 +77,12 @@ SERVICES = {
     'wadorthanc': {
         #[Unit]
         'Description': 'Orthanc for WAD-QC',
-        'After': 'syslog.target network.target',
+        'After': 'syslog.target network.target wadpostgresql.service',
+        'Requires': 'wadpostgresql.service',
         #[Service]
         'Type': 'simple',
+        'TimeoutStartSec': 300, # a database upgrade of Orthanc can take a while
+        'ExecStartPost': 'wad_healthprobe --http http://localhost:8042/system', # overwrite later; started when REST answers
         'User': 'wad',
         'Group': 'wad',
         'Restart': 'always',
@@ -88,7 +94,8 @@ SERVICES = {
     'wad_admin': { # uwsgi for nginx
         #[Unit]
         'Description': 'uWSGI instance to serve wadadmin of WAD-QC',
-        'After': 'syslog.target network.target',
+        'After': 'syslog.target network.target wadpostgresql.service',
+        'Wants': 'wadpostgresql.service',
         #[Service]
         'Type': 'simple',
         'User': 'wad', # overwrite later
@@ -103,7 +110,8 @@ SERVICES = {
     'wad_dashboard': { # uwsgi for nginx
         #[Unit]
         'Description': 'uWSGI instance to serve waddashboard of WAD-QC',
-        'After': 'syslog.target network.target',
+        'After': 'syslog.target network.target wadpostgresql.service',
+        'Wants': 'wadpostgresql.service',
         #[Service]
         'Type': 'simple',
         'User': 'wad', # overwrite later
@@ -118,7 +126,8 @@ SERVICES = {
     'wad_api': { # uwsgi for nginx
         #[Unit]
         'Description': 'uWSGI instance to serve wadapi of WAD-QC',
-        'After': 'syslog.target network.target',
+        'After': 'syslog.target network.target wadpostgresql.service',
+        'Wants': 'wadpostgresql.service',
         #[Service]
         'Type': 'simple',
         'User': 'wad', # overwrite later
@@ -129,44 +138,461 @@ SERVICES = {
         #[Install]
         'WantedBy': 'multi-user.target'
     },
+
+    'wadmaint-vacuum': { # maintenance job, started by its timer
+        #[Unit]
+        'Description': 'WAD-QC maintenance: VACUUM (ANALYZE) of the WAD-QC and Orthanc databases',
+        'After': 'wadpostgresql.service',
+        'Requisite': 'wadpostgresql.service', # do not start a stopped database for maintenance
+        #[Service]
+        'Type': 'oneshot',
+        'TimeoutStartSec': 7200, # longest run; a run that would reach into working hours is stopped
+        'User': 'wad', # overwrite later
+        'Group': 'wad',
+        'ExecStart': 'wad_maintenance vacuum', # overwrite later
+    },
+
+    'wadmaint-reindex': { # maintenance job, started by its timer
+        #[Unit]
+        'Description': 'WAD-QC maintenance: REINDEX of the WAD-QC and Orthanc databases',
+        'After': 'wadpostgresql.service wadmaint-vacuum.service',
+        'Requisite': 'wadpostgresql.service',
+        #[Service]
+        'Type': 'oneshot',
+        'TimeoutStartSec': 10800,
+        'User': 'wad', # overwrite later
+        'Group': 'wad',
+        'ExecStart': 'wad_maintenance reindex', # overwrite later
+    },
+
+    'wadmaint-storage': { # maintenance job, started by its timer
+        #[Unit]
+        'Description': 'WAD-QC maintenance: size of the Orthanc storage and the WAD-QC logs',
+        #[Service]
+        'Type': 'oneshot',
+        'TimeoutStartSec': 3600,
+        'User': 'wad', # overwrite later
+        'Group': 'wad',
+        'ExecStart': 'wad_maintenance storage', # overwrite later
+    },
+
+    'wadmaint-retention': { # maintenance job, started by its timer
+        #[Unit]
+        'Description': 'WAD-QC maintenance: delete processed studies older than the retention period from Orthanc',
+        'After': 'wadpostgresql.service wadorthanc.service',
+        'Requisite': 'wadpostgresql.service wadorthanc.service',
+        #[Service]
+        'Type': 'oneshot',
+        'TimeoutStartSec': 7200,
+        'User': 'wad', # overwrite later
+        'Group': 'wad',
+        'ExecStart': 'wad_maintenance retention', # overwrite later
+    },
 }
 
-def create_wrapper(dest, venvbin, exe, cwd=None):
+# timer units for the maintenance jobs; the run windows (OnCalendar) can be set in the recipe. The default windows
+# are at night, outside the hours that modalities send studies; the reindex runs after the vacuum of Sunday.
+TIMERS = {
+    'wadmaint-vacuum': {
+        #[Unit]
+        'Description': 'Nightly VACUUM (ANALYZE) of the WAD-QC databases',
+        #[Timer]
+        'OnCalendar': '*-*-* 02:30', # overwrite later
+        'RandomizedDelaySec': 600,
+        #[Install]
+        'WantedBy': 'timers.target'
+    },
+
+    'wadmaint-reindex': {
+        #[Unit]
+        'Description': 'Weekly REINDEX of the WAD-QC databases',
+        #[Timer]
+        'OnCalendar': 'Sun *-*-* 04:00', # overwrite later
+        'RandomizedDelaySec': 600,
+        #[Install]
+        'WantedBy': 'timers.target'
+    },
+
+    'wadmaint-storage': {
+        #[Unit]
+        'Description': 'Daily check of the WAD-QC storage size',
+        #[Timer]
+        'OnCalendar': '*-*-* 06:00', # overwrite later
+        'RandomizedDelaySec': 600,
+        #[Install]
+        'WantedBy': 'timers.target'
+    },
+
+    'wadmaint-retention': {
+        #[Unit]
+        'Description': 'Nightly retention of processed studies in Orthanc',
+        #[Timer]
+        'OnCalendar': '*-*-* 01:30', # overwrite later
+        'RandomizedDelaySec': 600,
+        #[Install]
+        'WantedBy': 'timers.target'
+    },
+}
+
+# socket units for socket activation of the uwsgi sites; systemd owns the sockets in WADROOT/sockets
+# and starts the matching service on the first connection
+SOCKETS = {
+    'wad_admin': {
+        #[Unit]
+        'Description': 'Socket for uWSGI instance to serve wadadmin of WAD-QC',
+        #[Socket]
+        'ListenStream': 'admin_wadqc.sock', # overwrite later
+        'SocketUser': 'wad', # overwrite later
+        'SocketGroup': 'www-data',
+        'SocketMode': '0660',
+        #[Install]
+        'WantedBy': 'sockets.target'
+    },
+
+    'wad_dashboard': {
+        #[Unit]
+        'Description': 'Socket for uWSGI instance to serve waddashboard of WAD-QC',
+        #[Socket]
+        'ListenStream': 'dashboard_wadqc.sock', # overwrite later
+        'SocketUser': 'wad', # overwrite later
+        'SocketGroup': 'www-data',
+        'SocketMode': '0660',
+        #[Install]
+        'WantedBy': 'sockets.target'
+    },
+
+    'wad_api': {
+        #[Unit]
+        'Description': 'Socket for uWSGI instance to serve wadapi of WAD-QC',
+        #[Socket]
+        'ListenStream': 'api_wadqc.sock', # overwrite later
+        'SocketUser': 'wad', # overwrite later
+        'SocketGroup': 'www-data',
+        'SocketMode': '0660',
+        #[Install]
+        'WantedBy': 'sockets.target'
+    },
+}
+
+def use_socket_activation(service, **kwargs):
+    """
+    Socket activation is only available for the uwsgi sites, and only if requested in the recipe
+    """
+    return service in SOCKETS.keys() and kwargs.get('socket_activation', False) in [True, 'true', 'True']
+
+def create_socket(service, wadroot, user):
+    """
+    Write the .socket unit for a socket activated uwsgi site to WADROOT. Returns the path of the unit file
+    """
+    sock = SOCKETS[service]
+    sock['ListenStream'] = os.path.join(wadroot, 'sockets', os.path.basename(sock['ListenStream']))
+    sock['SocketUser'] = user
+
+    dest = os.path.join(wadroot, "{}.socket".format(service))
+    with open(dest, "w") as fout:
+        fout.write('[Unit]\n')
+        for key in ['Description']:
+            if key in sock.keys(): fout.write('{}={}\n'.format(key, sock[key]))
+        fout.write('\n[Socket]\n')
+        for key in ['ListenStream', 'SocketUser', 'SocketGroup', 'SocketMode', 'Backlog']:
+            if key in sock.keys(): fout.write('{}={}\n'.format(key, sock[key]))
+        fout.write('\n[Install]\n')
+        for key in ['WantedBy']:
+            if key in sock.keys(): fout.write('{}={}\n'.format(key, sock[key]))
+
+    return dest
+
+def create_timer(service, wadroot, **kwargs):
+    """
+    Write the .timer unit of a maintenance job to WADROOT. Returns the path of the unit file.
+
+    Recipe kwargs:
+      maintenance_windows: OnCalendar per job, e.g. {"vacuum": "Sat *-*-* 22:00", "reindex": "Sun *-*-* 01:00"}
+      maintenance_persistent: true to run a job missed while the host was down at the next boot [false]
+    """
+    timer = dict(TIMERS[service])
+    job = service.split('-', 1)[1]
+    windows = kwargs.get('maintenance_windows', None) or {}
+    if job in windows.keys():
+        timer['OnCalendar'] = windows[job]
+    if kwargs.get('maintenance_persistent', False) in [True, 'true', 'True']:
+        timer['Persistent'] = 'true' # note: after a long downtime the job runs at boot, maybe during working hours
+    logger.info('...{}: runs at {}'.format(service, timer['OnCalendar']))
+
+    dest = os.path.join(wadroot, "{}.timer".format(service))
+    with open(dest, "w") as fout:
+        fout.write('[Unit]\n')
+        for key in ['Description']:
+            if key in timer.keys(): fout.write('{}={}\n'.format(key, timer[key]))
+        fout.write('\n[Timer]\n')
+        for key in ['OnCalendar', 'RandomizedDelaySec', 'Persistent']:
+            if key in timer.keys(): fout.write('{}={}\n'.format(key, timer[key]))
+        fout.write('\n[Install]\n')
+        for key in ['WantedBy']:
+            if key in timer.keys(): fout.write('{}={}\n'.format(key, timer[key]))
+
+    return dest
+
+def create_pgpass(wadroot, dest, pgport):
+    """
+    Write a PostgreSQL password file for the owners of the WAD-QC and Orthanc databases, readable by the user only.
+    Returns the list of database:user pairs in it.
+    """
     import stat
+    from .database_setup import get_dict_from_inifile, get_dict_from_jsonfile
+    iqcdb = get_dict_from_inifile(os.path.join(wadroot, 'WAD_QC', 'wadconfig.ini'))['iqc-db']
+    orthancdb = get_dict_from_jsonfile(os.path.join(wadroot, 'orthanc', 'config', 'orthanc.json'))['PostgreSQL']
+    entries = [
+        (iqcdb['DBASE'], iqcdb['USER'], iqcdb['PSWD']),
+        (orthancdb['Database'], orthancdb['Username'], orthancdb['Password']),
+    ]
     with open(dest, 'w') as fout:
-        fout.write('#!/bin/bash\n')
-        fout.write('source {}\n'.format(os.path.join(venvbin,'activate')))
-        if not cwd is None:
-            fout.write('cd {}\n'.format(cwd))
-        fout.write('exec {}\n'.format(exe))
-
-    try: # make executable
-        os.chmod(dest, os.stat(dest).st_mode | stat.S_IEXEC)
-    except Exception as e:
-        logger.warning('cannot make {} executable'.format(os.path.basename(dest)))
-    
-def create_start_systemd(service, installation_root, **kwargs):
+        pass
+    os.chmod(dest, stat.S_IRUSR | stat.S_IWUSR) # psql ignores a password file that others can read
+    with open(dest, 'w') as fout:
+        for dbname, user, pswd in entries:
+            fout.write('localhost:{}:{}:{}:{}\n'.format(pgport, dbname, user, pswd.replace('\\', '\\\\').replace(':', '\\:')))
+    return ['{}:{}'.format(dbname, user) for dbname, user, pswd in entries]
+
+def create_orthanc_credentials(wadroot, dest):
     """
-    Create a systemd service configuration, enable it and start it now
+    Write user:password of the first registered user of Orthanc for its REST API, readable by the user only
+    """
+    import stat
+    from .database_setup import get_dict_from_jsonfile
+    users = get_dict_from_jsonfile(os.path.join(wadroot, 'orthanc', 'config', 'orthanc.json'))['RegisteredUsers']
+    user = sorted(users.keys())[0]
+    with open(dest, 'w') as fout:
+        pass
+    os.chmod(dest, stat.S_IRUSR | stat.S_IWUSR)
+    with open(dest, 'w') as fout:
+        fout.write('{}:{}\n'.format(user, users[user]))
+
+# resource-control profiles per role, so a heavy analysis in wadprocessor cannot starve the DICOM receiver
+# of Orthanc, the database or the sites. Weights are relative (default 100); systemd maps them to cpu.shares
+# and blkio.weight on hosts with the legacy cgroup hierarchy, where MemoryHigh is ignored.
+RESOURCE_PROFILES = {
+    'database': {'CPUWeight': 200, 'IOWeight': 500, 'Nice': -5, 'TasksMax': 1024},
+    'ingest':   {'CPUWeight': 400, 'IOWeight': 400, 'Nice': -5, 'TasksMax': 1024},
+    'ui':       {'CPUWeight': 300, 'IOWeight': 200, 'Nice': 0, 'TasksMax': 256},
+    'analysis': {'CPUWeight': 50,  'IOWeight': 50,  'Nice': 10, 'TasksMax': 512},
+    'maintenance': {'CPUWeight': 20, 'IOWeight': 20, 'Nice': 15, 'TasksMax': 64},
+}
+
+SERVICE_ROLES = {
+    'wadpostgresql': 'database',
+    'wadorthanc': 'ingest',
+    'wad_admin': 'ui',
+    'wad_dashboard': 'ui',
+    'wad_api': 'ui',
+    'wadprocessor': 'analysis',
+    'wadmaint-vacuum': 'maintenance',
+    'wadmaint-reindex': 'maintenance',
+    'wadmaint-storage': 'maintenance',
+    'wadmaint-retention': 'maintenance',
+}
+
+UNITDIR = '/lib/systemd/system'
+
+RESOURCE_KEYS = ['Nice', 'CPUWeight', 'IOWeight', 'CPUAffinity', 'AllowedCPUs', 'MemoryHigh', 'MemoryMax', 'TasksMax']
+
+def _cpu_range(first, last):
+    return str(first) if first == last else '{}-{}'.format(first, last)
+
+def resource_controls(service, **kwargs):
+    """
+    Resource-control settings for the [Service] section of service.
+    Starts from the profile of the role of the service, sizes the analysis limits from the host, and
+    applies the "resources" dict of the recipe last; a value of null removes a setting, "resources": false
+    disables resource control for the service.
+    """
+    overrides = kwargs.get('resources', {})
+    if overrides in [False, 'false', 'False']:
+        return {}
+    if overrides is None:
+        overrides = {}
+
+    role = kwargs.get('resource_role', SERVICE_ROLES.get(service, None))
+    if role is None:
+        return {}
+    controls = dict(RESOURCE_PROFILES[role])
+
+    if role == 'analysis':
+        host = host_resources()
+        ncpus = host['cpus']
+        if not host['mem_mb'] is None:
+            # leave room for the database, Orthanc and the sites; above MemoryHigh the analysis is
+            # throttled and reclaimed, only above MemoryMax it is killed
+            controls['MemoryHigh'] = '{}M'.format(int(host['mem_mb']*ANALYSIS_MEMORY_HIGH))
+            controls['MemoryMax'] = '{}M'.format(int(host['mem_mb']*ANALYSIS_MEMORY_MAX))
+            logger.info('...{}: MemoryHigh={} MemoryMax={} ({:.0%} and {:.0%} of {} MB)'.format(
+                service, controls['MemoryHigh'], controls['MemoryMax'], ANALYSIS_MEMORY_HIGH, ANALYSIS_MEMORY_MAX,
+                host['mem_mb']))
+        cpus = analysis_cpus(ncpus)
+        if len(cpus) < ncpus:
+            controls['CPUAffinity'] = _cpu_range(cpus[0], cpus[-1])
+            logger.info('...{}: CPUAffinity={} (cpus 0-{} of {} kept for ingest and sites)'.format(
+                service, controls['CPUAffinity'], cpus[0]-1, ncpus))
+        else:
+            logger.info('...{}: no CPUAffinity, only {} cpus'.format(service, ncpus))
+
+    for key, val in overrides.items():
+        if not key in RESOURCE_KEYS:
+            logger.warning('...{}: ignoring unknown resource control {}'.format(service, key))
+            continue
+        if val is None:
+            controls.pop(key, None)
+        else:
+            controls[key] = val
+
+    if 'AllowedCPUs' in overrides.keys() and not 'CPUAffinity' in overrides.keys():
+        controls.pop('CPUAffinity', None) # AllowedCPUs (cgroup v2 cpuset) replaces the sized CPUAffinity
+
+    return controls
+
+# restart policies per role, so a service that keeps failing is restarted with a growing delay instead of in a
+# tight loop, and is left failed after StartLimitBurst starts within StartLimitIntervalSec. The delay grows
+# exponentially from RestartSec to RestartMaxDelaySec in RestartSteps steps; systemd before 254 ignores
+# RestartSteps and RestartMaxDelaySec and uses the fixed RestartSec, so there the start limit ends a restart loop.
+RESTART_POLICIES = {
+    'database': {'RestartSec': 5,  'RestartSteps': 5, 'RestartMaxDelaySec': 120, 'StartLimitIntervalSec': 900,  'StartLimitBurst': 10},
+    'ingest':   {'RestartSec': 5,  'RestartSteps': 5, 'RestartMaxDelaySec': 120, 'StartLimitIntervalSec': 900,  'StartLimitBurst': 10},
+    'ui':       {'RestartSec': 2,  'RestartSteps': 4, 'RestartMaxDelaySec': 60,  'StartLimitIntervalSec': 600,  'StartLimitBurst': 10},
+    'analysis': {'RestartSec': 10, 'RestartSteps': 5, 'RestartMaxDelaySec': 300, 'StartLimitIntervalSec': 1800, 'StartLimitBurst': 10},
+}
+
+RESTART_KEYS = ['Restart', 'RestartSec', 'RestartSteps', 'RestartMaxDelaySec', 'StartLimitIntervalSec', 'StartLimitBurst', 'WatchdogSec']
+RESTART_MODES = ['no', 'always', 'on-success', 'on-failure', 'on-abnormal', 'on-abort', 'on-watchdog']
+
+# services with a readiness probe that can also feed the watchdog
+WATCHDOG_SERVICES = ['wadpostgresql', 'wadorthanc']
+
+def restart_policy(service, **kwargs):
+    """
+    Restart settings for service: the policy of the role of the service, with the "restart" dict of the recipe
+    applied last; a value of null removes a setting (e.g. RestartSteps: null for a fixed delay), "restart": false
+    keeps only the plain Restart of the service. WatchdogSec is only honored for services with a readiness probe,
+    which then keeps pinging the watchdog while the service answers.
+    """
+    overrides = kwargs.get('restart', {})
+    if overrides in [False, 'false', 'False']:
+        return {}
+    if overrides is None:
+        overrides = {}
+
+    role = SERVICE_ROLES.get(service, None)
+    if not role in RESTART_POLICIES.keys(): # e.g. maintenance jobs are not restarted
+        return {}
+    policy = dict(RESTART_POLICIES[role])
+
+    for key, val in overrides.items():
+        if not key in RESTART_KEYS:
+            logger.warning('...{}: ignoring unknown restart setting {}'.format(service, key))
+            continue
+        if key == 'Restart' and not val in RESTART_MODES:
+            logger.warning('...{}: ignoring Restart={}, valid: {}'.format(service, val, ', '.join(RESTART_MODES)))
+            continue
+        if val is None:
+            policy.pop(key, None)
+        else:
+            policy[key] = val
+
+    if policy.get('WatchdogSec', 0) in [0, '0']:
+        policy.pop('WatchdogSec', None)
+    elif not service in WATCHDOG_SERVICES:
+        logger.warning('...{}: ignoring WatchdogSec, only {} can ping the watchdog'.format(service, ', '.join(WATCHDOG_SERVICES)))
+        policy.pop('WatchdogSec', None)
+    else:
+        policy['NotifyAccess'] = 'all' # the pings come from the probe, not from the main process
+
+    if 'RestartSteps' in policy.keys() and 'RestartMaxDelaySec' in policy.keys():
+        logger.info('...{}: restart after {} s up to {} s in {} steps, at most {} starts in {} s'.format(
+            service, policy.get('RestartSec', 0.1), policy['RestartMaxDelaySec'], policy['RestartSteps'],
+            policy.get('StartLimitBurst', 5), policy.get('StartLimitIntervalSec', 10)))
+    return policy
+
+def write_unit(dest, serv):
+    """
+    Write the [Unit], [Service] and [Install] sections of a .service file; list values give repeated keys
+    """
+    sections = [
+        ('Unit', ['Description', 'After', 'Before', 'Requires', 'Requisite', 'Wants', 'PartOf', 'StartLimitIntervalSec', 'StartLimitBurst']),
+        ('Service', ['Type', 'PIDFile', 'TimeoutStartSec', 'WorkingDirectory', 'Environment', 'EnvironmentFile', 'User', 'Group',  'Restart', 
+                     'RestartSec', 'RestartSteps', 'RestartMaxDelaySec', 'WatchdogSec', 'NotifyAccess', 'PermissionsStartOnly', 
+                     'ExecStartPre', 'ExecStart', 'ExecStartPost', 'RemainAfterExit',
+                     'ExecStop', 'ExecStopPost', 'SyslogIdentifier', 'OOMScoreAdjust']+RESOURCE_KEYS),
+        ('Install', ['Alias', 'WantedBy', 'Also']),
+    ]
+    with open(dest, "w") as fout:
+        for i, (section, keys) in enumerate(sections):
+            fout.write('{}[{}]\n'.format('\n' if i>0 else '', section))
+            for key in keys:
+                if key in serv.keys(): 
+                    if isinstance(serv[key], list):
+                        for val in serv[key]:
+                            fout.write('{}={}\n'.format(key, val))
+                    else:
+                        fout.write('{}={}\n'.format(key, serv[key]))
+
+def install_healthprobe(wadroot, **kwargs):
+    """
+    Copy the readiness probe to WAD_QC/systemd; returns the command to run it
+    """
+    return _install_script('healthprobe.py', 'wad_healthprobe', wadroot, **kwargs)
+
+def _install_script(script, name, wadroot, **kwargs):
+    """
+    Copy a stand-alone script of wad_setup to WAD_QC/systemd/name; returns the command to run it
+    """
+    import sys
+    import shutil
+    dest_folder = os.path.join(wadroot, 'WAD_QC', 'systemd')
+    if not os.path.exists(dest_folder):
+        os.makedirs(dest_folder)
+    dest = os.path.join(dest_folder, name)
+    shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)), script), dest)
+
+    if not "virtualenv" in kwargs.keys() or kwargs['virtualenv'].strip() == "":
+        python = which('python3') or sys.executable
+    else:
+        python = os.path.join(os.path.abspath(os.path.expanduser(kwargs['virtualenv'])), 'python')
+    return "{} {}".format(python, dest)
+
+def venv_environment(wadroot, **kwargs):
+    """
+    Settings for a unit that execs the console scripts of the virtualenv directly instead of through a bash wrapper:
+    an EnvironmentFile with the VIRTUAL_ENV and PATH that activate would set. Empty without a virtualenv.
+    """
+    if not "virtualenv" in kwargs.keys() or kwargs['virtualenv'].strip() == "":
+        return {}
+
+    venvbin = os.path.abspath(os.path.expanduser(kwargs['virtualenv']))
+    dest_folder = os.path.join(wadroot, 'WAD_QC', 'systemd')
+    if not os.path.exists(dest_folder):
+        os.makedirs(dest_folder)
+
+    dest = os.path.join(dest_folder, 'wadqc.env')
+    with open(dest, 'w') as fout:
+        fout.write('VIRTUAL_ENV={}\n'.format(os.path.dirname(venvbin)))
+        fout.write('PATH={}:/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin\n'.format(venvbin))
+    return {'EnvironmentFile': dest}
+
+def _generate_units(service, wadroot, user, **kwargs):
+    """
+    Write the unit files of service to wadroot. Returns result, msg and the plan to install them:
+      files: (file, installed path) pairs; remove: installed files to remove;
+      stop, disable, enable, start: units for those systemctl commands
     """
     logger.info("Creating systemd service for {}...".format(service))
     result, msg = ('OK', '')
-    cmds = []
-    user = getpass.getuser() # gets the name of the user running this shell
-
-    wadroot = installation_root
-    if wadroot is None:
-        wadroot = os.environ.get('WADROOT', installation_root)
-    if wadroot is None:
-        result = "ERROR"
-        msg = "Missing WADROOT definition. First run create_folders_settings!"
-        return result, msg
+    plan = {'files': [], 'remove': [], 'stop': [], 'disable': [], 'enable': [], 'start': []}
 
     if service in SERVICES.keys():
         # create .service file
-        serv = SERVICES[service]
+        serv = dict(SERVICES[service]) # a copy, so repeated calls start from the defaults
         serv['User'] = user
         serv['Group'] = user
+        policy = restart_policy(service, **kwargs)
         if service == 'wadpostgresql':
             pgsdata = os.path.join(wadroot, 'pgsql', 'data')
             pg_ctl = 'pg_ctl'
@@ -181,11 +607,17 @@ def create_start_systemd(service, installation_root, **kwargs):
                 '-{} -p /var/run/postgresql /var/log/postgresql'.format(which('mkdir')),
                 '-{} -R {}:{} /var/run/postgresql /var/log/postgresql'.format(which('chown'), user, user),
                 ]
-            serv['ExecStart'] = "{} -D {} start".format(pg_ctl, pgsdata)
-            serv['ExecStop'] = "{} -D {} stop".format(pg_ctl, pgsdata)
+            serv['PIDFile'] = os.path.join(pgsdata, 'postmaster.pid')
+            serv['ExecStart'] = "{} -w -t {} -D {} start".format(pg_ctl, serv['TimeoutStartSec'], pgsdata)
+            serv['ExecStop'] = "{} -w -D {} stop".format(pg_ctl, pgsdata)
             serv['ExecStopPost'] = "-{} -R postgres:postgres /var/run/postgresql".format(which('chown'))
             
             serv['OOMScoreAdjust'] = -900 # prevent OOM killer from choosing the postmaster
+
+            if 'WatchdogSec' in policy.keys():
+                # the probe stays in the background of the service and pings the watchdog while the port answers
+                serv['ExecStartPost'] = "{} --tcp localhost:{} --timeout {} --watchdog {}".format(
+                    install_healthprobe(wadroot, **kwargs), kwargs.get('pgsql_port', 5432), serv['TimeoutStartSec'], policy['WatchdogSec'])
             
             # stop manually started postgres instance, so service can take over
             #cmd = [pg_ctl, '-D', pgsdata, 'stop']
@@ -204,43 +636,81 @@ def create_start_systemd(service, installation_root, **kwargs):
                 
             inifile = os.path.join(wadroot, 'WAD_QC', 'wadconfig.ini')
             serv['WorkingDirectory'] = "{}".format(os.path.join(wadroot, 'WAD_QC'))
-            if not "virtualenv" in kwargs.keys() or kwargs['virtualenv'].strip() == "":
-                serv['ExecStart'] = "{} -i {} --logfile_only".format(os.path.join(exepath, 'wadprocessor'), inifile)
-                serv['ExecStop'] = "{} quit".format(os.path.join(exepath, 'wadcontrol'))
-            else:
-                # make a wrapper for wadprocessor and wadcontrol to start it from the given virtualenv
-                dest_folder = os.path.join(wadroot, 'WAD_QC', 'systemd')
-                if not os.path.exists(dest_folder):
-                    os.makedirs(dest_folder)
-                dest = os.path.join(dest_folder, 'wadprocessor_wrp')
-                create_wrapper(dest, kwargs['virtualenv'], "{} -i {} --logfile_only".format(os.path.join(exepath, 'wadprocessor'), inifile))
-                serv['ExecStart'] = dest
-                dest = os.path.join(dest_folder, 'wadcontrol_wrp')
-                create_wrapper(dest, kwargs['virtualenv'], "{} quit".format(os.path.join(exepath, 'wadcontrol')))
-                serv['ExecStop'] = dest
+            # exec the console scripts directly, so wadprocessor itself is the main process and gets the signals
+            serv['Environment'] = 'WADROOT={}'.format(wadroot)
+            serv.update(venv_environment(wadroot, **kwargs))
+            serv['ExecStart'] = "{} -i {} --logfile_only".format(os.path.join(exepath, 'wadprocessor'), inifile)
+            serv['ExecStop'] = "{} quit".format(os.path.join(exepath, 'wadcontrol'))
 
         elif service == 'wadorthanc':
             orthanc = which('Orthanc')
             if orthanc is None:
                 result = "ERROR"
                 msg = "Cannot find Orthanc executable."
-                return result, msg
+                return result, msg, plan
             orthanc = os.path.abspath(orthanc)
 
             cfg = os.path.join(wadroot, 'orthanc', 'config', 'orthanc.json')
             logdir = os.path.join(wadroot, 'WAD_QC', 'Logs')
 
-            if not "virtualenv" in kwargs.keys() or kwargs['virtualenv'].strip() == "":
-                serv['ExecStart'] = "{} --logdir={} {}".format(orthanc, logdir, cfg)
-            else:
-                # make a wrapper for Orthanc to start it from the given virtualenv
-                dest_folder = os.path.join(wadroot, 'WAD_QC', 'systemd')
-                if not os.path.exists(dest_folder):
-                    os.makedirs(dest_folder)
-                dest = os.path.join(dest_folder, 'orthanc_wrp')
-                create_wrapper(dest, kwargs['virtualenv'], "{} --logdir={} {}".format(orthanc, logdir, cfg))
-                serv['ExecStart'] = dest
+            # the lua scripts run wadselector, which finds the python of the virtualenv on PATH
+            serv['Environment'] = 'WADROOT={}'.format(wadroot)
+            serv.update(venv_environment(wadroot, **kwargs))
+            serv['ExecStart'] = "{} --logdir={} {}".format(orthanc, logdir, cfg)
+
+            # only started once the REST port answers, so wadprocessor does not race it
+            serv['ExecStartPost'] = "{} --http http://localhost:{}/system --timeout {}".format(
+                install_healthprobe(wadroot, **kwargs), kwargs.get('rest_port', 8042), serv['TimeoutStartSec'])
+            if 'WatchdogSec' in policy.keys():
+                serv['ExecStartPost'] = "{} --watchdog {}".format(serv['ExecStartPost'], policy['WatchdogSec'])
                 
+        elif service in TIMERS.keys():
+            jobcmd = "{} {} --outdir {}".format(_install_script('maintenance.py', 'wad_maintenance', wadroot, **kwargs),
+                                                service.split('-', 1)[1], os.path.join(wadroot, 'WAD_QC', 'maintenance'))
+            if service == 'wadmaint-storage':
+                # recipe: storage_limits {"orthanc": "500G", "logs": "2G"}, storage_min_free: percent free per filesystem
+                limits = kwargs.get('storage_limits', None) or {}
+                for name, folder in [('orthanc', os.path.join(wadroot, 'orthanc', 'db')), ('logs', os.path.join(wadroot, 'WAD_QC', 'Logs'))]:
+                    jobcmd += " --path {}".format(folder if limits.get(name, None) is None else '{}:{}'.format(folder, limits[name]))
+                jobcmd += " --min-free {}".format(kwargs.get('storage_min_free', 10))
+            else:
+                psql = 'psql'
+                result2, pgbindir = external_call(['pg_config', '--bindir'], returnoutput=True)
+                if result2 == "OK":
+                    psql = os.path.join(pgbindir, psql)
+                pgpass = os.path.join(wadroot, 'WAD_QC', 'systemd', 'wadmaint.pgpass')
+                try:
+                    dbs = create_pgpass(wadroot, pgpass, kwargs.get('pgsql_port', 5432))
+                except Exception as e:
+                    result = "ERROR"
+                    msg = "Cannot read the database passwords for {}. {}".format(service, str(e))
+                    return result, msg, plan
+                serv['Environment'] = 'PGPASSFILE={}'.format(pgpass)
+                if service == 'wadmaint-retention':
+                    dbs = dbs[:1] # the WAD-QC database tells which studies are processed
+                jobcmd += " --psql {} --port {} {}".format(psql, kwargs.get('pgsql_port', 5432), ' '.join(['--db {}'.format(db) for db in dbs]))
+
+            if service == 'wadmaint-retention':
+                # recipe: retention_days, retention_batch (studies per batch), retention_max_studies (per run), retention_dry_run
+                cred = os.path.join(wadroot, 'WAD_QC', 'systemd', 'wadmaint.orthanc')
+                try:
+                    create_orthanc_credentials(wadroot, cred)
+                except Exception as e:
+                    result = "ERROR"
+                    msg = "Cannot read the Orthanc credentials for {}. {}".format(service, str(e))
+                    return result, msg, plan
+                jobcmd += " --orthanc http://localhost:{} --credentials {} --days {} --batch {} --max-studies {}".format(
+                    kwargs.get('rest_port', 8042), cred, kwargs.get('retention_days', 90), kwargs.get('retention_batch', 50), 
+                    kwargs.get('retention_max_studies', 1000))
+                if kwargs.get('retention_dry_run', False) in [True, 'true', 'True']:
+                    jobcmd += " --dry-run"
+            serv['ExecStart'] = jobcmd
+
+            # recipe: maintenance_max_runtime {"vacuum": 3600}: seconds before a run is stopped
+            runtimes = kwargs.get('maintenance_max_runtime', None) or {}
+            if service.split('-', 1)[1] in runtimes.keys():
+                serv['TimeoutStartSec'] = runtimes[service.split('-', 1)[1]]
+
         #nginx
         elif service == 'wad_admin':
             if not "virtualenv" in kwargs.keys() or kwargs['virtualenv'].strip() == "": 
@@ -272,54 +742,211 @@ def create_start_systemd(service, installation_root, **kwargs):
             serv['Group'] = "www-data"
             serv['ExecStart'] = "{} --ini api_wadqc.ini".format(os.path.join(exepath, 'uwsgi'))
 
+        socket_activated = use_socket_activation(service, **kwargs)
+        if socket_activated:
+            # systemd owns the socket and starts the service on the first connection; the service is not
+            # started at boot, and it may exit when idle (die-on-idle) without being restarted
+            serv['Requires'] = '{}.socket'.format(service)
+            if not '{}.socket'.format(service) in serv['After']:
+                serv['After'] = '{} {}.socket'.format(serv['After'], service)
+            serv['Restart'] = 'on-failure'
+            serv.pop('WantedBy', None)
+            serv['Also'] = '{}.socket'.format(service)
+
+        serv.update(resource_controls(service, **kwargs))
+        serv.update(policy)
+
         # continue
         dest = os.path.join(wadroot, "{}.service".format(service))
         
-        with open(dest, "w") as fout:
-            fout.write('[Unit]\n')
-            for key in ['Description', 'After', 'Before', 'Requires']:
-                if key in serv.keys(): fout.write('{}={}\n'.format(key, serv[key]))
-            fout.write('\n[Service]\n')
-            for key in ['Type', 'WorkingDirectory', 'User', 'Group',  'Restart', 'PermissionsStartOnly', 
-                        'ExecStartPre', 'ExecStart', 'ExecStartPost', 'RemainAfterExit',
-                        'ExecStop', 'ExecStopPost', 'OOMScoreAdjust']:
-                if key in serv.keys(): 
-                    if isinstance(serv[key], list):
-                        for val in serv[key]:
-                            fout.write('{}={}\n'.format(key, val))
-                    else:
-                        fout.write('{}={}\n'.format(key, serv[key]))
-            fout.write('\n[Install]\n')
-            for key in ['Alias', 'WantedBy']:
-                if key in serv.keys(): fout.write('{}={}\n'.format(key, serv[key]))
+        write_unit(dest, serv)
 
         # set correct .service file location
-        cmds.append(['sudo', 'mv', dest, os.path.join('/lib/systemd/system',os.path.basename(dest))])
-        
-        # always issue a sudo systemctl daemon-reload
-        cmds.append(['sudo', 'systemctl', 'daemon-reload'])
+        plan['files'].append((dest, os.path.join(UNITDIR, os.path.basename(dest))))
 
-        # start service at boot; not sure if this step must be skipped if service already enabled
-        cmds.append(['sudo', 'systemctl', 'enable', service])
+        if service in TIMERS.keys():
+            # the timer starts the job; the job itself is not enabled
+            dest = create_timer(service, wadroot, **kwargs)
+            plan['files'].append((dest, os.path.join(UNITDIR, os.path.basename(dest))))
+            plan['enable'].append('{}.timer'.format(service))
+            plan['start'].append('{}.timer'.format(service))
+        elif socket_activated:
+            dest = create_socket(service, wadroot, user)
+            plan['files'].append((dest, os.path.join(UNITDIR, os.path.basename(dest))))
 
-        # manually start service now; not sure if this step must be skipped if service already started
-        cmds.append(['sudo', 'systemctl', 'start', service])
+            # a running uwsgi owns the socket path; stop it and let the socket unit take over
+            plan['stop'].append(service)
+            plan['disable'].append(service)
+            plan['enable'].append('{}.socket'.format(service))
+            plan['start'].append('{}.socket'.format(service))
+        else:
+            plan['enable'].append(service)
+            plan['start'].append(service)
     else:
         result = 'ERROR'
         msg = 'Unknown Service {}'.format(service)
-        
-    for cmd in cmds:
-        result, msg = external_call(cmd, returnoutput=True)
-        mustquit = (not result == "OK")
-        if mustquit:
-            if 'Created symlink' in msg:
-                result = "OK"
+
+    return result, msg, plan
+
+def _file_hash(fname):
+    import hashlib
+    with open(fname, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def _systemctl_call(cmd):
+    """
+    Run a (sudo) systemctl or file command; returns its exit code, stdout and stderr.
+    Unlike external_call, the exit code decides: systemctl reports progress like "Created symlink" on stderr.
+    """
+    import subprocess
+    try:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        (output, error) = proc.communicate()
+    except OSError as e:
+        return 1, '', str(e)
+    return proc.returncode, bytes_as_string(output.strip()), bytes_as_string(error.strip())
+
+def _unit_states(verb, units):
+    """
+    Map each unit to its state from one "systemctl is-active" or "systemctl is-enabled" call;
+    an empty dict if the states cannot be read.
+    The exit code is not an error: it is non-zero as soon as one of the units is not active or not enabled.
+    """
+    if len(units) == 0:
+        return {}
+    code, output, error = _systemctl_call(['systemctl', verb]+units)
+    states = output.splitlines()
+    if not len(states) == len(units):
+        return {}
+    return dict(zip(units, [st.strip() for st in states]))
+
+def install_units(services, installation_root, **kwargs):
+    """
+    Create the systemd units of a set of services and install them together: changed unit files are moved
+    in place followed by one daemon-reload, all units are enabled in one call and started in one call, so
+    systemd starts independent units in parallel and orders the others by their After/Requires.
+    A unit file with the same content (sha256) as the installed one is not touched, and a running service
+    without changes is not restarted, so re-running an unchanged set only queries systemd.
+    """
+    result, msg = ('OK', '')
+    user = getpass.getuser() # gets the name of the user running this shell
+
+    wadroot = installation_root
+    if wadroot is None:
+        wadroot = os.environ.get('WADROOT', installation_root)
+    if wadroot is None:
+        result = "ERROR"
+        msg = "Missing WADROOT definition. First run create_folders_settings!"
+        return result, msg
+
+    plans = []
+    for service in services:
+        result, msg, plan = _generate_units(service, wadroot, user, **kwargs)
+        if result == 'ERROR':
+            return result, msg
+        plans.append((service, plan))
+
+    return _install_plans(plans, services)
+
+def _install_plans(plans, services):
+    """
+    Install the (service, plan) pairs made by _generate_units, see install_units
+    """
+    # compare with the installed units
+    changed = []
+    for service, plan in plans:
+        newfiles = []
+        for src, dest in plan['files']:
+            if os.path.exists(dest) and _file_hash(src) == _file_hash(dest):
+                os.remove(src)
             else:
-                errormsg = 'ERROR! Could not create and start systemd script for {}! '.format(service)
-                return result, errormsg+msg
+                newfiles.append((src, dest))
+        plan['files'] = newfiles
+        plan['remove'] = [f for f in plan['remove'] if os.path.exists(f)]
+        if len(plan['files'])+len(plan['remove']) > 0:
+            changed.append(service)
+    logger.info('...units changed: {}'.format(', '.join(changed) if len(changed) > 0 else 'none'))
+
+    cmds = []
+    for service, plan in plans:
+        if not service in changed:
+            continue
+        for src, dest in plan['files']:
+            if not os.path.dirname(dest) == UNITDIR and not os.path.exists(os.path.dirname(dest)): # drop-in folder
+                cmds.append(['sudo', 'mkdir', '-p', os.path.dirname(dest)])
+            cmds.append(['sudo', 'mv', src, dest])
+        for dest in plan['remove']:
+            cmds.append(['sudo', 'rm', '-f', dest])
+
+    if len(changed) > 0:
+        cmds.append(['sudo', 'systemctl', 'daemon-reload'])
+        for verb in ['stop', 'disable']:
+            units = [u for service, plan in plans if service in changed for u in plan[verb]]
+            if len(units) > 0:
+                cmds.append(['sudo', 'systemctl', verb]+units)
+
+    result, msg = _run_systemctl(cmds, services)
+    if result == 'ERROR':
+        return result, msg
+
+    # enable at boot the units that are not enabled yet
+    units = [u for service, plan in plans for u in plan['enable']]
+    states = _unit_states('is-enabled', units)
+    units = [u for u in units if not states.get(u, '') in ['enabled', 'static']]
+    cmds = []
+    if len(units) > 0:
+        cmds.append(['sudo', 'systemctl', 'enable']+units)
+
+    # changed units are restarted to pick up their new definition; unchanged units are only started if needed
+    units = [u for service, plan in plans if service in changed for u in plan['start']]
+    if len(units) > 0:
+        cmds.append(['sudo', 'systemctl', 'restart']+units)
+    units = [u for service, plan in plans if not service in changed for u in plan['start']]
+    states = _unit_states('is-active', units)
+    units = [u for u in units if not states.get(u, '') == 'active']
+    if len(units) > 0:
+        cmds.append(['sudo', 'systemctl', 'start']+units)
+
+    return _run_systemctl(cmds, services)
+
+def _run_systemctl(cmds, services):
+    """
+    Run the commands in order and stop at the first one that fails. A command fails on a non-zero exit code,
+    except for systemctl stop and disable of units that are not loaded (e.g. on a first install): those
+    succeed if the units end up inactive or not enabled.
+    """
+    result, msg = ('OK', '')
+    for cmd in cmds:
+        code, output, error = _systemctl_call(cmd)
+        msg = output
+        if code == 0:
+            continue
+
+        verb, units = (None, [])
+        if 'systemctl' in cmd:
+            pos = cmd.index('systemctl')
+            verb, units = (cmd[pos+1], [u for u in cmd[pos+2:] if not u.startswith('-')])
+        if verb == 'stop' and len(units) > 0:
+            states = _unit_states('is-active', units)
+            if len(states) > 0 and not 'active' in states.values():
+                continue
+        elif verb == 'disable' and len(units) > 0:
+            states = _unit_states('is-enabled', units)
+            if len(states) > 0 and not 'enabled' in states.values():
+                continue
+
+        result = "ERROR"
+        errormsg = 'ERROR! Could not create and start systemd script for {}! '.format(', '.join(services))
+        return result, errormsg+'{} (exit code {}): {}'.format(' '.join(cmd), code, error or output)
 
     return result, msg
 
+def create_start_systemd(service, installation_root, **kwargs):
+    """
+    Create a systemd service configuration, enable it and start it now
+    """
+    return install_units([service], installation_root, **kwargs)
+
 def replace_systemd(**kwargs):
     """
     Use this only when running in docker, or in WSL under Windows 10. It replaces parts of systemd, so
@@ -392,14 +1019,20 @@ def replace_systemd(**kwargs):
                 return result, errormsg+msg
     
 
-    # replace systemctl by python wrapper
+    # replace systemctl by python wrapper; the launcher runs it as a precompiled module,
+    # so a systemctl call that is handed to the init process does not compile systemctl3.py first
     logger.info("Replacing systemctl...")
     srcfile  = os.path.join('scripts', 'files', 'systemd', 'systemctl3.py')
+    launcher = os.path.join('scripts', 'files', 'systemd', 'systemctl_launcher.py')
+    libdir   = "/usr/lib/systemctl3"
     destfile = "/usr/bin/systemctl"
     errormsg = 'ERROR! Could not replace systemctl! '
 
     cmds = [
-        ['sudo', 'cp', srcfile, destfile],
+        ['sudo', 'mkdir', '-p', libdir],
+        ['sudo', 'cp', srcfile, os.path.join(libdir, 'systemctl3.py')],
+        ['sudo', '/usr/bin/python3', '-m', 'py_compile', os.path.join(libdir, 'systemctl3.py')],
+        ['sudo', 'cp', launcher, destfile],
         ['sudo', 'chmod', '+x', destfile]
     ]
 
@@ -411,42 +1044,290 @@ def replace_systemd(**kwargs):
 
     return result, msg
 
+# drop-in in <service>.service.d that holds the changes made by update_service
+DROPIN = 'wadqc-override.conf'
+
+# how a changed property reaches a running service; all others (ExecStart, User, Nice, CPUAffinity, ...) need a restart
+LIVE_PROPERTIES = ['CPUWeight', 'IOWeight', 'AllowedCPUs', 'MemoryHigh', 'MemoryMax', 'TasksMax'] # systemctl set-property
+RELOAD_PROPERTIES = ['Description', 'After', 'Before', 'Requires', 'Wants', 'PartOf', 'StartLimitIntervalSec', 'StartLimitBurst',
+                     'TimeoutStartSec', 'Restart', 'RestartSec', 'RestartSteps', 'RestartMaxDelaySec', 'PermissionsStartOnly',
+                     'ExecStartPre', 'ExecStartPost', 'ExecStop', 'ExecStopPost', 'SyslogIdentifier'] # daemon-reload is enough
+
+DEPENDENCY_KEYS = ['After', 'Before', 'Requires', 'Wants', 'PartOf'] # lists of units; a drop-in can only extend them
+LIST_KEYS = ['ExecStartPre', 'ExecStart', 'ExecStartPost', 'ExecStop', 'ExecStopPost', 'CPUAffinity',
+             'Environment', 'EnvironmentFile'] # an empty assignment resets them
+# an empty assignment resets these to whatever systemd uses by default; other settings cannot be removed by a drop-in
+RESET_KEYS = LIST_KEYS+LIVE_PROPERTIES
+
+# where systemd looks for units, highest priority first
+UNIT_FOLDERS = ['/etc/systemd/system', '/run/systemd/system', UNITDIR, '/usr/lib/systemd/system']
+# systemctl show names some settings differently
+SHOW_NAMES = {'TimeoutStartSec': 'TimeoutStartUSec', 'RestartSec': 'RestartUSec', 'RestartMaxDelaySec': 'RestartMaxDelayUSec',
+              'StartLimitIntervalSec': 'StartLimitIntervalUSec', 'WatchdogSec': 'WatchdogUSec', 'EnvironmentFile': 'EnvironmentFiles'}
+
+def _parse_unit(lines, props=None):
+    """
+    Add the settings in the lines of a unit file or drop-in to props, a dict of (section, key) to the list of values
+    """
+    if props is None:
+        props = {}
+    section = None
+    for line in lines:
+        line = line.strip()
+        if line == '' or line[0] in '#;':
+            continue
+        if line.startswith('[') and line.endswith(']'):
+            section = line[1:-1]
+            continue
+        if not '=' in line:
+            continue
+        key, val = [v.strip() for v in line.split('=', 1)]
+        if key in DEPENDENCY_KEYS:
+            props.setdefault((section, key), []).extend([u for u in val.split() if not u in props.get((section, key), [])])
+        elif val == '':
+            props[(section, key)] = []
+        elif key in LIST_KEYS:
+            props.setdefault((section, key), []).append(val)
+        else:
+            props[(section, key)] = [val]
+    return props
+
+def _read_unit(fname, props=None):
+    """
+    Add the settings of a unit file or drop-in to props, see _parse_unit
+    """
+    with open(fname) as f:
+        return _parse_unit(f.read().splitlines(), props)
+
+def _show_properties(service):
+    """
+    Effective properties of service as systemd has loaded them, from systemctl show. The Exec* properties are
+    reduced to their command lines, without the status of the last run.
+    """
+    import re
+    code, output, error = _systemctl_call(['systemctl', 'show', '{}.service'.format(service)])
+    props = {}
+    for line in output.splitlines():
+        if not '=' in line:
+            continue
+        key, val = line.split('=', 1)
+        if key.startswith('Exec'):
+            val = ' '.join([v.strip() for v in re.findall(r'argv\[\]=([^;]*)', val)]) or val
+        props[key] = val
+    return props
+
+def _unit_files(service, shown):
+    """
+    The unit file and the drop-ins that systemd loads for service, in the order they apply: FragmentPath and
+    DropInPaths of the properties shown by systemctl show, or where systemd would find them in UNIT_FOLDERS
+    """
+    import glob
+    if not shown.get('FragmentPath', '') == '':
+        return shown['FragmentPath'], [f for f in shown.get('DropInPaths', '').split() if os.path.exists(f)]
+
+    unitfile = None
+    for folder in UNIT_FOLDERS:
+        fname = os.path.join(folder, '{}.service'.format(service))
+        if unitfile is None and os.path.exists(fname):
+            unitfile = fname
+    dropins = {}
+    for folder in reversed(UNIT_FOLDERS): # a drop-in replaces one with the same name in a folder with a lower priority
+        for fname in glob.glob(os.path.join(folder, '{}.service.d'.format(service), '*.conf')):
+            dropins[os.path.basename(fname)] = fname
+    return unitfile, [dropins[name] for name in sorted(dropins.keys())]
+
+def _effective_unit(service, shown, dropin, text):
+    """
+    Settings of service from its unit file with the drop-ins applied in systemd order, with text as
+    the content of dropin (None to leave it out)
+    """
+    unitfile, dropins = _unit_files(service, shown)
+    dropins = [f for f in dropins if not os.path.realpath(f) == os.path.realpath(dropin)]
+    props = _read_unit(unitfile)
+    done = text is None
+    for fname in dropins:
+        if not done and os.path.basename(fname) > os.path.basename(dropin):
+            _parse_unit(text.splitlines(), props)
+            done = True
+        _read_unit(fname, props)
+    if not done:
+        _parse_unit(text.splitlines(), props)
+    return props
+
+def _diff_units(old, new):
+    """
+    List of (section, key, old values, new values) for the properties that differ
+    """
+    keys = list(old.keys())+[k for k in new.keys() if not k in old.keys()]
+    return [(sec, key, old.get((sec, key), []), new.get((sec, key), []))
+            for sec, key in keys if not old.get((sec, key), []) == new.get((sec, key), [])]
+
+def _render_dropin(base, new):
+    """
+    Drop-in that turns unit properties base into new; returns the text and None, or None and the reason
+    why a drop-in cannot express the change
+    """
+    sections = {}
+    for sec, key, old, val in _diff_units(base, new):
+        lines = sections.setdefault(sec, [])
+        if sec == 'Install':
+            return None, '[Install] changed, which is only read from the unit file itself'
+        if key in DEPENDENCY_KEYS:
+            missing = [u for u in old if not u in val]
+            if len(missing) > 0:
+                return None, '{} no longer lists {}'.format(key, ' '.join(missing))
+            lines.append('{}={}'.format(key, ' '.join([u for u in val if not u in old])))
+        elif key in LIST_KEYS:
+            lines.append('{}='.format(key))
+            lines.extend(['{}={}'.format(key, v) for v in val])
+        elif len(val) == 0:
+            if not key in RESET_KEYS:
+                return None, '{} was removed'.format(key)
+            lines.append('{}='.format(key))
+        else:
+            lines.append('{}={}'.format(key, val[-1]))
+    text = '\n'.join(['[{}]\n{}\n'.format(sec, '\n'.join(lines)) for sec, lines in sections.items()])
+    return text, None
+
+def _backup_units(files, backups):
+    """
+    Copy the installed files that exist to their backups
+    """
+    import shutil
+    try:
+        os.makedirs(os.path.dirname(backups[0]), exist_ok=True)
+        for src, dest in zip(files, backups):
+            if os.path.exists(src):
+                shutil.copy(src, dest)
+    except Exception as e:
+        return "ERROR", str(e)
+    return "OK", ""
+
 def update_service(service, installation_root, tag, **kwargs):
     """
-    Replace an exisiting wad service with an updated one. 
-    Right now only wadpostgresql can be updated to include ExecStartPre to set ownership of some folders
+    Update an installed wad service to the current definition, with the tuning of the recipe, without rewriting it.
+    The differences with the unit as systemd loads it, including its overrides in /etc/systemd/system, are written
+    to the drop-in <service>.service.d/wadqc-override.conf. What to install is decided before anything is installed.
+    After the daemon-reload, the properties systemctl show reports before and after decide what happens to a
+    running service:
+      properties in LIVE_PROPERTIES changed: applied with systemctl set-property, also if others need a reload only
+      only properties in RELOAD_PROPERTIES changed: nothing, they are used at the next start or stop
+      anything else: restart
+    A changed setting that systemctl show does not report counts as changed.
+    If a drop-in cannot express the change (e.g. a dependency is removed) or other files of the service changed,
+    the generated units are installed as by create_start_systemd, without the drop-in.
+    The installed unit and drop-in are backed up to WAD_QC/upgraded with the given tag.
     """
     if installation_root is None:
         return "ERROR", 'Cannot update services without supplying "WADROOT"'
 
     result, msg = ('OK', '')
+    user = getpass.getuser() # gets the name of the user running this shell
 
-    valid_services = ['wadpostgresql']
-    if not service in valid_services:
+    unitfile = os.path.join(UNITDIR, "{}.service".format(service))
+    if not service in SERVICES.keys() or not os.path.exists(unitfile):
         result = "ERROR"
-        msg = "Cannot update service {}".format(service)
+        msg = "Cannot update service {}, it is not installed. Use create_start_systemd.".format(service)
         return result, msg
 
-    # make sure the backup folder exists
+    dropin = os.path.join(UNITDIR, "{}.service.d".format(service), DROPIN)
     backup_folder = os.path.join(installation_root, "WAD_QC", "upgraded")
-    os.makedirs(backup_folder, exist_ok=True)
+    backups = [os.path.join(backup_folder, "{}.service.{}".format(service, tag)),
+               os.path.join(backup_folder, "{}.{}.{}".format(service, DROPIN, tag))]
+    if os.path.exists(backups[0]):
+        msg = 'Refusing to upgrade "{}" because backup file "{}" already exists.'.format(service, backups[0])
+        return "ERROR", msg
 
-    if service == 'wadpostgresql':
-        # move existing service to WADROOT/<service>.backup
-        
-        # make a backup of the original file
-        src = os.path.join('/lib/systemd/system', "{}.service".format(service))
-        dest = os.path.join(backup_folder, "{}.service.{}".format(service, tag))
-        if os.path.exists(dest):
-            msg = 'Refusing to upgrade "{}" because backup file "{}" already exists.'.format(service, dest)
-            return "ERROR", msg
- 
-        import shutil
-        try:
-            shutil.copy(src, dest)
-        except Exception as e:
-            return "ERROR", str(e)
-
-        # now just make a new systemd service, overwriting the existing one
-        return create_start_systemd(service, installation_root, **kwargs)
-        
\ No newline at end of file
+    # the generated units, in installation_root
+    result, msg, plan = _generate_units(service, installation_root, user, **kwargs)
+    if result == 'ERROR':
+        return result, msg
+
+    # the other files of the service (socket, instance template) must be unchanged, else install the full units
+    generated = None
+    reason = None
+    for src, dest in plan['files']:
+        if dest == unitfile:
+            generated = src
+        elif not os.path.exists(dest) or not _file_hash(src) == _file_hash(dest):
+            reason = '{} changed'.format(os.path.basename(dest))
+    if len([f for f in plan['remove'] if os.path.exists(f)]) > 0:
+        reason = 'files to remove'
+
+    shown = _show_properties(service)
+    old = _effective_unit(service, shown, dropin, None)
+    if os.path.exists(dropin):
+        with open(dropin) as f:
+            old = _effective_unit(service, shown, dropin, f.read())
+    text = None
+    if reason is None:
+        text, reason = _render_dropin(_effective_unit(service, shown, dropin, None), _read_unit(generated))
+
+    if not reason is None:
+        logger.info('...{}: {}; installing the full units'.format(service, reason))
+        plan['remove'].append(dropin)
+        result, msg = _backup_units([unitfile, dropin], backups)
+        if result == 'ERROR':
+            return result, msg
+        return _install_plans([(service, plan)], [service])
+
+    for src, dest in plan['files']:
+        os.remove(src)
+    if text.strip() == '':
+        text = None
+    new = _effective_unit(service, shown, dropin, text)
+    changes = _diff_units(old, new)
+    if len(changes) == 0:
+        msg = 'Service {} is up to date'.format(service)
+        logger.info(msg)
+        return result, msg
+
+    # install the drop-in
+    cmds = []
+    if text is None:
+        cmds.append(['sudo', 'rm', '-f', dropin])
+    else:
+        src = os.path.join(installation_root, "{}.{}".format(service, DROPIN))
+        with open(src, 'w') as fout:
+            fout.write(text)
+        if not os.path.exists(os.path.dirname(dropin)):
+            cmds.append(['sudo', 'mkdir', '-p', os.path.dirname(dropin)])
+        cmds.append(['sudo', 'mv', src, dropin])
+    cmds.append(['sudo', 'systemctl', 'daemon-reload'])
+
+    result, msg = _backup_units([unitfile, dropin], backups)
+    if result == 'ERROR':
+        return result, msg
+    result, msg = _run_systemctl(cmds, [service])
+    if result == 'ERROR':
+        return result, msg
+
+    # the effective changes
+    after = _show_properties(service)
+    keys = []
+    for sec, key, oldval, newval in changes:
+        name = SHOW_NAMES.get(key, key)
+        if name in shown.keys() and name in after.keys():
+            if shown[name] == after[name]:
+                logger.info('...{}: {} {} -> {}, no effective change'.format(service, key, ' '.join(oldval) or '(unset)', ' '.join(newval) or '(unset)'))
+                continue
+            logger.info('...{}: {} {} -> {}'.format(service, key, shown[name] or '(unset)', after[name] or '(unset)'))
+        else:
+            logger.info('...{}: {} {} -> {}'.format(service, key, ' '.join(oldval) or '(unset)', ' '.join(newval) or '(unset)'))
+        keys.append((sec, key))
+
+    cmds = []
+    restart = [key for sec, key in keys if not key in LIVE_PROPERTIES+RELOAD_PROPERTIES]
+    live = ['{}={}'.format(key, (new.get((sec, key), []) or [''])[-1]) for sec, key in keys if key in LIVE_PROPERTIES]
+    if _unit_states('is-active', [service]).get(service, '') == 'active':
+        if len(restart) > 0:
+            logger.info('...{}: restart for {}'.format(service, ', '.join(restart)))
+            cmds.append(['sudo', 'systemctl', 'restart', service])
+        elif len(live) > 0:
+            # the drop-in keeps them after a reboot
+            cmds.append(['sudo', 'systemctl', 'set-property', '--runtime', service]+live)
+
+    result, msg = _run_systemctl(cmds, [service])
+    if result == 'OK':
+        msg = 'Updated service {}: {}'.format(service, ', '.join([key for sec, key in keys]) or 'no effective changes')
+    return result, msg
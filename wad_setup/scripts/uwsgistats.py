@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+__version__ = '20261019'
+
+"""
+Collector for the uwsgi stats servers of the WAD-QC sites deployed on nginx.
+
+Each uwsgi ini (admin_wadqc, dashboard_wadqc, api_wadqc) enables a stats socket
+  WADROOT/sockets/<app>.stats.sock
+which dumps a json document on connect. This script reads all of them and shows
+per app: busy/idle workers, listen queue depth and errors, requests, exceptions,
+harakiri counts and per worker RSS. A growing listen queue with all workers busy
+means requests are queueing; a high avg_rt with idle workers means slow handlers.
+
+It is stand-alone (standard library only), because nginx_deploy_sites installs it
+as ~/.local/bin/wad_uwsgistats.
+
+Usage:
+  wad_uwsgistats                      # table view
+  wad_uwsgistats --workers            # table view including each worker
+  wad_uwsgistats --format prometheus  # prometheus text exposition format
+  wad_uwsgistats --serve 9117         # serve the prometheus format on http://127.0.0.1:9117/metrics
+  wad_uwsgistats --serve 9117 --address 0.0.0.0  # also for a remote prometheus, on http://<host>:9117/metrics
+
+Changelog:
+ 20261019: initial version
+"""
+
+import os
+import sys
+import json
+import glob
+import socket
+import argparse
+
+STATS_SUFFIX = '.stats.sock'
+WORKER_STATES = ['idle', 'busy', 'cheap', 'pause', 'sig']
+
+def read_stats(sockfile, timeout=2.):
+    """
+    Read the json stats dump of one uwsgi stats socket
+    """
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.settimeout(timeout)
+    try:
+        s.connect(sockfile)
+        chunks = []
+        while True:
+            data = s.recv(65536)
+            if not data:
+                break
+            chunks.append(data)
+    finally:
+        s.close()
+    return json.loads(b''.join(chunks).decode('utf-8', 'replace'))
+
+def find_stats_sockets(sockdir):
+    """
+    Map app name to stats socket for all stats sockets in sockdir
+    """
+    socks = {}
+    for sockfile in sorted(glob.glob(os.path.join(sockdir, '*'+STATS_SUFFIX))):
+        socks[os.path.basename(sockfile)[:-len(STATS_SUFFIX)]] = sockfile
+    return socks
+
+def summarize(stats):
+    """
+    Aggregate the raw stats of one uwsgi master
+    """
+    workers = stats.get('workers', [])
+    summary = {
+        'listen_queue': stats.get('listen_queue', 0),
+        'listen_queue_errors': stats.get('listen_queue_errors', 0),
+        'max_queue': max([s.get('max_queue', 0) for s in stats.get('sockets', [])] or [0]),
+        'load': stats.get('load', 0),
+        'workers': len(workers),
+        'requests': sum(w.get('requests', 0) for w in workers),
+        'exceptions': sum(w.get('exceptions', 0) for w in workers),
+        'harakiri_count': sum(w.get('harakiri_count', 0) for w in workers),
+        'respawn_count': sum(w.get('respawn_count', 0) for w in workers),
+        'rss': sum(w.get('rss', 0) for w in workers),
+        'avg_rt': 0,
+        'per_worker': [],
+    }
+    for state in WORKER_STATES:
+        summary[state] = len([w for w in workers if w.get('status') == state])
+
+    # weigh the average response time of each worker by its number of requests
+    nreq = summary['requests']
+    if nreq > 0:
+        summary['avg_rt'] = sum(w.get('avg_rt', 0)*w.get('requests', 0) for w in workers)/float(nreq)
+
+    for w in workers:
+        summary['per_worker'].append({
+            key: w.get(key, 0) for key in ['id', 'pid', 'status', 'requests', 'exceptions', 'harakiri_count',
+                                           'respawn_count', 'rss', 'vsz', 'avg_rt', 'running_time']
+        })
+    return summary
+
+def collect(sockdir):
+    """
+    Summaries for all apps in sockdir. An app whose stats socket cannot be read is reported as down.
+    """
+    result = {}
+    for app, sockfile in find_stats_sockets(sockdir).items():
+        try:
+            result[app] = summarize(read_stats(sockfile))
+            result[app]['up'] = 1
+        except (socket.error, ValueError) as e:
+            result[app] = {'up': 0, 'error': str(e)}
+    return result
+
+def format_prometheus(collected):
+    """
+    Prometheus text exposition format
+    """
+    metrics = [
+        # name, help, type, key
+        ('wadqc_uwsgi_up', 'Whether the stats socket of the app could be read.', 'gauge', 'up'),
+        ('wadqc_uwsgi_listen_queue', 'Requests waiting in the listen queue.', 'gauge', 'listen_queue'),
+        ('wadqc_uwsgi_listen_queue_max', 'Size of the listen queue.', 'gauge', 'max_queue'),
+        ('wadqc_uwsgi_listen_queue_errors', 'Requests dropped because the listen queue was full.', 'counter', 'listen_queue_errors'),
+        ('wadqc_uwsgi_workers', 'Number of workers.', 'gauge', 'workers'),
+        ('wadqc_uwsgi_requests_total', 'Requests handled by all workers.', 'counter', 'requests'),
+        ('wadqc_uwsgi_exceptions_total', 'Exceptions raised in all workers.', 'counter', 'exceptions'),
+        ('wadqc_uwsgi_harakiri_total', 'Workers killed by harakiri.', 'counter', 'harakiri_count'),
+        ('wadqc_uwsgi_respawn_total', 'Worker respawns.', 'counter', 'respawn_count'),
+        ('wadqc_uwsgi_rss_bytes', 'Resident memory of all workers.', 'gauge', 'rss'),
+        ('wadqc_uwsgi_avg_response_time_microseconds', 'Average response time of all workers.', 'gauge', 'avg_rt'),
+    ]
+    lines = []
+    for name, hlp, mtype, key in metrics:
+        lines.append('# HELP {} {}'.format(name, hlp))
+        lines.append('# TYPE {} {}'.format(name, mtype))
+        for app, data in sorted(collected.items()):
+            if key in data:
+                lines.append('{}{{app="{}"}} {}'.format(name, app, data[key]))
+
+    lines.append('# HELP wadqc_uwsgi_workers_state Number of workers per state.')
+    lines.append('# TYPE wadqc_uwsgi_workers_state gauge')
+    for app, data in sorted(collected.items()):
+        for state in WORKER_STATES:
+            if state in data:
+                lines.append('wadqc_uwsgi_workers_state{{app="{}",state="{}"}} {}'.format(app, state, data[state]))
+
+    worker_metrics = [
+        ('wadqc_uwsgi_worker_rss_bytes', 'Resident memory of a worker.', 'gauge', 'rss'),
+        ('wadqc_uwsgi_worker_requests_total', 'Requests handled by a worker.', 'counter', 'requests'),
+        ('wadqc_uwsgi_worker_harakiri_total', 'Harakiri count of a worker.', 'counter', 'harakiri_count'),
+        ('wadqc_uwsgi_worker_avg_response_time_microseconds', 'Average response time of a worker.', 'gauge', 'avg_rt'),
+    ]
+    for name, hlp, mtype, key in worker_metrics:
+        lines.append('# HELP {} {}'.format(name, hlp))
+        lines.append('# TYPE {} {}'.format(name, mtype))
+        for app, data in sorted(collected.items()):
+            for w in data.get('per_worker', []):
+                lines.append('{}{{app="{}",worker="{}"}} {}'.format(name, app, w['id'], w[key]))
+
+    return '\n'.join(lines)+'\n'
+
+def format_table(collected, show_workers=False):
+    """
+    Human readable view
+    """
+    fmt = '{:<18} {:>5} {:>5} {:>5} {:>8} {:>8} {:>10} {:>8} {:>9} {:>10} {:>10}'
+    lines = [fmt.format('app', 'busy', 'idle', 'total', 'queue', 'q.errors', 'requests', 'except', 'harakiri', 'avg_rt ms', 'rss MB')]
+    for app, data in sorted(collected.items()):
+        if not data['up']:
+            lines.append('{:<18} DOWN: {}'.format(app, data.get('error', '')))
+            continue
+        lines.append(fmt.format(app, data['busy'], data['idle'], data['workers'],
+                                '{}/{}'.format(data['listen_queue'], data['max_queue']), data['listen_queue_errors'],
+                                data['requests'], data['exceptions'], data['harakiri_count'],
+                                '{:.1f}'.format(data['avg_rt']/1000.), '{:.1f}'.format(data['rss']/1024./1024.)))
+        if show_workers:
+            for w in data['per_worker']:
+                lines.append('  worker {:>3} pid {:>7} {:<6} requests {:>8} harakiri {:>3} avg_rt {:>8.1f} ms rss {:>8.1f} MB'.format(
+                    w['id'], w['pid'], w['status'], w['requests'], w['harakiri_count'], w['avg_rt']/1000., w['rss']/1024./1024.))
+    return '\n'.join(lines)
+
+def serve(sockdir, port, address=''):
+    """
+    Serve the prometheus format on /metrics
+    """
+    try:
+        from http.server import HTTPServer, BaseHTTPRequestHandler
+    except ImportError:
+        from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if not self.path.split('?')[0] in ['/metrics', '/']:
+                self.send_error(404)
+                return
+            body = format_prometheus(collect(sockdir)).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    HTTPServer((address, port), MetricsHandler).serve_forever()
+
+if __name__ == "__main__":
+    sockdir = None
+    if 'WADROOT' in os.environ:
+        sockdir = os.path.join(os.environ['WADROOT'], 'sockets')
+
+    parser = argparse.ArgumentParser(description='Show the uwsgi stats of the WAD-QC sites')
+    parser.add_argument('-s', '--sockdir',
+                        default=sockdir,
+                        type=str,
+                        help='folder with the uwsgi stats sockets [{}].'.format(sockdir),
+                        dest='sockdir')
+    parser.add_argument('-f', '--format',
+                        default='table',
+                        choices=['table', 'prometheus', 'json'],
+                        help='output format [table].',
+                        dest='format')
+    parser.add_argument('-w', '--workers',
+                        default=False, action='store_true',
+                        help='also show each worker in the table view [False].',
+                        dest='workers')
+    parser.add_argument('--serve',
+                        default=None,
+                        type=int,
+                        help='serve the prometheus format on this port instead of printing [None].',
+                        dest='port')
+    parser.add_argument('--address',
+                        default='127.0.0.1',
+                        type=str,
+                        help='address to serve on [127.0.0.1].',
+                        dest='address')
+
+    args = parser.parse_args()
+    if args.sockdir is None:
+        print('Error! WADROOT cannot be found in the environment and no --sockdir was given. Exit.\n\n')
+        parser.print_help()
+        sys.exit(1)
+
+    if not args.port is None:
+        serve(args.sockdir, args.port, args.address)
+    else:
+        collected = collect(args.sockdir)
+        if args.format == 'prometheus':
+            sys.stdout.write(format_prometheus(collected))
+        elif args.format == 'json':
+            print(json.dumps(collected, indent=2))
+        else:
+            print(format_table(collected, show_workers=args.workers))